@@ -4,29 +4,51 @@ from logging.handlers import RotatingFileHandler
 from flask import Flask
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
 from flask_login import LoginManager
+from flask_migrate import Migrate
 from flask_bcrypt import Bcrypt
-from flask_wtf import CSRFProtect
 from config import Config
+from app.cache import PresignedUrlCache, ObjectCache, ModelCache
+from app.storage import Storage
+from app.hashing import PasswordHasher
+from app.metrics import metrics
+from app.queries import queries
+from app.tokens import BearerSessionInterface, BearerCSRFProtect, \
+    RevocationList
 
 
 db = SQLAlchemy()
 migrate = Migrate()
 bcrypt = Bcrypt()
-csrf = CSRFProtect()
+csrf = BearerCSRFProtect()
 login = LoginManager()
 login.login_view = 'auth.login'
+presigned_urls = PresignedUrlCache()
+object_cache = ObjectCache()
+user_cache = ModelCache()
+revoked_tokens = RevocationList()
+storage = Storage()
+hasher = PasswordHasher()
 
 
 def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(Config)
+    # Bearer token requests ignore the session cookie
+    app.session_interface = BearerSessionInterface()
     db.init_app(app)
     migrate.init_app(app, db)
     login.init_app(app)
     bcrypt.init_app(app)
     csrf.init_app(app)
+    presigned_urls.init_app(app)
+    object_cache.init_app(app)
+    user_cache.init_app(app)
+    revoked_tokens.init_app(app)
+    storage.init_app(app)
+    hasher.init_app(app)
+    metrics.init_app(app)
+    queries.init_app(app)
     CORS(app, origins="*", supports_credentials=True)
 
     from app.s3 import bp as s3_bp
@@ -59,4 +81,24 @@ def create_app(config_class=Config):
 
     return app
 
+
+def warm_up(app):
+    """
+    Loads what the first request would otherwise load lazily, the
+    storage client's service models, PyJWT and the email libraries.
+
+    Called by a preloading gunicorn master so forked workers share
+    them and answer their first request without the delay. Nothing
+    holding a socket is shared, workers build their own clients.
+    """
+    with app.app_context():
+        backend = storage.backend
+        if hasattr(backend, 'client'):
+            backend.client
+        db.get_engine()
+        import jwt
+        from app.auth.email import make_message, get_session
+        make_message('warm@up.com', '', 'warm@up.com', '')
+        get_session()
+
 from app import models
@@ -1,33 +1,247 @@
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
+import os
+import threading
+from uuid import uuid4
+from datetime import datetime, timedelta
+
 from flask import current_app
+from sqlalchemy import or_
 
+from app import db
+from app.metrics import timed
+from app.models import OutboxEmail
 
-def auth_email(_from_email, _subject, _to_email, _content):
-    message = Mail(
-        from_email=_from_email,
-        to_emails=_to_email,
-        subject=_subject,
-        html_content=_content
+# One keep-alive session per process, created on first use.
+# requests and sendgrid are only imported then, so booting a
+# worker does not pay for them.
+_session = None
+_session_pid = None
+
+
+def get_session():
+    """
+    Returns the process wide HTTP session used to reach SendGrid.
+
+    Connections are kept alive between messages, so only the first
+    send pays for the TLS handshake. A forked worker builds its own
+    session instead of sharing the parent's sockets.
+    """
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        session = requests.Session()
+        session.mount('https://', HTTPAdapter(
+            pool_maxsize=current_app.config['SENDGRID_POOL_SIZE']))
+        session.headers.update({
+            'Authorization': 'Bearer {}'.format(
+                current_app.config['SENDGRID_API_KEY']),
+            'Content-Type': 'application/json',
+        })
+        _session, _session_pid = session, os.getpid()
+    return _session
+
+
+def make_message(from_email, subject, to_email, content):
+    from sendgrid.helpers.mail import Mail
+
+    return Mail(
+        from_email=from_email,
+        to_emails=to_email,
+        subject=subject,
+        html_content=content
     )
+
+
+@timed('email')
+def send_message(message):
+    """
+    Sends a sendgrid Mail and returns the response status code
+    """
+    res = get_session().post(
+        current_app.config['SENDGRID_API_HOST'] + '/v3/mail/send',
+        json=message.get(),
+        timeout=current_app.config['SENDGRID_TIMEOUT']
+    )
+    res.raise_for_status()
+    return res.status_code
+
+
+def auth_email(_from_email, _subject, _to_email, _content):
+    message = make_message(_from_email, _subject, _to_email, _content)
     try:
-        sg = SendGridAPIClient(current_app.config['SENDGRID_API_KEY'])
-        response = sg.send(message)
-        return response.status_code
+        return send_message(message)
     except Exception as e:
         print(str(e))
 
 
 def reset_email(_from_email, _subject, _to_email, _content):
-    message = Mail(
-        from_email=_from_email,
-        to_emails=_to_email,
-        subject=_subject,
-        html_content=_content
-    )
+    message = make_message(_from_email, _subject, _to_email, _content)
     try:
-        sg = SendGridAPIClient(current_app.config['SENDGRID_API_KEY'])
-        response = sg.send(message)
-        return response.status_code
+        return send_message(message)
     except Exception as e:
         print(str(e))
+
+
+class Outbox(object):
+    """
+    Database backed queue of outgoing emails.
+
+    Routes queue a message in their own transaction and call `notify`
+    after committing. A background thread, or `flask outbox drain`,
+    sends due messages in batches and retries failures with
+    exponential backoff.
+    """
+    def __init__(self):
+        self._wakeup = threading.Event()
+        self._worker = None
+        self._worker_pid = None
+        self._lock = threading.Lock()
+
+    def queue(self, from_email, subject, to_email, content, kind):
+        """
+        Adds an email to the session, the caller commits it.
+
+        An email of the same kind to the same address queued within
+        `OUTBOX_COALESCE_SECONDS` is reused: a pending one gets the new
+        content and a sent one is not sent again.
+        """
+        window = timedelta(
+            seconds=current_app.config['OUTBOX_COALESCE_SECONDS'])
+        recent = OutboxEmail.query.filter(
+            OutboxEmail.to_email == to_email,
+            OutboxEmail.kind == kind,
+            OutboxEmail.created_at >= datetime.utcnow() - window
+        ).order_by(OutboxEmail.id.desc()).first()
+
+        if recent and recent.status == 'pending':
+            recent.subject = subject
+            recent.content = content
+            return recent
+        if recent and recent.status in ('sending', 'sent'):
+            return recent
+
+        email = OutboxEmail(from_email=from_email, to_email=to_email,
+                            subject=subject, content=content, kind=kind)
+        db.session.add(email)
+        return email
+
+    def queue_many(self, from_email, subject, messages, kind):
+        """
+        Adds `(to_email, content)` messages with one insert, the caller
+        commits them. Nothing is coalesced, this is for addresses that
+        were never sent to, such as imported users.
+        """
+        if not messages:
+            return
+        db.session.execute(OutboxEmail.__table__.insert(), [{
+            'from_email': from_email,
+            'to_email': to_email,
+            'subject': subject,
+            'content': content,
+            'kind': kind,
+        } for to_email, content in messages])
+
+    def notify(self):
+        """
+        Wakes the worker of this process, starting it if needed
+        """
+        if not current_app.config['OUTBOX_WORKER'] or current_app.testing:
+            return
+        with self._lock:
+            if self._worker_pid != os.getpid() or \
+                    not self._worker.is_alive():
+                self._worker = threading.Thread(
+                    target=self.run,
+                    args=(current_app._get_current_object(),),
+                    daemon=True
+                )
+                self._worker_pid = os.getpid()
+                self._worker.start()
+        self._wakeup.set()
+
+    def run(self, app):
+        """
+        Drains the outbox until the process exits
+        """
+        with app.app_context():
+            while True:
+                try:
+                    sent = self.drain()
+                except Exception as err:
+                    app.logger.error('Outbox drain failed: %s', err)
+                    db.session.rollback()
+                    sent = 0
+                finally:
+                    db.session.remove()
+                if not sent:
+                    self._wakeup.wait(app.config['OUTBOX_POLL_SECONDS'])
+                    self._wakeup.clear()
+
+    def claim(self, batch_size):
+        """
+        Marks a batch of due emails as sending and returns them.
+
+        Emails stuck in sending longer than `OUTBOX_CLAIM_TIMEOUT`
+        belong to a worker that died and are claimed again.
+        """
+        now = datetime.utcnow()
+        stale = now - timedelta(
+            seconds=current_app.config['OUTBOX_CLAIM_TIMEOUT'])
+        due_ids = [row.id for row in db.session.query(OutboxEmail.id).filter(
+            or_(
+                (OutboxEmail.status == 'pending') &
+                (OutboxEmail.next_attempt_at <= now),
+                (OutboxEmail.status == 'sending') &
+                (OutboxEmail.claimed_at < stale)
+            )
+        ).order_by(OutboxEmail.id).limit(batch_size)]
+        if not due_ids:
+            return []
+
+        # Only one worker wins each row, even across processes
+        claim_id = uuid4().hex
+        OutboxEmail.query.filter(
+            OutboxEmail.id.in_(due_ids),
+            or_(OutboxEmail.status == 'pending',
+                OutboxEmail.claimed_at < stale)
+        ).update({'status': 'sending', 'claimed_by': claim_id,
+                  'claimed_at': now}, synchronize_session=False)
+        db.session.commit()
+        return OutboxEmail.query.filter_by(claimed_by=claim_id).all()
+
+    def drain(self, batch_size=None):
+        """
+        Sends one batch of due emails, returns how many were tried
+        """
+        batch_size = batch_size or current_app.config['OUTBOX_BATCH_SIZE']
+        emails = self.claim(batch_size)
+        for email in emails:
+            message = make_message(email.from_email, email.subject,
+                                   email.to_email, email.content)
+            try:
+                send_message(message)
+            except Exception as err:
+                self.retry_later(email, err)
+            else:
+                email.status = 'sent'
+                email.sent_at = datetime.utcnow()
+        db.session.commit()
+        return len(emails)
+
+    @staticmethod
+    def retry_later(email, err):
+        email.attempts += 1
+        email.last_error = str(err)[:255]
+        if email.attempts >= current_app.config['OUTBOX_MAX_ATTEMPTS']:
+            email.status = 'failed'
+            current_app.logger.error('Giving up on email %d to %s: %s',
+                                     email.id, email.to_email, err)
+            return
+        delay = current_app.config['OUTBOX_RETRY_BACKOFF'] * \
+            2 ** (email.attempts - 1)
+        email.status = 'pending'
+        email.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+
+
+outbox = Outbox()
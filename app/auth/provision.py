@@ -0,0 +1,228 @@
+import os
+import csv
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from flask import current_app, render_template
+
+from app import db, storage, hasher
+from app.models import User, PurgeJob, new_folder
+from app.auth.email import outbox
+from app.auth.routes import MIN_USERNAME_LEN, MAX_USERNAME_LEN, \
+    MIN_PASSWORD_LEN, MAX_PASSWORD_LEN
+from app.hashing import hash_password
+
+
+class MalformedRow(dict):
+    """
+    Stands in for an NDJSON line that is not a JSON object, so the
+    import reports it and goes on with the next line
+    """
+    def __init__(self, error):
+        super(MalformedRow, self).__init__()
+        self.error = error
+
+
+def read_users(stream, fmt):
+    """
+    Yields a dict for each user of a CSV file with a header row or of
+    an NDJSON file. Rows have username, email and password and may
+    have verified.
+    """
+    if fmt == 'csv':
+        for row in csv.DictReader(stream):
+            yield row
+        return
+    for line_number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as err:
+            yield MalformedRow('line {0} is not valid JSON: {1}'.format(
+                line_number, err))
+            continue
+        if not isinstance(row, dict):
+            yield MalformedRow(
+                'line {} is not a JSON object'.format(line_number))
+            continue
+        yield row
+
+
+def check_user(row):
+    """
+    Returns why a row can not be imported, or None. The same rules
+    as `/register`.
+    """
+    if isinstance(row, MalformedRow):
+        return row.error
+    username = row.get('username') or ''
+    email = row.get('email') or ''
+    password = row.get('password') or ''
+    if not username or not email or not password:
+        return 'missing username, email or password'
+    if (len(username) <= MIN_USERNAME_LEN) or \
+            (len(username) >= MAX_USERNAME_LEN):
+        return 'username must be between {0} and {1} characters'.format(
+            MIN_USERNAME_LEN, MAX_USERNAME_LEN)
+    if (len(password) < MIN_PASSWORD_LEN) or \
+            (len(password) > MAX_PASSWORD_LEN):
+        return 'password must be between {0} and {1} characters'.format(
+            MIN_PASSWORD_LEN, MAX_PASSWORD_LEN)
+    return None
+
+
+def is_verified(row):
+    return str(row.get('verified', '')).lower() in ('1', 'true', 'yes')
+
+
+class Importer(object):
+    """
+    Creates users in chunks: one query finds the usernames and emails
+    already taken, passwords are hashed in a process pool, rows and
+    verification emails are inserted with one statement each and the
+    storage folders are created concurrently.
+
+    Each chunk is committed on its own. The number of rows done is
+    written to `checkpoint` after each commit, a rerun skips them, and
+    users that already exist are skipped either way, so an interrupted
+    import can be run again.
+    """
+    def __init__(self, chunk_size=500, workers=None, checkpoint=None):
+        self.chunk_size = chunk_size
+        self.workers = os.cpu_count() if workers is None else workers
+        self.checkpoint = checkpoint
+        self.created = 0
+        self.skipped = 0
+        self.invalid = []
+
+    def load_checkpoint(self):
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            with open(self.checkpoint) as f:
+                return int(f.read().strip() or 0)
+        return 0
+
+    def save_checkpoint(self, done):
+        if not self.checkpoint:
+            return
+        tmp = self.checkpoint + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(str(done))
+        os.replace(tmp, self.checkpoint)
+
+    def run(self, rows, done=None):
+        """
+        Imports `rows`, skipping the first `done`, by default the
+        number saved in the checkpoint
+        """
+        if done is None:
+            done = self.load_checkpoint()
+        pool = None
+        if self.workers:
+            pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn'))
+        try:
+            chunk = []
+            for number, row in enumerate(rows, 1):
+                if number <= done:
+                    continue
+                chunk.append((number, row))
+                if len(chunk) >= self.chunk_size:
+                    self.import_chunk(chunk, pool)
+                    self.save_checkpoint(chunk[-1][0])
+                    chunk = []
+            if chunk:
+                self.import_chunk(chunk, pool)
+                self.save_checkpoint(chunk[-1][0])
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+
+    def new_users(self, chunk):
+        """
+        Drops invalid rows and rows whose username or email is taken,
+        or whose username belongs to an account still being purged
+        """
+        valid = []
+        for number, row in chunk:
+            err = check_user(row)
+            if err:
+                self.invalid.append((number, err))
+            else:
+                valid.append(row)
+
+        usernames = [row['username'] for row in valid]
+        emails = [row['email'] for row in valid]
+        taken_usernames, taken_emails = set(), set()
+        for username, email in db.session.query(
+                User.username, User.email).filter(
+                User.username.in_(usernames) | User.email.in_(emails)):
+            taken_usernames.add(username)
+            taken_emails.add(email)
+        taken_usernames.update(PurgeJob.pending_usernames(usernames))
+
+        users = []
+        for row in valid:
+            if row['username'] in taken_usernames or \
+                    row['email'] in taken_emails:
+                self.skipped += 1
+                continue
+            taken_usernames.add(row['username'])
+            taken_emails.add(row['email'])
+            users.append(row)
+        return users
+
+    def import_chunk(self, chunk, pool):
+        users = self.new_users(chunk)
+        if not users:
+            return
+
+        passwords = [row['password'] for row in users]
+        if pool is None:
+            hashes = [hash_password(password, hasher.rounds)
+                      for password in passwords]
+        else:
+            hashes = list(pool.map(
+                hash_password, passwords, [hasher.rounds] * len(passwords),
+                chunksize=max(1, len(passwords) // (self.workers * 4))))
+
+        # Folders first, a marker left by a failed chunk is harmless
+        folders = [new_folder() for _ in users]
+        backend = storage.backend
+        with ThreadPoolExecutor(
+                current_app.config['UPLOAD_CONCURRENCY']) as threads:
+            list(threads.map(lambda folder: backend.put(folder + '/', b''),
+                             folders))
+
+        db.session.execute(User.__table__.insert(), [{
+            'username': row['username'],
+            'folder': folder,
+            'email': row['email'],
+            'password_hash': password_hash,
+            'is_verified': is_verified(row),
+        } for row, password_hash, folder in zip(users, hashes, folders)])
+
+        unverified = [row['username'] for row in users
+                      if not is_verified(row)]
+        if unverified:
+            messages = []
+            # The template builds URLs, which needs a request outside
+            # of a view
+            with current_app.test_request_context():
+                for user_id, email in db.session.query(
+                        User.id, User.email).filter(
+                        User.username.in_(unverified)):
+                    token = User(id=user_id).get_email_token()
+                    messages.append((email, render_template(
+                        'email/verify.html', token=token)))
+            outbox.queue_many('welcome@justfiles.com',
+                              'Verify Your Account!', messages, 'verify')
+
+        db.session.commit()
+        self.created += len(users)
@@ -0,0 +1,115 @@
+from uuid import uuid4
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from flask import current_app
+from sqlalchemy import or_
+
+from app import db, storage
+from app.models import PurgeJob
+from app.s3.blobs import collect_blobs
+
+# Purges run here so deleting a large account does not hold a worker.
+# Jobs cut short by a restart are picked up by `flask users
+# resume-purges`, run by boot.sh.
+executor = ThreadPoolExecutor(max_workers=2)
+
+
+def create_purge_job(prefix, username):
+    """
+    Adds a queued purge job to the session, the caller commits it
+    """
+    job = PurgeJob(id=uuid4().hex, prefix=prefix, username=username)
+    db.session.add(job)
+    return job
+
+
+def start_purge(job_id):
+    """
+    Runs a committed purge job in the background
+    """
+    app = current_app._get_current_object()
+    return executor.submit(run_purge, app, job_id)
+
+
+def _resumable(stale):
+    return or_(PurgeJob.status.in_(['queued', 'failed']),
+               (PurgeJob.status == 'running') &
+               (PurgeJob.updated_at < stale))
+
+
+def resumable_jobs():
+    """
+    Returns the ids of queued and failed jobs and of running jobs
+    whose worker stopped updating them
+    """
+    stale = datetime.utcnow() - timedelta(
+        seconds=current_app.config['PURGE_STALE_SECONDS'])
+    return [job_id for job_id, in db.session.query(PurgeJob.id)
+            .filter(_resumable(stale)).order_by(PurgeJob.created_at)]
+
+
+def claim_purge(job_id):
+    """
+    Marks a job as running, returns False when another worker runs it
+    """
+    now = datetime.utcnow()
+    stale = now - timedelta(seconds=current_app.config['PURGE_STALE_SECONDS'])
+    claimed = PurgeJob.query.filter(PurgeJob.id == job_id, _resumable(stale)) \
+        .update({'status': 'running', 'updated_at': now, 'failed': 0},
+                synchronize_session=False)
+    db.session.commit()
+    return bool(claimed)
+
+
+def run_purge(app, job_id):
+    """
+    Pages through the objects under the job prefix and deletes
+    each page with one batch request, keeping at most
+    `PURGE_CONCURRENCY` delete requests in flight, then removes
+    content addressed blobs that are no longer referenced.
+
+    Deleting is idempotent, so a job resumed after a restart or
+    after failing to delete some keys starts over from the first
+    page. Returns the job, or None when another
+    worker runs it.
+    """
+    with app.app_context():
+        if not claim_purge(job_id):
+            return None
+        job = PurgeJob.query.get(job_id)
+
+        backend = storage.backend
+        concurrency = app.config['PURGE_CONCURRENCY']
+
+        def record(done):
+            for future in done:
+                deleted, errors = future.result()
+                job.deleted += len(deleted)
+                job.failed += len(errors)
+            job.updated_at = datetime.utcnow()
+            db.session.commit()
+
+        try:
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                pending = set()
+                for keys in backend.list_pages(job.prefix):
+                    pending.add(pool.submit(backend.delete_many, keys))
+                    if len(pending) >= concurrency:
+                        done, pending = wait(
+                            pending, return_when=FIRST_COMPLETED)
+                        record(done)
+                record(wait(pending).done)
+            # Blobs that only the deleted files referenced
+            job.deleted += collect_blobs()
+            # Keys that failed to delete are retried by a resumed run
+            job.status = 'failed' if job.failed else 'done'
+        except Exception as err:
+            app.logger.error('Purge of %s failed: %s', job.prefix, err)
+            db.session.rollback()
+            job.status = 'failed'
+
+        job.finished_at = job.updated_at = datetime.utcnow()
+        db.session.commit()
+        app.logger.info('Purge of %s %s, %d deleted, %d failed',
+                        job.prefix, job.status, job.deleted, job.failed)
+        return job
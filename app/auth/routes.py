@@ -1,17 +1,16 @@
-import boto3
-from flask import current_app, render_template, flash, redirect, \
+from flask import render_template, flash, redirect, \
                     url_for, request, jsonify
 from flask_login import login_user, logout_user, current_user
 from flask_wtf import csrf as _csrf
 
-from app import db, csrf
-from app.models import User
+from app import db, csrf, storage, revoked_tokens
+from app.models import User, File, PurgeJob
 from app.auth import bp
-from app.auth.email import auth_email, reset_email
+from app.auth.email import outbox
+from app.auth.purge import create_purge_job, start_purge
+from app.s3.blobs import release_user_blobs
 from app.utils import login_required
-
-s3 = boto3.resource('s3')
-s3_client = boto3.client('s3')
+from app.tokens import issue_tokens, decode_token, bearer_token
 
 # Form Validator Constants
 MIN_USERNAME_LEN = 6
@@ -64,13 +63,21 @@ def login():
         if (not user) or (not user.check_password(password)):
             return jsonify({'err': 'Invalid username or password'}), 400
 
+        # Upgrade the hash while the password is at hand
+        if user.password_needs_rehash():
+            user.set_password(password)
+            db.session.commit()
+
         # If the user is not verified, send a new email
         if not user.is_verified:
             token = user.get_email_token()
-            auth_email('welcome@justfiles.com',
-                       'Verify Your Account!',
-                       user.email,
-                       render_template('email/verify.html', token=token))
+            outbox.queue('welcome@justfiles.com',
+                         'Verify Your Account!',
+                         user.email,
+                         render_template('email/verify.html', token=token),
+                         'verify')
+            db.session.commit()
+            outbox.notify()
             return jsonify({
                 'err': 'Please verify your account. We just sent another email'
             }), 401
@@ -93,6 +100,70 @@ def logout():
     return jsonify({'msg': 'Logged out'})
 
 
+@csrf.exempt
+@bp.route('/token', methods=['POST'])
+def token():
+    """
+    Issues an access and refresh token pair for API clients. Send the
+    access token as `Authorization: Bearer <token>` instead of logging in.
+    """
+    try:
+        username = request.form['username']
+        password = request.form['password']
+    except KeyError:
+        return jsonify({'err': 'Missing form information'}), 400
+
+    user = User.query.filter_by(username=username).first()
+    if (not user) or (not user.check_password(password)):
+        return jsonify({'err': 'Invalid username or password'}), 400
+    if not user.is_verified:
+        return jsonify({'err': 'Please verify your account'}), 401
+
+    if user.password_needs_rehash():
+        user.set_password(password)
+        db.session.commit()
+
+    return jsonify(issue_tokens(user))
+
+
+@csrf.exempt
+@bp.route('/token/refresh', methods=['POST'])
+def refresh_token():
+    """
+    Exchanges a refresh token for a new token pair, the old refresh
+    token is revoked
+    """
+    claims = decode_token(request.form.get('refresh_token'), 'refresh')
+    if claims is None or revoked_tokens.is_revoked(claims):
+        return jsonify({'err': 'Invalid or expired token'}), 401
+
+    user = User.query.get(claims['sub'])
+    if not user:
+        return jsonify({'err': 'Invalid or expired token'}), 401
+
+    revoked_tokens.revoke(claims)
+    db.session.commit()
+    return jsonify(issue_tokens(user))
+
+
+@csrf.exempt
+@bp.route('/token/revoke', methods=['POST'])
+def revoke_token():
+    """
+    Revokes the access or refresh token in the `token` field, or the
+    bearer token of the request
+    """
+    claims = decode_token(
+        request.form.get('token') or bearer_token(), kind=None)
+    if claims is None:
+        return jsonify({'err': 'Invalid or expired token'}), 400
+
+    if not revoked_tokens.is_revoked(claims):
+        revoked_tokens.revoke(claims)
+        db.session.commit()
+    return jsonify({'msg': 'Token revoked'})
+
+
 @csrf.exempt
 @bp.route('/register', methods=['GET', 'POST'])
 def register():
@@ -114,6 +185,13 @@ def register():
         if user_exists:
             return jsonify({'err': 'Username or email already exists'}), 400
 
+        # The files of a deleted account with this name are still
+        # being removed
+        if PurgeJob.pending_usernames([username]):
+            return jsonify({
+                'err': 'Username is not available yet, try again later'
+            }), 400
+
         if (len(username) <= MIN_USERNAME_LEN) or \
                 (len(username) >= MAX_USERNAME_LEN):
             return jsonify({
@@ -138,13 +216,15 @@ def register():
         db.session.commit()
 
         token = user.get_email_token()
-        auth_email('welcome@justfiles.com',
-                   'Verify Your Account!',
-                   user.email,
-                   render_template('email/verify.html', token=token))
+        outbox.queue('welcome@justfiles.com',
+                     'Verify Your Account!',
+                     user.email,
+                     render_template('email/verify.html', token=token),
+                     'verify')
+        db.session.commit()
+        outbox.notify()
 
-        s3.Bucket(current_app.config['S3_BUCKET']
-                  ).put_object(Key=user.username + '/')
+        storage.put(user.folder + '/', b'')
 
     return jsonify({'msg': 'User added'})
 
@@ -153,11 +233,32 @@ def register():
 @login_required
 def delete_user():
     """
-    Deletes a user and the user's S3 buckets
+    Deletes a user and the user's files, then removes the user's
+    storage folder in the background. Poll `/user/delete/<job_id>`
+    for the progress of the purge.
     """
+    job = create_purge_job(current_user.folder + '/',
+                           current_user.username)
+    release_user_blobs(current_user.id)
+    File.query.filter_by(user_id=current_user.id) \
+        .delete(synchronize_session=False)
+    revoked_tokens.revoke_user(current_user.id)
     db.session.delete(current_user)
     db.session.commit()
+    logout_user()
 
-    s3_client.delete_object(
-        Bucket=current_app.config['S3_BUCKET'], Key=current_user.username + '/')
-    return jsonify({'msg': 'User deleted'})
+    start_purge(job.id)
+    return jsonify({'msg': 'User deleted', 'job': job.to_dict()})
+
+
+@bp.route('/user/delete/<job_id>')
+def purge_status(job_id):
+    """
+    Reports the progress of a user's purge job. Open to anyone, the
+    deleted user is logged out and the job id is a random uuid4 that
+    only the deletion response reveals.
+    """
+    job = PurgeJob.query.get(job_id)
+    if not job:
+        return jsonify({'err': 'Job does not exist'}), 404
+    return jsonify({'job': job.to_dict()})
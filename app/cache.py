@@ -0,0 +1,346 @@
+import os
+import mmap
+import hashlib
+import tempfile
+from collections import OrderedDict
+from threading import Event, Lock
+from time import time
+from flask import current_app
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+
+from app.storage import StorageError
+
+
+class LRUCache(object):
+    """
+    Thread-safe LRU mapping with optional per-entry expiry
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, expires_at=None):
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return entry[0] if entry else None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class PresignedUrlCache(object):
+    """
+    Reuses presigned URLs while they have at least
+    `PRESIGNED_URL_MIN_TTL` seconds of validity left, so
+    clients polling a file get the same URL and can cache it
+    """
+    def __init__(self, app=None):
+        self._cache = LRUCache()
+        self._methods = set()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self._cache = LRUCache(app.config['PRESIGNED_URL_CACHE_SIZE'])
+
+    def get_url(self, backend, key, method='get_object'):
+        cache_key = (backend.name, key, method)
+        url = self._cache.get(cache_key)
+        if url is not None:
+            return url
+
+        expires_in = current_app.config['PRESIGNED_URL_EXPIRES']
+        url = backend.presign(key, expires_in, method)
+        # Stop handing the URL out once it is close to expiring
+        reusable_for = expires_in - current_app.config['PRESIGNED_URL_MIN_TTL']
+        if reusable_for > 0:
+            self._methods.add(method)
+            self._cache.set(cache_key, url, time() + reusable_for)
+        return url
+
+    def invalidate(self, backend, key):
+        for method in list(self._methods):
+            self._cache.pop((backend.name, key, method))
+
+    def stats(self):
+        return {'entries': len(self._cache)}
+
+
+class ModelCache(object):
+    """
+    Caches rows by primary key for `USER_CACHE_TTL` seconds.
+
+    Only column values are kept, never instances, so nothing cached
+    is bound to a session. A hit is rebuilt as a detached instance
+    and merged into the caller's session without a query. Each
+    process has its own cache, entries changed by another process
+    are stale for at most the TTL.
+    """
+    def __init__(self, app=None):
+        self._cache = LRUCache()
+        self.ttl = 0
+        self.hits = self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self._cache = LRUCache(app.config['USER_CACHE_SIZE'])
+        self.ttl = app.config['USER_CACHE_TTL']
+        self.hits = self.misses = 0
+
+    def get(self, session, model, ident):
+        if not self.ttl:
+            return session.query(model).get(ident)
+
+        values = self._cache.get((model.__name__, ident))
+        if values is not None:
+            self.hits += 1
+            instance = model(**values)
+            make_transient_to_detached(instance)
+            return session.merge(instance, load=False)
+
+        self.misses += 1
+        instance = session.query(model).get(ident)
+        if instance is not None:
+            values = {attr.key: getattr(instance, attr.key)
+                      for attr in inspect(model).column_attrs}
+            self._cache.set((model.__name__, ident), values,
+                            time() + self.ttl)
+        return instance
+
+    def invalidate(self, model, ident):
+        self._cache.pop((model.__name__, ident))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': len(self._cache),
+        }
+
+
+class EmptyMap(bytes):
+    """
+    Stands in for the memory map of an empty file, which mmap refuses
+    """
+    def close(self):
+        pass
+
+
+class ObjectCache(object):
+    """
+    Read-through cache of stored objects on local disk.
+
+    Entries are named after the object's ETag, so an entry is fresh
+    exactly when its ETag matches the one stored on the File row and
+    hits need no storage request at all. The least recently used entries
+    are evicted once the cache holds more than `DISK_CACHE_MAX_BYTES`.
+    Only one thread caches an object at a time. Concurrent full reads
+    wait up to `DISK_CACHE_FILL_TIMEOUT` seconds for it to finish, then
+    fall back to storage; ranged reads of an uncached object never wait.
+    """
+    def __init__(self, app=None):
+        self.directory = None
+        self.max_bytes = 0
+        self.max_object_size = 0
+        self.fill_timeout = 0
+        self.hits = self.misses = self.evictions = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = Lock()
+        self._fills = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.directory = app.config['DISK_CACHE_DIR']
+        self.max_bytes = app.config['DISK_CACHE_MAX_BYTES']
+        self.max_object_size = app.config['DISK_CACHE_MAX_OBJECT_SIZE']
+        self.fill_timeout = app.config['DISK_CACHE_FILL_TIMEOUT']
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            self._load()
+
+    def _load(self):
+        """
+        Indexes entries left by an earlier process, oldest first
+        """
+        paths = []
+        for name in os.listdir(self.directory):
+            if '.' not in name or name.startswith('tmp'):
+                continue
+            path = os.path.join(self.directory, name)
+            stat = os.stat(path)
+            paths.append((stat.st_atime, name, stat.st_size))
+        for _, name, size in sorted(paths):
+            digest, etag = name.split('.', 1)
+            self._entries[digest] = (etag, size)
+            self._size += size
+        self._evict()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'bytes': self._size,
+        }
+
+    def _path(self, digest, etag):
+        return os.path.join(self.directory, '{0}.{1}'.format(digest, etag))
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._entries:
+            digest, (etag, size) = self._entries.popitem(last=False)
+            self._size -= size
+            self.evictions += 1
+            try:
+                os.remove(self._path(digest, etag))
+            except OSError:
+                pass
+
+    def _map(self, digest, etag):
+        with open(self._path(digest, etag), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return EmptyMap()
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _hit(self, digest, etag):
+        """
+        Maps a fresh entry, holding the lock
+        """
+        entry = self._entries.get(digest)
+        if not entry or entry[0] != etag:
+            return None
+        self._entries.move_to_end(digest)
+        try:
+            data = self._map(digest, etag)
+        except (IOError, OSError):
+            # Evicted by another process sharing the directory
+            self._entries.pop(digest)
+            self._size -= entry[1]
+            return None
+        self.hits += 1
+        return data
+
+    def open(self, backend, key, etag, size, fill=True):
+        """
+        Returns a read-only memory map of the object, or None when the
+        object is not cached and should be read from storage directly.
+
+        A miss caches the object only when `fill` is set, as for a GET
+        of the whole object. If another thread is caching it already
+        the miss waits for that instead of fetching the object again.
+        """
+        if not self.directory or not etag or size is None or \
+                size > self.max_object_size:
+            return None
+
+        etag = etag.strip('"')
+        digest = hashlib.sha1(
+            '{0}/{1}'.format(backend.name, key).encode('utf-8')).hexdigest()
+
+        with self._lock:
+            data = self._hit(digest, etag)
+            if data is not None:
+                return data
+            filling = self._fills.get(digest)
+            if not fill or filling is None:
+                self.misses += 1
+                if not fill:
+                    return None
+                self._fills[digest] = Event()
+
+        if filling is not None:
+            # Served from storage if the fill is slow or fails
+            filling.wait(self.fill_timeout)
+            with self._lock:
+                data = self._hit(digest, etag)
+                if data is None:
+                    self.misses += 1
+                return data
+
+        try:
+            return self._fill(backend, key, digest, etag)
+        finally:
+            with self._lock:
+                self._fills.pop(digest).set()
+
+    def _fill(self, backend, key, digest, etag):
+        try:
+            obj = backend.open(key, if_match=etag)
+        except StorageError:
+            # Changed or deleted since the row was written
+            return None
+
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(prefix='tmp', dir=self.directory)
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in obj.body.iter_chunks(1024 * 1024):
+                    f.write(chunk)
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, self._path(digest, etag))
+            tmp_path = None
+        except (IOError, OSError) as err:
+            # A full disk only skips the cache, the object is
+            # read from storage instead
+            current_app.logger.warning('Could not cache %s: %s', key, err)
+            return None
+        finally:
+            obj.body.close()
+            if tmp_path is not None:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+
+        with self._lock:
+            old = self._entries.pop(digest, None)
+            if old:
+                self._size -= old[1]
+                if old[0] != etag:
+                    try:
+                        os.remove(self._path(digest, old[0]))
+                    except OSError:
+                        pass
+            self._entries[digest] = (etag, size)
+            self._size += size
+            self._evict()
+            if digest not in self._entries:
+                return None
+            try:
+                return self._map(digest, etag)
+            except (IOError, OSError):
+                return None
@@ -0,0 +1,143 @@
+import click
+
+from app import db, storage
+from app.auth.email import outbox
+from app.models import File
+from app.storage import ObjectNotFound
+
+
+def drain_outbox():
+    """
+    Sends every due email, returns how many were tried
+    """
+    sent = 0
+    while True:
+        batch = outbox.drain()
+        if not batch:
+            return sent
+        sent += batch
+
+
+def register(app):
+    @app.cli.group()
+    def files():
+        """File maintenance commands."""
+        pass
+
+    @files.command()
+    @click.option('--batch-size', default=100,
+                  help='Number of rows to commit at a time.')
+    def backfill(batch_size):
+        """Store size, ETag and content type on older File rows."""
+        updated = missing = 0
+        last_id = None
+        while True:
+            query = File.query.filter(File.size.is_(None))
+            if last_id is not None:
+                query = query.filter(File.id > last_id)
+            rows = query.order_by(File.id).limit(batch_size).all()
+            if not rows:
+                break
+            for row in rows:
+                try:
+                    row.set_metadata(storage.head(row.key))
+                    updated += 1
+                except ObjectNotFound:
+                    missing += 1
+            last_id = rows[-1].id
+            db.session.commit()
+
+        click.echo('Backfilled {0} files, {1} missing from storage'
+                   .format(updated, missing))
+
+    @files.command()
+    @click.option('--repair', is_flag=True,
+                  help='Delete orphaned objects and rows whose object '
+                       'is missing.')
+    @click.option('--grace', default=3600,
+                  help='Seconds an orphaned object is left alone, so '
+                       'uploads in progress are not deleted.')
+    @click.option('--concurrency', default=8,
+                  help='Number of folders listed at a time.')
+    @click.option('--batch-size', default=1000,
+                  help='Number of rows read or repaired at a time.')
+    def reconcile(repair, grace, concurrency, batch_size):
+        """Compare storage with the File and Blob rows."""
+        from app.s3.reconcile import Reconciler
+
+        reconciler = Reconciler(repair, grace, concurrency, batch_size)
+        reconciler.run(
+            lambda kind, key: click.echo('{0} {1}'.format(kind, key)))
+        click.echo('Checked {0} objects, {1} orphaned, {2} missing'
+                   .format(reconciler.checked, reconciler.orphans,
+                           reconciler.missing))
+        if repair:
+            click.echo('Deleted {0} objects and {1} rows'.format(
+                reconciler.deleted_objects, reconciler.deleted_rows))
+
+    @app.cli.group()
+    def users():
+        """User commands."""
+        pass
+
+    @users.command('resume-purges')
+    def resume_purges():
+        """Finish purges of deleted users cut short by a restart."""
+        from app.auth.purge import resumable_jobs, run_purge
+
+        for job_id in resumable_jobs():
+            job = run_purge(app, job_id)
+            if job is not None:
+                click.echo('Purge of {0} {1}, {2} deleted, {3} failed'
+                           .format(job.prefix, job.status, job.deleted,
+                                   job.failed))
+
+    @users.command('import')
+    @click.argument('source', type=click.File('r'))
+    @click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']),
+                  help='Input format, guessed from the file name if unset.')
+    @click.option('--chunk-size', default=500,
+                  help='Number of users to insert and commit at a time.')
+    @click.option('--workers', type=int, default=None,
+                  help='Hashing processes, 0 hashes in this process. '
+                       'Defaults to the number of CPUs.')
+    @click.option('--checkpoint', default=None,
+                  help='Progress file to resume from. Defaults to '
+                       'SOURCE.checkpoint, none when reading stdin.')
+    def import_users(source, fmt, chunk_size, workers, checkpoint):
+        """Create the users of a CSV or NDJSON file."""
+        from app.auth.provision import Importer, read_users
+
+        if fmt is None:
+            fmt = 'csv' if source.name.lower().endswith('.csv') \
+                else 'ndjson'
+        if checkpoint is None and source.name != '<stdin>':
+            checkpoint = source.name + '.checkpoint'
+
+        importer = Importer(chunk_size, workers, checkpoint)
+        done = importer.load_checkpoint()
+        if done:
+            click.echo('Resuming after row {}'.format(done))
+        importer.run(read_users(source, fmt), done)
+
+        for number, err in importer.invalid:
+            click.echo('Row {0}: {1}'.format(number, err), err=True)
+        click.echo('Created {0} users, {1} already existed, {2} invalid'
+                   .format(importer.created, importer.skipped,
+                           len(importer.invalid)))
+        # Sent before exiting, a worker thread would die with the command
+        click.echo('Tried {} emails'.format(drain_outbox()))
+
+    @app.cli.group('outbox')
+    def outbox_group():
+        """Email outbox commands."""
+        pass
+
+    @outbox_group.command()
+    @click.option('--loop', is_flag=True,
+                  help='Keep draining until interrupted.')
+    def drain(loop):
+        """Send the queued emails that are due."""
+        if loop:
+            outbox.run(app)
+        click.echo('Tried {} emails'.format(drain_outbox()))
@@ -1,6 +1,7 @@
 from flask import jsonify
 from flask_wtf.csrf import CSRFError
 from app.errors import bp
+from app.hashing import HashingBusy
 
 
 @bp.app_errorhandler(CSRFError)
@@ -8,3 +9,10 @@ def csrf_error(e):
     return jsonify({
         'msg': 'You are missing a CSRF token'
     }), 400
+
+
+@bp.app_errorhandler(HashingBusy)
+def hashing_busy(e):
+    return jsonify({
+        'msg': 'Too many logins right now, please try again'
+    }), 503, {'Retry-After': '1'}
@@ -0,0 +1,121 @@
+import os
+import multiprocessing
+from threading import BoundedSemaphore, Lock
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+from app.metrics import timed
+
+
+class HashingBusy(Exception):
+    """
+    Raised when more passwords are waiting to be hashed than
+    `HASHING_QUEUE_SIZE` allows, the request should be retried
+    """
+    pass
+
+
+def hash_password(password, rounds):
+    from flask_bcrypt import generate_password_hash
+    return generate_password_hash(password, rounds).decode('utf-8')
+
+
+def verify_password(password_hash, password):
+    from flask_bcrypt import check_password_hash
+    return check_password_hash(password_hash, password)
+
+
+def hash_rounds(password_hash):
+    """
+    Returns the cost a bcrypt hash was made with, `$2b$12$...` is 12
+    """
+    try:
+        return int(password_hash.split('$')[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+class PasswordHasher(object):
+    """
+    Hashes and checks passwords with bcrypt in a process pool.
+
+    bcrypt is slow on purpose, running it on worker threads lets a
+    burst of logins starve every other request. At most
+    `HASHING_WORKERS` passwords are hashed at once and at most
+    `HASHING_QUEUE_SIZE` more wait for a worker, beyond that
+    HashingBusy is raised at once instead of queueing. With
+    `HASHING_WORKERS` set to 0 hashing runs in the caller, for tests.
+    """
+    def __init__(self, app=None):
+        self.rounds = 12
+        self.workers = 0
+        self.queue_size = 0
+        self.timeout = None
+        self._pool = None
+        self._pool_pid = None
+        self._slots = None
+        self._lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.rounds = app.config['BCRYPT_LOG_ROUNDS']
+        self.workers = app.config['HASHING_WORKERS']
+        self.queue_size = app.config['HASHING_QUEUE_SIZE']
+        self.timeout = app.config['HASHING_TIMEOUT']
+
+    def _get_pool(self):
+        # Workers are spawned, a forked web worker builds its own pool
+        with self._lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+                self._slots = BoundedSemaphore(
+                    self.workers + self.queue_size)
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def start(self):
+        """
+        Spawns the workers in the background, so the first login
+        of a new web worker does not wait for them
+        """
+        if self.workers:
+            pool = self._get_pool()
+            for _ in range(self.workers):
+                pool.submit(hash_rounds, '')
+
+    def _run(self, fn, *args):
+        if not self.workers:
+            return fn(*args)
+
+        pool = self._get_pool()
+        slots = self._slots
+        if not slots.acquire(blocking=False):
+            raise HashingBusy()
+        try:
+            future = pool.submit(fn, *args)
+        except Exception:
+            slots.release()
+            raise
+        future.add_done_callback(lambda future: slots.release())
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            raise HashingBusy()
+
+    @timed('hashing')
+    def hash(self, password):
+        return self._run(hash_password, password, self.rounds)
+
+    @timed('hashing')
+    def verify(self, password_hash, password):
+        return self._run(verify_password, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """
+        True when a hash was made with another cost than the
+        configured `BCRYPT_LOG_ROUNDS`
+        """
+        return hash_rounds(password_hash) != self.rounds
@@ -0,0 +1,293 @@
+import hmac
+import threading
+from bisect import bisect_left
+from functools import wraps
+from time import perf_counter
+
+from flask import request, g, Response, current_app, abort
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Prometheus' default buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Time spent in each span by the request running on this thread
+_local = threading.local()
+
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics(object):
+    """
+    Request latency broken down into db, storage, hashing and email
+    spans, kept in memory and served in the Prometheus text format
+    on `/metrics`.
+
+    Requests are timed by request hooks, SQL statements by engine
+    events and the rest by `timed` on the storage backends, the
+    password hasher and the email sender. Each process keeps its own
+    numbers, a scrape sees the gunicorn worker that answered it.
+
+    Off unless `METRICS_ENABLED` is set. `/metrics` then asks for
+    `METRICS_TOKEN` as a bearer token when one is configured, and the
+    `Server-Timing` header is only sent with `SERVER_TIMING`, as it
+    tells any client how long the backends took.
+    """
+    def __init__(self, app=None):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._requests = {}
+        self._statuses = {}
+        self._request_spans = {}
+        self._spans = {}
+        self._collectors = []
+        self._query_observers = []
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config['METRICS_ENABLED']
+        with self._lock:
+            self._requests.clear()
+            self._statuses.clear()
+            self._request_spans.clear()
+            self._spans.clear()
+        # Statements are timed for the query observers either way
+        if not event.contains(Engine, 'before_cursor_execute',
+                              _before_execute):
+            event.listen(Engine, 'before_cursor_execute', _before_execute)
+            event.listen(Engine, 'after_cursor_execute', _after_execute)
+            event.listen(Engine, 'handle_error', _after_error)
+        # Registered either way, they do nothing while disabled
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.teardown_request(self._teardown_request)
+        app.add_url_rule('/metrics', 'metrics', self.view)
+
+    def add_collector(self, collector):
+        """
+        Registers a callable returning `(name, type, help, samples)`
+        tuples, samples being `(labels, value)` pairs, read on scrape
+        """
+        self._collectors.append(collector)
+
+    def add_query_observer(self, observer):
+        """
+        Registers a callable called with `(statement, parameters,
+        executemany, seconds)` after every SQL statement, whether
+        metrics are enabled or not
+        """
+        self._query_observers.append(observer)
+
+    def observe_span(self, span, operation, seconds):
+        spans = getattr(_local, 'spans', None)
+        if spans is not None:
+            spans[span] = spans.get(span, 0.0) + seconds
+        key = (span, operation)
+        with self._lock:
+            histogram = self._spans.get(key)
+            if histogram is None:
+                histogram = self._spans[key] = Histogram()
+            histogram.observe(seconds)
+
+    def _start_request(self):
+        if not self.enabled:
+            return
+        _local.spans = {}
+        g.metrics_started_at = perf_counter()
+
+    def _finish_request(self, response):
+        started_at = g.pop('metrics_started_at', None)
+        if started_at is None:
+            return response
+        elapsed = perf_counter() - started_at
+        spans = getattr(_local, 'spans', None) or {}
+        _local.spans = None
+
+        endpoint = request.endpoint or 'unmatched'
+        method = request.method
+        with self._lock:
+            histogram = self._requests.get((endpoint, method))
+            if histogram is None:
+                histogram = self._requests[(endpoint, method)] = Histogram()
+            histogram.observe(elapsed)
+            status = (endpoint, method, response.status_code)
+            self._statuses[status] = self._statuses.get(status, 0) + 1
+            for span, seconds in spans.items():
+                key = (endpoint, span)
+                histogram = self._request_spans.get(key)
+                if histogram is None:
+                    histogram = self._request_spans[key] = Histogram()
+                histogram.observe(seconds)
+
+        if current_app.config['SERVER_TIMING']:
+            # Shows the breakdown in the browser's network panel
+            timings = ['{0};dur={1:.1f}'.format(span, seconds * 1000)
+                       for span, seconds in sorted(spans.items())]
+            timings.append('total;dur={:.1f}'.format(elapsed * 1000))
+            response.headers['Server-Timing'] = ', '.join(timings)
+        return response
+
+    def _teardown_request(self, exc):
+        _local.spans = None
+
+    def render(self):
+        lines = []
+
+        def histogram(name, help, items, label_names):
+            lines.append('# HELP {0} {1}'.format(name, help))
+            lines.append('# TYPE {} histogram'.format(name))
+            for labels, hist in items:
+                labels = dict(zip(label_names, labels))
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ('+Inf',), hist.counts):
+                    cumulative += count
+                    lines.append('{0}_bucket{1} {2}'.format(
+                        name, format_labels(labels, le=bound), cumulative))
+                lines.append('{0}_sum{1} {2}'.format(
+                    name, format_labels(labels), hist.sum))
+                lines.append('{0}_count{1} {2}'.format(
+                    name, format_labels(labels), hist.count))
+
+        with self._lock:
+            histogram('http_request_duration_seconds',
+                      'Time to answer a request.',
+                      sorted(self._requests.items()),
+                      ('endpoint', 'method'))
+            histogram('http_request_span_seconds',
+                      'Time a request spent in each kind of call.',
+                      sorted(self._request_spans.items()),
+                      ('endpoint', 'span'))
+            histogram('span_duration_seconds',
+                      'Time taken by each call to the database, storage, '
+                      'password hasher or email service.',
+                      sorted(self._spans.items()), ('span', 'operation'))
+            statuses = sorted(self._statuses.items())
+
+        lines.append('# HELP http_requests_total Requests answered.')
+        lines.append('# TYPE http_requests_total counter')
+        for (endpoint, method, status), count in statuses:
+            lines.append('http_requests_total{0} {1}'.format(format_labels(
+                {'endpoint': endpoint, 'method': method, 'status': status}),
+                count))
+
+        for collector in self._collectors:
+            for name, kind, help, samples in collector():
+                lines.append('# HELP {0} {1}'.format(name, help))
+                lines.append('# TYPE {0} {1}'.format(name, kind))
+                for labels, value in samples:
+                    lines.append('{0}{1} {2}'.format(
+                        name, format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+    def view(self):
+        if not self.enabled:
+            abort(404)
+        token = current_app.config['METRICS_TOKEN']
+        if token and not hmac.compare_digest(
+                request.headers.get('Authorization', ''),
+                'Bearer ' + token):
+            return Response('Unauthorized\n', 401,
+                            {'WWW-Authenticate': 'Bearer'})
+        return Response(self.render(),
+                        mimetype='text/plain; version=0.0.4')
+
+
+def format_labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{0}="{1}"'.format(name, str(value).replace('\\', '\\\\')
+                           .replace('"', '\\"'))
+        for name, value in sorted(labels.items())) + '}'
+
+
+def timed(span):
+    """
+    Records the calls of a function as `span`, named after the function.
+    Calls made from within a call of the same span are not recorded
+    twice.
+    """
+    def decorator(fn):
+        operation = fn.__name__
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            previous = getattr(_local, 'span', None)
+            if not metrics.enabled or previous == span:
+                return fn(*args, **kwargs)
+            _local.span = span
+            start = perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                _local.span = previous
+                metrics.observe_span(span, operation, perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def _before_execute(conn, cursor, statement, parameters, context,
+                    executemany):
+    conn.info.setdefault('query_started_at', []).append(perf_counter())
+
+
+def _after_execute(conn, cursor, statement, parameters, context,
+                   executemany):
+    started = conn.info.get('query_started_at')
+    if not started:
+        return
+    seconds = perf_counter() - started.pop()
+    if metrics.enabled:
+        operation = statement.lstrip().split(None, 1)[0].upper() \
+            if statement else 'UNKNOWN'
+        metrics.observe_span('db', operation, seconds)
+    for observer in metrics._query_observers:
+        observer(statement, parameters, executemany, seconds)
+
+
+def _after_error(context):
+    started = context.connection.info.get('query_started_at') \
+        if context.connection is not None else None
+    if started:
+        started.pop()
+
+
+def cache_metrics():
+    """
+    Hit rates and sizes of the in-process caches
+    """
+    from app import presigned_urls, object_cache, user_cache
+
+    users = user_cache.stats()
+    objects = object_cache.stats()
+    yield ('cache_hits_total', 'counter', 'Cache lookups that hit.', [
+        ({'cache': 'user'}, users['hits']),
+        ({'cache': 'object'}, objects['hits']),
+    ])
+    yield ('cache_misses_total', 'counter', 'Cache lookups that missed.', [
+        ({'cache': 'user'}, users['misses']),
+        ({'cache': 'object'}, objects['misses']),
+    ])
+    yield ('cache_entries', 'gauge', 'Entries held by a cache.', [
+        ({'cache': 'user'}, users['entries']),
+        ({'cache': 'object'}, objects['entries']),
+        ({'cache': 'presigned_url'}, presigned_urls.stats()['entries']),
+    ])
+    yield ('object_cache_bytes', 'gauge',
+           'Bytes held by the disk object cache.', [({}, objects['bytes'])])
+
+
+metrics = Metrics()
+metrics.add_collector(cache_metrics)
@@ -1,32 +1,51 @@
-import jwt
 from time import time
-from app import db, login
+from uuid import uuid4
+from datetime import datetime
+from app import db, login, hasher, user_cache, revoked_tokens
 from flask import current_app
 from flask_login import UserMixin
-from flask_bcrypt import generate_password_hash, check_password_hash
+from sqlalchemy import event
+from app.tokens import bearer_token, decode_token
+
+
+def new_folder():
+    """
+    Random storage folder for a new user, so the folder of a deleted
+    account is never handed to another one
+    """
+    return uuid4().hex
 
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), index=True, unique=True)
+    # Users created before folders were random keep their username
+    folder = db.Column(db.String(64), default=new_folder)
     email = db.Column(db.String(64), index=True, unique=True)
     password_hash = db.Column(db.String(128))
     is_verified = db.Column(db.Boolean, unique=False, default=False)
     files = db.relationship('File', backref='author', lazy='dynamic')
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password).decode('utf-8')
+        self.password_hash = hasher.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return hasher.verify(self.password_hash, password)
+
+    def password_needs_rehash(self):
+        return hasher.needs_rehash(self.password_hash)
 
     def get_email_token(self, expires_in=600):
+        import jwt
+
         return jwt.encode(
             {'email_id': self.id, 'exp': time() + expires_in},
             current_app.config['SECRET_KEY'], algorithm='HS256').decode('utf-8')
 
     @staticmethod
     def verify_email_token(token):
+        import jwt
+
         try:
             jwt_id = jwt.decode(token, current_app.config['SECRET_KEY'],
                                 algorithms=['HS256'])['email_id']
@@ -39,18 +58,187 @@ class User(UserMixin, db.Model):
         return '<User {}>'.format(self.username)
 
 
+class Blob(db.Model):
+    """
+    Content addressed object shared by every File with the same contents
+    """
+    sha256 = db.Column(db.String(64), primary_key=True)
+    key = db.Column(db.String(140))
+    size = db.Column(db.BigInteger)
+    etag = db.Column(db.String(64))
+    content_type = db.Column(db.String(128))
+    refcount = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    files = db.relationship('File', backref='blob', lazy='dynamic')
+
+    def set_metadata(self, metadata):
+        self.size = metadata['size']
+        self.etag = metadata['etag']
+        self.content_type = metadata['content_type']
+
+    def to_metadata(self):
+        return {
+            'size': self.size,
+            'etag': self.etag,
+            'content_type': self.content_type,
+        }
+
+    def __repr__(self):
+        return '<Blob {}>'.format(self.sha256)
+
+
 class File(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64), index=True)
-    key = db.Column(db.String(64), index=True)
+    key = db.Column(db.String(140), index=True)
     body = db.Column(db.String(140))
-    date = db.Column(db.String(140))
+    date = db.Column(db.String(140), default='')
+    size = db.Column(db.BigInteger)
+    etag = db.Column(db.String(64))
+    content_type = db.Column(db.String(128))
+    uploaded_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Thumbnail keys by size, see app/s3/thumbnails.py
+    thumbnails = db.Column(db.JSON(none_as_null=True))
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    blob_sha256 = db.Column(db.String(64), db.ForeignKey('blob.sha256'),
+                            index=True)
+
+    # Serve keyset pages of a user's files from the index
+    __table_args__ = (
+        db.Index('ix_file_user_id_id', 'user_id', 'id'),
+        db.Index('ix_file_user_id_date', 'user_id', 'date', 'id'),
+        db.Index('ix_file_user_id_name', 'user_id', 'name', unique=True),
+    )
+
+    @staticmethod
+    def name_exists(user_id, name):
+        """
+        Checks the unique (user_id, name) index without loading the row
+        """
+        return db.session.query(File.id).filter_by(
+            user_id=user_id, name=name).first() is not None
+
+    def set_metadata(self, metadata):
+        """
+        Stores the object metadata returned by `object_metadata`
+        """
+        self.size = metadata['size']
+        self.etag = metadata['etag']
+        self.content_type = metadata['content_type']
 
     def __repr__(self):
         return '<File {}>'.format(self.name)
 
 
+class PurgeJob(db.Model):
+    """
+    Progress of a background removal of every object under a prefix.
+    The username of the deleted account can not be registered again
+    until the job is done.
+    """
+    # Jobs that have not finished yet, failed ones are retried
+    PENDING = ('queued', 'running', 'failed')
+
+    id = db.Column(db.String(32), primary_key=True)
+    prefix = db.Column(db.String(80))
+    username = db.Column(db.String(64), index=True)
+    status = db.Column(db.String(16), default='queued')
+    deleted = db.Column(db.Integer, default=0)
+    failed = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Moved on by the running purge, a running job that has not been
+    # updated for PURGE_STALE_SECONDS belongs to a worker that died
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+    @staticmethod
+    def pending_usernames(usernames):
+        """
+        Returns the usernames whose deleted account is still purged
+        """
+        return {username for username, in db.session.query(
+            PurgeJob.username).filter(PurgeJob.username.in_(usernames),
+                                      PurgeJob.status.in_(PurgeJob.PENDING))}
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'deleted': self.deleted,
+            'failed': self.failed,
+        }
+
+    def __repr__(self):
+        return '<PurgeJob {}>'.format(self.prefix)
+
+
+class RevokedToken(db.Model):
+    """
+    A revoked bearer token, or with no `jti` every token issued to
+    `user_id` before `revoked_at`. Kept until `expires_at`, after
+    which the tokens it covers have expired anyway.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    jti = db.Column(db.String(32), unique=True)
+    user_id = db.Column(db.Integer, index=True)
+    revoked_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, index=True)
+
+    def __repr__(self):
+        return '<RevokedToken {}>'.format(self.jti or self.user_id)
+
+
+class OutboxEmail(db.Model):
+    """
+    An email waiting to be sent by the outbox worker
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    from_email = db.Column(db.String(64))
+    to_email = db.Column(db.String(64), index=True)
+    subject = db.Column(db.String(140))
+    content = db.Column(db.Text)
+    kind = db.Column(db.String(32))
+    status = db.Column(db.String(16), default='pending', index=True)
+    attempts = db.Column(db.Integer, default=0)
+    last_error = db.Column(db.String(255))
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow)
+    claimed_by = db.Column(db.String(32), index=True)
+    claimed_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return '<OutboxEmail {}>'.format(self.to_email)
+
+
 @login.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    return user_cache.get(db.session, User, int(id))
+
+
+@login.request_loader
+def load_user_from_token(request):
+    """
+    Loads the user of a valid bearer token through the user cache, so
+    a deleted user or a changed column is seen like for a session
+    """
+    token = bearer_token(request)
+    claims = decode_token(token) if token else None
+    if claims is None or revoked_tokens.is_revoked(claims):
+        return None
+    return user_cache.get(db.session, User, claims['sub'])
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def invalidate_user(mapper, connection, target):
+    user_cache.invalidate(User, target.id)
+    # Dropped again once committed, in case a request cached the
+    # old row between the flush and the commit
+    db.session.info.setdefault('changed_users', set()).add(target.id)
+
+
+@event.listens_for(db.session, 'after_commit')
+def invalidate_committed_users(session):
+    for user_id in session.info.pop('changed_users', ()):
+        user_cache.invalidate(User, user_id)
@@ -0,0 +1,178 @@
+import re
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import request, current_app, has_app_context
+
+from app.metrics import metrics
+
+# Runs of bound parameters, as in `IN (?, ?, ?)`, whatever the driver's
+# paramstyle, so statements differing only by list length match
+_PARAMETER = r'(?:\?|%s|%\(\w+\)s|:\w+)'
+_PARAMETER_LIST = re.compile(r'{0}(?:\s*,\s*{0})+'.format(_PARAMETER))
+# Query logs the current thread is recording into
+_local = threading.local()
+
+
+def statement_shape(statement):
+    return _PARAMETER_LIST.sub('?', ' '.join(statement.split()))
+
+
+def parameter_types(parameters, executemany):
+    """
+    Describes bound parameters without their values, which may be
+    password hashes, tokens or email addresses
+    """
+    if executemany:
+        rows = len(parameters)
+        parameters = parameters[0] if rows else ()
+    if isinstance(parameters, dict):
+        parameters = parameters.values()
+    types = '({})'.format(', '.join(
+        type(value).__name__ for value in parameters or ()))
+    if executemany:
+        return '{0} rows of {1}'.format(rows, types)
+    return types
+
+
+class QueryLog(object):
+    """
+    The statements run while it was recording, an executemany
+    counting as one
+    """
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = []
+        self.shapes = Counter()
+
+    def record(self, statement, seconds):
+        self.count += 1
+        self.seconds += seconds
+        self.statements.append(statement)
+        self.shapes[statement_shape(statement)] += 1
+
+    def repeated(self, threshold):
+        """
+        Returns `(shape, count)` for statements run at least
+        `threshold` times, usually one query per row of another
+        """
+        return [(shape, count) for shape, count in self.shapes.items()
+                if count >= threshold]
+
+
+@contextmanager
+def count_queries():
+    """
+    Records the statements run by this thread in the block
+    """
+    log = QueryLog()
+    logs = _logs()
+    logs.append(log)
+    try:
+        yield log
+    finally:
+        logs.remove(log)
+
+
+def _logs():
+    logs = getattr(_local, 'logs', None)
+    if logs is None:
+        logs = _local.logs = []
+    return logs
+
+
+class QueryTracker(object):
+    """
+    Counts the SQL statements of each request and the time spent in
+    them, logs statements slower than `SLOW_QUERY_SECONDS` with the
+    types of their parameters and warns about requests running the
+    same statement `N_PLUS_ONE_THRESHOLD` times or more, the sign of
+    a lazy load in a loop. Statements are timed by the engine
+    listeners of `app.metrics`.
+
+    Totals per endpoint are served on `/metrics` when metrics are
+    enabled, the logging does not depend on them.
+    """
+    def __init__(self, app=None):
+        self.slow_seconds = None
+        self.repeat_threshold = 0
+        self._lock = threading.Lock()
+        self._totals = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.slow_seconds = app.config['SLOW_QUERY_SECONDS']
+        self.repeat_threshold = app.config['N_PLUS_ONE_THRESHOLD']
+        with self._lock:
+            self._totals.clear()
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.teardown_request(self._teardown_request)
+
+    def _start_request(self):
+        _local.request_log = log = QueryLog()
+        _logs().append(log)
+
+    def _finish_request(self, response):
+        log = self._pop_request_log()
+        if log is None:
+            return response
+
+        if metrics.enabled:
+            endpoint = request.endpoint or 'unmatched'
+            with self._lock:
+                totals = self._totals.get(endpoint, (0, 0.0))
+                self._totals[endpoint] = (totals[0] + log.count,
+                                          totals[1] + log.seconds)
+
+        current_app.logger.debug('%s %s ran %d queries in %.1f ms',
+                                 request.method, request.path, log.count,
+                                 log.seconds * 1000)
+        if self.repeat_threshold:
+            for shape, count in log.repeated(self.repeat_threshold):
+                current_app.logger.warning(
+                    'Possible N+1 query, %s %s ran %d times: %s',
+                    request.method, request.path, count, shape)
+        return response
+
+    def _teardown_request(self, exc):
+        self._pop_request_log()
+
+    def _pop_request_log(self):
+        log = getattr(_local, 'request_log', None)
+        _local.request_log = None
+        if log is not None and log in _logs():
+            _logs().remove(log)
+        return log
+
+    def collect(self):
+        with self._lock:
+            totals = sorted(self._totals.items())
+        yield ('http_request_queries_total', 'counter',
+               'SQL statements run by requests.',
+               [({'endpoint': endpoint}, count)
+                for endpoint, (count, _) in totals])
+        yield ('http_request_query_seconds_total', 'counter',
+               'Time requests spent running SQL statements.',
+               [({'endpoint': endpoint}, seconds)
+                for endpoint, (_, seconds) in totals])
+
+
+def _record_query(statement, parameters, executemany, seconds):
+    for log in _logs():
+        log.record(statement, seconds)
+
+    slow_seconds = queries.slow_seconds
+    if slow_seconds is not None and seconds >= slow_seconds \
+            and has_app_context():
+        current_app.logger.warning(
+            'Slow query, %.1f ms: %s %s', seconds * 1000, statement,
+            parameter_types(parameters, executemany))
+
+
+queries = QueryTracker()
+metrics.add_collector(queries.collect)
+metrics.add_query_observer(_record_query)
@@ -0,0 +1,106 @@
+import os
+import zipfile
+from time import localtime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+
+from app.storage import StorageError
+
+# Formats that are already compressed are stored as is
+STORED_EXTENSIONS = set(['docx', 'xlsx', 'jpg', 'jpeg', 'png', 'gif'])
+CHUNK_SIZE = 64 * 1024
+
+
+class ZipStream(object):
+    """
+    Write-only file object that hands out what the archive wrote
+    """
+    def __init__(self):
+        self._chunks = []
+        self._offset = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._offset
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def compress_type(name):
+    extension = os.path.splitext(name)[1][1:].lower()
+    if extension in STORED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def stream_zip(backend, files, prefetch=4):
+    """
+    Yields a ZIP archive of `files`, a list of (name, key) pairs.
+
+    Objects are copied into the archive one chunk at a time while
+    GET requests for the next `prefetch` objects are already in
+    flight, so memory use does not depend on the archive size.
+    Objects that no longer exist are left out. Bodies still open when
+    the client goes away are closed.
+    """
+    output = ZipStream()
+    pending = deque()
+    files = iter(files)
+
+    with ThreadPoolExecutor(max_workers=prefetch) as pool:
+        def fetch_next():
+            entry = next(files, None)
+            if entry is not None:
+                pending.append((entry[0],
+                                pool.submit(backend.open, entry[1])))
+
+        for _ in range(prefetch):
+            fetch_next()
+
+        obj = None
+        try:
+            with zipfile.ZipFile(output, 'w', allowZip64=True) as archive:
+                while pending:
+                    name, future = pending.popleft()
+                    fetch_next()
+                    try:
+                        obj = future.result()
+                    except StorageError as err:
+                        current_app.logger.warning(
+                            'Leaving %s out of archive: %s', name, err)
+                        continue
+
+                    info = zipfile.ZipInfo(name, date_time=localtime()[:6])
+                    info.compress_type = compress_type(name)
+                    # Lets zipfile decide up front if the entry needs ZIP64
+                    info.file_size = obj.size
+                    with archive.open(info, 'w') as entry:
+                        for chunk in obj.body.iter_chunks(CHUNK_SIZE):
+                            entry.write(chunk)
+                            data = output.pop()
+                            if data:
+                                yield data
+                    obj.body.close()
+                    obj = None
+                    yield output.pop()
+
+            yield output.pop()
+        finally:
+            if obj is not None:
+                obj.body.close()
+            for _, future in pending:
+                try:
+                    future.result().body.close()
+                except Exception:
+                    pass
@@ -0,0 +1,225 @@
+import hashlib
+from uuid import uuid4
+from collections import Counter, defaultdict
+from flask import current_app
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from app import db, storage
+from app.models import Blob, File
+from app.s3.thumbnails import thumbnail_keys
+
+# Content addressed objects are stored under this prefix
+BLOB_PREFIX = 'blobs/'
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def new_blob_key(sha256):
+    """
+    Returns a key for new contents with this hash that no other upload
+    writes to, so they can be uploaded before their row is committed
+    """
+    return '{0}{1}/{2}'.format(BLOB_PREFIX, sha256, uuid4().hex)
+
+
+def hash_stream(stream):
+    """
+    Returns the SHA-256 hex digest of a seekable stream
+    and rewinds it so it can be uploaded afterwards
+    """
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(HASH_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+def acquire_blob(sha256):
+    """
+    Adds a reference to an existing blob, returns the blob
+    or None when no object with that hash is stored yet
+    """
+    updated = Blob.query.filter_by(sha256=sha256).update(
+        {Blob.refcount: Blob.refcount + 1}, synchronize_session=False)
+    if not updated:
+        return None
+    return Blob.query.get(sha256)
+
+
+def stored_hashes(hashes):
+    """
+    Returns which of `hashes` have a blob, without locking anything
+    """
+    return {sha256 for sha256, in db.session.query(Blob.sha256).filter(
+        Blob.sha256.in_(list(hashes)))}
+
+
+def claim_blob(sha256, key=None, metadata=None):
+    """
+    Adds a reference to the blob with this hash. When there is none
+    and the contents were uploaded to `key`, creates it from them.
+    Returns the blob, or None when there is none and nothing was
+    uploaded.
+    """
+    blob = acquire_blob(sha256)
+    if blob is not None or key is None:
+        return blob
+    try:
+        with db.session.begin_nested():
+            blob = Blob(sha256=sha256, key=key, refcount=1)
+            blob.set_metadata(metadata)
+            db.session.add(blob)
+    except IntegrityError:
+        # Another upload of the same content created it first
+        return acquire_blob(sha256)
+    return blob
+
+
+def claim_blobs(hashes, uploaded):
+    """
+    Adds one reference per item of `hashes` to the blob with that
+    hash, in a few statements whatever the number of hashes. Missing
+    blobs are created from `uploaded`, which maps hashes to the key
+    and metadata of contents uploaded for them. Returns `{hash: blob}`
+    without the hashes that have neither.
+    """
+    counts = Counter(hashes)
+    # Locked so `collect_blobs` can not delete them before the update
+    blobs = {blob.sha256: blob for blob in Blob.query.filter(
+        Blob.sha256.in_(list(counts))).with_for_update()}
+    by_count = defaultdict(list)
+    for sha256 in blobs:
+        by_count[counts[sha256]].append(sha256)
+    for count, group in by_count.items():
+        Blob.query.filter(Blob.sha256.in_(group)).update(
+            {Blob.refcount: Blob.refcount + count},
+            synchronize_session=False)
+    for blob in blobs.values():
+        db.session.expire(blob, ['refcount'])
+
+    missing = [sha256 for sha256 in counts
+               if sha256 not in blobs and sha256 in uploaded]
+    if not missing:
+        return blobs
+    try:
+        with db.session.begin_nested():
+            db.session.execute(Blob.__table__.insert(), [dict(
+                uploaded[sha256][1],
+                sha256=sha256,
+                key=uploaded[sha256][0],
+                refcount=counts[sha256],
+            ) for sha256 in missing])
+    except IntegrityError:
+        # Another upload created some of them first
+        for sha256 in missing:
+            blob = claim_blob(sha256, *uploaded[sha256])
+            if blob is None:
+                continue
+            if counts[sha256] > 1:
+                Blob.query.filter_by(sha256=sha256).update(
+                    {Blob.refcount: Blob.refcount + counts[sha256] - 1},
+                    synchronize_session=False)
+            blobs[sha256] = blob
+        return blobs
+    blobs.update((blob.sha256, blob) for blob in Blob.query.filter(
+        Blob.sha256.in_(missing)))
+    return blobs
+
+
+def store_blob(file, stream, content_type):
+    """
+    Points `file` at the blob holding the contents of `stream`.
+
+    The stream is hashed locally first, so content that is already
+    stored is never uploaded again. New content is uploaded to a key
+    of its own with no transaction open, and its row is added to the
+    transaction of the caller, who commits it. Returns the key
+    uploaded to, or None; the caller deletes that object when the
+    commit fails or `file.key` is not that key.
+    """
+    sha256 = hash_stream(stream)
+    key = metadata = None
+    while True:
+        blob = claim_blob(sha256, key, metadata)
+        if blob is not None:
+            break
+        # Ends the transaction of the failed claim before uploading
+        db.session.rollback()
+        key = new_blob_key(sha256)
+        metadata = storage.upload(key, stream, content_type)
+
+    file.blob = blob
+    file.key = blob.key
+    file.set_metadata(blob.to_metadata())
+    return key
+
+
+def release_blobs(counts):
+    """
+    Drops references to blobs, `counts` maps hashes to the
+    number of references to drop. Unreferenced blobs are
+    removed by `collect_blobs`.
+    """
+    for sha256, count in counts.items():
+        Blob.query.filter_by(sha256=sha256).update(
+            {Blob.refcount: Blob.refcount - count},
+            synchronize_session=False)
+
+
+def release_user_blobs(user_id):
+    """
+    Drops the references held by every file of a user
+    """
+    counts = db.session.query(File.blob_sha256, func.count(File.id)) \
+        .filter(File.user_id == user_id, File.blob_sha256.isnot(None)) \
+        .group_by(File.blob_sha256)
+    release_blobs(dict(counts))
+
+
+def collect_blobs(hashes=None, batch_size=1000):
+    """
+    Deletes unreferenced blobs and their objects, then commits.
+
+    The rows are deleted before the objects, so a concurrent upload
+    of the same content waits on the row lock and then stores a new
+    blob instead of pointing at an object that is being deleted.
+    Candidates are locked where the database supports it, and only
+    the objects of rows that were actually deleted are removed, a
+    blob acquired again since it was selected keeps its object.
+    Returns the number of objects deleted.
+    """
+    query = db.session.query(Blob.sha256, Blob.key) \
+        .filter(Blob.refcount <= 0)
+    if hashes is not None:
+        query = query.filter(Blob.sha256.in_(list(hashes)))
+
+    removed = 0
+    while True:
+        batch = dict(query.with_for_update().limit(batch_size))
+        if not batch:
+            break
+        Blob.query.filter(Blob.sha256.in_(list(batch)), Blob.refcount <= 0) \
+            .delete(synchronize_session=False)
+        for sha256, in db.session.query(Blob.sha256).filter(
+                Blob.sha256.in_(list(batch))):
+            del batch[sha256]
+        if not batch:
+            db.session.commit()
+            continue
+        keys = list(batch.values())
+        deleted, errors = storage.delete_many(keys)
+        if errors:
+            db.session.rollback()
+            raise RuntimeError('Could not delete blobs: {}'.format(errors))
+        db.session.commit()
+        removed += len(deleted)
+
+        # Thumbnails are derived from the blob key, missing ones are no-ops
+        sizes = current_app.config['THUMBNAIL_SIZES']
+        if sizes:
+            storage.delete_many([
+                thumbnail_key for key in keys
+                for thumbnail_key in thumbnail_keys(key, sizes)
+            ])
+    db.session.commit()
+    return removed
@@ -0,0 +1,73 @@
+import json
+import base64
+from sqlalchemy import and_, or_
+
+from app.models import File
+
+# Columns the file listing can be ordered by
+SORT_COLUMNS = {
+    'id': File.id,
+    'name': File.name,
+    'date': File.date,
+}
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(sort, row):
+    """
+    Encodes the sort value and id of the last row of a page
+    """
+    value = getattr(row, sort)
+    raw = json.dumps([value, row.id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        value, row_id = json.loads(base64.urlsafe_b64decode(
+            cursor.encode('ascii')).decode('utf-8'))
+    except (ValueError, TypeError):
+        raise InvalidCursor(cursor)
+    if not isinstance(row_id, int):
+        raise InvalidCursor(cursor)
+    return value, row_id
+
+
+def keyset_page(query, sort='id', order='desc', cursor=None, limit=50):
+    """
+    Returns one page of `query` and the cursor of the next page.
+
+    Rows are ordered by (sort column, id) and the page starts after
+    the row encoded in `cursor`, so each page is an index range scan
+    instead of an OFFSET over every earlier row.
+    """
+    column = SORT_COLUMNS[sort]
+    descending = order == 'desc'
+
+    if cursor:
+        value, row_id = decode_cursor(cursor)
+        if sort == 'id':
+            query = query.filter(
+                File.id < row_id if descending else File.id > row_id)
+        elif descending:
+            query = query.filter(or_(
+                column < value, and_(column == value, File.id < row_id)))
+        else:
+            query = query.filter(or_(
+                column > value, and_(column == value, File.id > row_id)))
+
+    if descending:
+        query = query.order_by(column.desc(), File.id.desc())
+    else:
+        query = query.order_by(column.asc(), File.id.asc())
+
+    # Fetch one extra row to know if there is a next page
+    rows = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(sort, rows[-1])
+    return rows, next_cursor
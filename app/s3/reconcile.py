@@ -0,0 +1,279 @@
+import json
+import heapq
+import queue
+import tempfile
+import threading
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+from app import db, storage
+from app.models import Blob, File
+from app.s3.blobs import BLOB_PREFIX
+from app.s3.thumbnails import THUMBNAIL_DIR, thumbnail_keys
+from app.storage import ObjectNotFound
+
+_DONE = object()
+
+
+def binary_order(column):
+    """
+    Compares keys by code point, the order S3 lists them in,
+    whatever the collation of the database
+    """
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        return column.collate('C')
+    if dialect == 'mysql':
+        return column.collate('utf8mb4_bin')
+    return column
+
+
+def is_derived(key):
+    """
+    Folder markers and thumbnails have no row of their own
+    """
+    return key.endswith('/') or '/{}/'.format(THUMBNAIL_DIR) in key
+
+
+def _list_into(backend, prefix, pages, stop):
+    try:
+        for page in backend.list_pages(prefix):
+            if not _put(pages, page, stop):
+                return
+    except Exception as err:
+        _put(pages, err, stop)
+        return
+    _put(pages, _DONE, stop)
+
+
+def _put(pages, item, stop):
+    # Gives up once the reader is gone, so no lister blocks forever
+    while not stop.is_set():
+        try:
+            pages.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _folder_keys(backend, folders, concurrency, prefetch):
+    stop = threading.Event()
+    window = deque()
+    folders = iter(folders)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        def start_next():
+            folder = next(folders, None)
+            if folder is not None:
+                pages = queue.Queue(prefetch)
+                pool.submit(_list_into, backend, folder, pages, stop)
+                window.append(pages)
+
+        try:
+            for _ in range(concurrency):
+                start_next()
+            while window:
+                pages = window.popleft()
+                start_next()
+                while True:
+                    page = pages.get()
+                    if page is _DONE:
+                        break
+                    if isinstance(page, Exception):
+                        raise page
+                    for key in page:
+                        yield key
+        finally:
+            stop.set()
+
+
+def stored_keys(backend, concurrency=8, prefetch=4):
+    """
+    Yields every key of the backend in lexicographic order.
+
+    The top level folders, one per user, are listed concurrently, up
+    to `concurrency` of them ahead of the one being read and each
+    holding at most `prefetch` pages, so memory stays bounded
+    however many keys there are. Folders never overlap, so reading
+    them one after the other keeps the keys in order.
+    """
+    folders, keys = backend.list_folders()
+    return heapq.merge(
+        _folder_keys(backend, folders, concurrency, prefetch), keys)
+
+
+def recorded_keys(batch_size=1000):
+    """
+    Yields the keys of every File and Blob row in lexicographic
+    order, streaming them from the database in batches
+    """
+    def stream(query, column):
+        query = query.order_by(binary_order(column)) \
+            .execution_options(stream_results=True).yield_per(batch_size)
+        return (key for key, in query)
+
+    # Files of content addressed uploads share their blob's key,
+    # blob keys are read from the Blob table instead
+    files = db.session.query(File.key).filter(
+        File.key.isnot(None), ~File.key.startswith(BLOB_PREFIX))
+    key = binary_order(File.key)
+    # One query at a time, some drivers can only stream one
+    return chain(
+        stream(files.filter(key < BLOB_PREFIX), File.key),
+        stream(db.session.query(Blob.key), Blob.key),
+        stream(files.filter(key > BLOB_PREFIX), File.key),
+    )
+
+
+def compare(stored, recorded):
+    """
+    Merge joins two ordered key streams. Yields `('orphan', key)` for
+    objects without a row and `('missing', key)` for rows without an
+    object.
+    """
+    stored_key = next(stored, None)
+    recorded_key = next(recorded, None)
+    while stored_key is not None or recorded_key is not None:
+        if recorded_key is None or \
+                (stored_key is not None and stored_key < recorded_key):
+            yield 'orphan', stored_key
+            stored_key = next(stored, None)
+        elif stored_key is None or recorded_key < stored_key:
+            yield 'missing', recorded_key
+            recorded_key = next(recorded, None)
+        else:
+            # Several rows may point at the same object
+            matched = stored_key
+            stored_key = next(stored, None)
+            while recorded_key == matched:
+                recorded_key = next(recorded, None)
+
+
+class Reconciler(object):
+    """
+    Finds objects without a File or Blob row and rows whose object is
+    gone, and with `repair` removes both.
+
+    The differences are spooled to a temporary file during the scan
+    and repaired in batches once it is done, so the streaming queries
+    are never interrupted by a commit. Uploads write the object before
+    committing the row, so orphans younger than `grace` seconds are
+    left alone, and every difference is checked again just before it
+    is repaired.
+    """
+    def __init__(self, repair=False, grace=3600, concurrency=8,
+                 batch_size=1000):
+        self.repair = repair
+        self.grace = timedelta(seconds=grace)
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.checked = 0
+        self.orphans = 0
+        self.missing = 0
+        self.deleted_objects = 0
+        self.deleted_rows = 0
+
+    def run(self, report=None):
+        backend = storage.backend
+
+        def counted(keys):
+            for key in keys:
+                if not is_derived(key):
+                    self.checked += 1
+                    yield key
+
+        with tempfile.TemporaryFile('w+') as found:
+            stored = counted(stored_keys(backend, self.concurrency))
+            for kind, key in compare(stored,
+                                     recorded_keys(self.batch_size)):
+                if report is not None:
+                    report(kind, key)
+                if kind == 'orphan':
+                    self.orphans += 1
+                else:
+                    self.missing += 1
+                if self.repair:
+                    found.write(json.dumps([kind, key]) + '\n')
+            db.session.rollback()
+
+            if not self.repair:
+                return
+            found.seek(0)
+            batches = {'orphan': [], 'missing': []}
+            for line in found:
+                kind, key = json.loads(line)
+                batches[kind].append(key)
+                if len(batches[kind]) >= self.batch_size:
+                    self.remove(backend, kind, batches[kind])
+                    batches[kind] = []
+            for kind, keys in batches.items():
+                self.remove(backend, kind, keys)
+
+    def remove(self, backend, kind, keys):
+        if not keys:
+            return
+        if kind == 'orphan':
+            self.remove_orphans(backend, keys)
+        else:
+            self.remove_missing(backend, keys)
+
+    def remove_orphans(self, backend, keys):
+        # Rows committed since the scan keep their objects
+        recorded = {key for key, in db.session.query(File.key)
+                    .filter(File.key.in_(keys))}
+        recorded.update(key for key, in db.session.query(Blob.key)
+                        .filter(Blob.key.in_(keys)))
+        db.session.rollback()
+
+        cutoff = datetime.now(timezone.utc) - self.grace
+        orphans = []
+        for key in keys:
+            if key in recorded:
+                continue
+            try:
+                if backend.last_modified(key) < cutoff:
+                    orphans.append(key)
+            except ObjectNotFound:
+                pass
+        if not orphans:
+            return
+
+        deleted, errors = backend.delete_many(orphans)
+        for key, err in errors.items():
+            current_app.logger.error('Could not delete %s: %s', key, err)
+        self.deleted_objects += len(deleted)
+        self._delete_thumbnails(backend, deleted)
+
+    def remove_missing(self, backend, keys):
+        missing = []
+        for key in keys:
+            try:
+                backend.last_modified(key)
+            except ObjectNotFound:
+                missing.append(key)
+        if not missing:
+            return
+
+        removed = File.query.filter(File.key.in_(missing)) \
+            .delete(synchronize_session=False)
+        blob_keys = [key for key in missing if key.startswith(BLOB_PREFIX)]
+        if blob_keys:
+            removed += Blob.query.filter(Blob.key.in_(blob_keys)) \
+                .delete(synchronize_session=False)
+        db.session.commit()
+        self.deleted_rows += removed
+        self._delete_thumbnails(backend, missing)
+
+    @staticmethod
+    def _delete_thumbnails(backend, keys):
+        sizes = current_app.config['THUMBNAIL_SIZES']
+        if sizes and keys:
+            backend.delete_many([
+                thumbnail_key for key in keys
+                for thumbnail_key in thumbnail_keys(key, sizes)
+            ])
@@ -1,25 +1,115 @@
 import re
 import os
-import boto3
-from botocore.exceptions import ClientError
-from flask import current_app, redirect, url_for, request, jsonify
+from uuid import uuid4
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app, redirect, url_for, request, jsonify, \
+                  Response, stream_with_context
 from flask_login import current_user
+from sqlalchemy.exc import IntegrityError
+from werkzeug.http import http_date
 from werkzeug.utils import secure_filename
 
-from app import db
+from app import db, presigned_urls, object_cache, storage
 from app.auth import bp
 from app.models import File
+from app.s3.archive import stream_zip
+from app.s3.blobs import store_blob, acquire_blob, release_blobs, \
+    collect_blobs, claim_blobs, stored_hashes, new_blob_key, hash_stream
+from app.s3.thumbnails import queue_thumbnails
+from app.s3.pagination import SORT_COLUMNS, InvalidCursor, keyset_page
+from app.storage import StorageError, ObjectNotFound, NotModified, \
+    InvalidRange
 from app.utils import login_required, allowed_file
 
-
-# S3 Instances
-s3 = boto3.resource('s3')
-s3_client = boto3.client('s3')
-
 # Form Validator for max file description length
 # Must be less than column size for File body in models.py
 MAX_FILE_DESC_LEN = 130
 
+FILE_EXISTS_MSG = 'You already have a file with that name. \
+                        File names must be unique'
+
+# Page sizes for the file listing
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# Most files added by one batch upload request
+MAX_BATCH_UPLOAD = 100
+# Most files removed by one batch delete request
+MAX_BATCH_DELETE = 10000
+# Bytes relayed at a time by the download proxy
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Most files in one ZIP download
+MAX_ZIP_FILES = 1000
+# Keeps IN clauses under SQLite's bound parameter limit
+ID_CHUNK_SIZE = 500
+
+
+def check_new_file(filename, file_text):
+    """
+    Returns why a file with this name and description can not be
+    added, without looking at the user's existing files
+    """
+    if len(file_text) > MAX_FILE_DESC_LEN:
+        return 'File description must be less than {} characters' \
+            .format(MAX_FILE_DESC_LEN)
+
+    if not allowed_file(filename):
+        return 'Invalid file type'
+
+    return None
+
+
+def validate_new_file(filename, file_text):
+    """
+    Returns an error response if the current user
+    can not add a file with this name and description
+    """
+    if File.name_exists(current_user.id, filename):
+        return jsonify({'msg': FILE_EXISTS_MSG}), 400
+
+    error = check_new_file(filename, file_text)
+    if error:
+        return jsonify({'msg': error}), 400
+
+    return None
+
+
+def new_file_key(folder, filename):
+    """
+    Returns a key for a new upload that no other upload writes to
+    """
+    return '{0}/{1}/{2}'.format(folder, uuid4().hex, filename)
+
+
+def discard_objects(keys):
+    """
+    Deletes objects uploaded for rows that were not committed.
+    Failures are only logged, `flask files reconcile` removes
+    what is left.
+    """
+    keys = [key for key in keys if key]
+    if not keys:
+        return
+    try:
+        _, errors = storage.delete_many(keys)
+    except StorageError as err:
+        errors = {key: err for key in keys}
+    for key, err in errors.items():
+        current_app.logger.warning('Could not delete %s: %s', key, err)
+
+
+def remove_unreferenced_blobs(hashes):
+    """
+    Deletes blobs that lost their last reference. Failures are
+    only logged, the blobs are collected by a later purge.
+    """
+    try:
+        collect_blobs(hashes)
+    except (RuntimeError, StorageError) as err:
+        current_app.logger.warning('Could not remove blobs: %s', err)
+
 
 @bp.route('/')
 @login_required
@@ -37,6 +127,9 @@ def files():
     Uploads a new file if the filename does not exist
     in the current users filenames.
 
+    Lists the current users files one page at a time,
+    ordered by `sort` (id, name or date) and `order`.
+    Pass the returned `next` cursor to get the next page.
     """
     if request.method == 'POST':
         try:
@@ -51,41 +144,304 @@ def files():
 
         # Must secure filename before checking if it already exists
         filename = secure_filename(file.filename)
-        file_names = [file.name for file in current_user.files]
-
-        if filename in file_names:
-            return jsonify({
-                'msg': 'You already have a file with that name. \
-                        File names must be unique'
-            }), 400
-
-        if len(file_text) > MAX_FILE_DESC_LEN:
-            return jsonify({
-                'msg': 'File description must be less than {} characters'
-                       .format(MAX_FILE_DESC_LEN)
-            }), 400
-
-        if not allowed_file(file.filename):
-            return jsonify({'msg': 'Invalid file type'}), 400
+        error = validate_new_file(filename, file_text)
+        if error:
+            return error
 
-        key_str = "{0}/{1}".format(current_user.username, filename)
-        s3.Bucket(current_app.config['S3_BUCKET']).put_object(
-            Key=key_str,
-            Body=request.files['file'].stream.read()
-        )
-        # Add a new file
+        content_addressed = current_app.config['S3_CONTENT_ADDRESSED']
+        user_id, folder = current_user.id, current_user.folder
         new_file = File(name=filename, body=file_text, date=file_date,
-                        key=key_str, author=current_user)
+                        user_id=user_id)
+
+        # The object is uploaded with no transaction open, to a key no
+        # other upload uses, and the row is committed after it. A
+        # concurrent upload of the same name fails on the unique
+        # (user_id, name) index and its object is deleted again.
+        uploaded = None
+        try:
+            if content_addressed:
+                uploaded = store_blob(new_file, file.stream, file.mimetype)
+            else:
+                db.session.rollback()
+                uploaded = new_file.key = new_file_key(folder, filename)
+                new_file.set_metadata(
+                    storage.upload(uploaded, file.stream, file.mimetype))
+        except StorageError as err:
+            db.session.rollback()
+            current_app.logger.error('Upload failed for %s: %s',
+                                     filename, err)
+            return jsonify({'msg': 'Upload failed, please try again'}), 500
+
+        # Contents another upload stored first are not needed
+        unused = uploaded if uploaded != new_file.key else None
         db.session.add(new_file)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            discard_objects([uploaded])
+            return jsonify({'msg': FILE_EXISTS_MSG}), 400
+        discard_objects([unused])
+
+        queue_thumbnails(new_file)
         db.session.commit()
 
         return jsonify({'msg': 'Uploaded {0}'.format(filename)})
 
-    user_files = [{'name': file.name, 'body': file.body, "id": file.id}
-                  for file in current_user.files]
-    user_files.reverse()
+    sort = request.args.get('sort', 'id')
+    order = request.args.get('order', 'desc')
+    if sort not in SORT_COLUMNS or order not in ('asc', 'desc'):
+        return jsonify({'msg': 'Invalid sort order'}), 400
+
+    try:
+        limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        return jsonify({'msg': 'Invalid limit'}), 400
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    try:
+        page, next_cursor = keyset_page(
+            current_user.files, sort, order,
+            request.args.get('cursor'), limit)
+    except InvalidCursor:
+        return jsonify({'msg': 'Invalid cursor'}), 400
+
+    user_files = [{'name': file.name, 'body': file.body,
+                   'date': file.date, "id": file.id,
+                   'thumbnails': file.thumbnails or {}}
+                  for file in page]
+
+    return jsonify({'files': user_files, 'next': next_cursor})
+
+
+def insert_files(user_id, values):
+    """
+    Inserts the File rows of a batch upload with one statement,
+    `values` maps indexes to the columns of their row. Returns the
+    indexes whose name a concurrent upload took since they were
+    checked, those rows are not inserted.
+    """
+    taken = []
+    indexes = list(values)
+    while indexes:
+        try:
+            with db.session.begin_nested():
+                db.session.execute(File.__table__.insert(),
+                                   [values[index] for index in indexes])
+            return taken
+        except IntegrityError:
+            existing = {name for name, in db.session.query(File.name).filter(
+                File.user_id == user_id,
+                File.name.in_([values[index]['name'] for index in indexes]))}
+            if not existing:
+                raise
+            taken.extend(index for index in indexes
+                         if values[index]['name'] in existing)
+            indexes = [index for index in indexes
+                       if values[index]['name'] not in existing]
+    return taken
+
+
+@bp.route('/files/batch', methods=['POST'])
+@login_required
+def upload_files():
+    """
+    Uploads every file in the `file` list of one multipart request.
+
+    `text` is either one description for every file or one per file.
+    All files are validated before anything is uploaded, the objects
+    are uploaded `UPLOAD_CONCURRENCY` at a time with no transaction
+    open and the File rows are then committed in one transaction.
+    Reports the result for each file.
+    """
+    uploads = request.files.getlist('file')
+    texts = request.form.getlist('text')
+    file_date = request.form.get('date')
+    if not uploads or file_date is None:
+        return jsonify({'msg': 'Missing part of your form'}), 400
+
+    if len(uploads) > MAX_BATCH_UPLOAD:
+        return jsonify({
+            'msg': 'You can upload at most {} files at once'
+                   .format(MAX_BATCH_UPLOAD)
+        }), 400
+
+    if len(texts) == 1:
+        texts = texts * len(uploads)
+    elif len(texts) != len(uploads):
+        return jsonify({'msg': 'Send one description or one per file'}), 400
+
+    names = [secure_filename(upload.filename) for upload in uploads]
+    existing = set()
+    for start in range(0, len(names), ID_CHUNK_SIZE):
+        existing.update(name for name, in db.session.query(File.name).filter(
+            File.user_id == current_user.id,
+            File.name.in_(names[start:start + ID_CHUNK_SIZE])))
+
+    results = [{'name': name} for name in names]
+    accepted = []
+    for index, (name, text) in enumerate(zip(names, texts)):
+        if name == '':
+            error = 'missing file name'
+        elif name in existing:
+            error = FILE_EXISTS_MSG
+        else:
+            error = check_new_file(name, text)
+        if error:
+            results[index].update(uploaded=False, msg=error)
+            continue
+        # Later files with the same name in this batch are duplicates
+        existing.add(name)
+        accepted.append(index)
+
+    content_addressed = current_app.config['S3_CONTENT_ADDRESSED']
+    user_id, folder = current_user.id, current_user.folder
+    backend = storage.backend
+    # Keys uploaded to, by index or for content addressing by hash
+    keys = {}
+    with ThreadPoolExecutor(
+            max_workers=current_app.config['UPLOAD_CONCURRENCY']) as pool:
+        if content_addressed:
+            hashes = dict(zip(accepted, pool.map(
+                hash_stream, [uploads[index].stream for index in accepted])))
+            known = stored_hashes(set(hashes.values())) if hashes else set()
+
+        # As in `files`, the objects are uploaded with no transaction
+        # open to keys no other upload uses, then the rows are inserted.
+        # Only new content is uploaded, once for duplicates in the batch.
+        db.session.rollback()
+        futures = {}
+        for index in accepted:
+            if content_addressed:
+                sha256 = hashes[index]
+                if sha256 in known or sha256 in keys:
+                    continue
+                key = keys[sha256] = new_blob_key(sha256)
+            else:
+                key = keys[index] = new_file_key(folder, names[index])
+            upload = uploads[index]
+            futures[key] = pool.submit(backend.upload, key, upload.stream,
+                                       upload.mimetype)
+
+        stored = {}
+        for key, future in futures.items():
+            try:
+                stored[key] = future.result()
+            except StorageError as err:
+                current_app.logger.error('Upload of %s failed: %s', key, err)
+
+    blobs = {}
+    if content_addressed and accepted:
+        blobs = claim_blobs(
+            [hashes[index] for index in accepted],
+            {sha256: (key, stored[key]) for sha256, key in keys.items()
+             if key in stored})
+
+    values = {}
+    for index in accepted:
+        sha256 = None
+        if content_addressed:
+            sha256 = hashes[index]
+            blob = blobs.get(sha256)
+            key = blob and blob.key
+            metadata = blob and blob.to_metadata()
+        else:
+            key = keys[index]
+            metadata = stored.get(key)
+        if metadata is None:
+            results[index].update(uploaded=False,
+                                  msg='Upload failed, please try again')
+            continue
+        values[index] = dict(metadata, name=names[index], body=texts[index],
+                             date=file_date, user_id=user_id, key=key,
+                             blob_sha256=sha256)
+
+    taken = insert_files(user_id, values)
+    for index in taken:
+        results[index].update(uploaded=False, msg=FILE_EXISTS_MSG)
+        del values[index]
+    if content_addressed and taken:
+        release_blobs(Counter(hashes[index] for index in taken))
+
+    # Objects stored for rows that are not committed
+    if content_addressed:
+        unused = [key for sha256, key in keys.items()
+                  if key in stored and (sha256 not in blobs or
+                                        blobs[sha256].key != key)]
+    else:
+        unused = [key for index, key in keys.items()
+                  if key in stored and index not in values]
+    db.session.commit()
+    discard_objects(unused)
+    if content_addressed and taken:
+        remove_unreferenced_blobs({hashes[index] for index in taken})
+
+    if values:
+        rows = {row.name: row for row in File.query.filter(
+            File.user_id == user_id,
+            File.name.in_([names[index] for index in values]))}
+        for index in values:
+            row = rows[names[index]]
+            queue_thumbnails(row)
+            results[index].update(uploaded=True, id=row.id)
+    db.session.commit()
+
+    return jsonify({'files': results})
+
+
+@bp.route('/files/instant', methods=['POST'])
+@login_required
+def instant_upload():
+    """
+    Adds a file whose contents are already stored, given the
+    SHA-256 `hash` of the contents, without transferring them.
+
+    Responds with 404 when no stored object has that hash and
+    the file must be uploaded to `/files` instead.
+    """
+    if not current_app.config['S3_CONTENT_ADDRESSED']:
+        return jsonify({'msg': 'Instant uploads are not enabled'}), 404
+
+    try:
+        file_text = request.form['text']
+        filename = secure_filename(request.form['name'])
+        file_date = request.form['date']
+        sha256 = request.form['hash'].lower()
+    except KeyError:
+        return jsonify({'msg': 'Missing part of your form'}), 400
+
+    if filename == '':
+        return jsonify({'msg': 'missing file name'}), 400
+
+    if not re.match(r'^[0-9a-f]{64}$', sha256):
+        return jsonify({'msg': 'Invalid file hash'}), 400
+
+    error = validate_new_file(filename, file_text)
+    if error:
+        return error
+
+    new_file = File(name=filename, body=file_text, date=file_date,
+                    author=current_user)
+    db.session.add(new_file)
+    try:
+        db.session.flush()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'msg': FILE_EXISTS_MSG}), 400
+
+    blob = acquire_blob(sha256)
+    if blob is None:
+        db.session.rollback()
+        return jsonify({'msg': 'Unknown file hash, upload the file'}), 404
+
+    new_file.blob = blob
+    new_file.key = blob.key
+    new_file.set_metadata(blob.to_metadata())
+    db.session.commit()
+    queue_thumbnails(new_file)
+    db.session.commit()
 
-    return jsonify({'files': user_files})
+    return jsonify({'msg': 'Uploaded {0}'.format(filename)})
 
 
 @bp.route('/files/<file_id>')
@@ -95,31 +451,159 @@ def file(file_id):
     if not file:
         return jsonify({'msg': 'File does not exist'})
 
-    try:
-        res_object = s3_client.get_object(
-            Bucket=current_app.config['S3_BUCKET'],
-            Key=file.key
-        )
-    except ClientError:
-        return jsonify({'msg': 'File not in your folder'})
-
-    url = s3_client.generate_presigned_url(
-        ClientMethod='get_object',
-        Params={
-            'Bucket': current_app.config['S3_BUCKET'],
-            'Key': file.key,
-        }
-    )
+    # Files uploaded before metadata was stored are backfilled on first view
+    if file.size is None:
+        try:
+            file.set_metadata(storage.head(file.key))
+        except ObjectNotFound:
+            return jsonify({'msg': 'File not in your folder'})
+        except StorageError as err:
+            # Served without the metadata, the next view tries again
+            current_app.logger.warning('Could not backfill %s: %s',
+                                       file.key, err)
+        else:
+            db.session.commit()
+
+    url = presigned_urls.get_url(storage.backend, file.key)
     file_dict = {
         'url': url,
         'body': file.body,
         'date': file.date,
-        'size': res_object['ResponseMetadata']['HTTPHeaders']['content-length'],
+        'size': file.size,
+        'content_type': file.content_type,
+        'thumbnails': file.thumbnails or {},
     }
 
     return jsonify({'file': file_dict})
 
 
+def cached_download(file, data):
+    """
+    Answers a download from a memory mapped cache entry
+    """
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'Content-Disposition': 'attachment; filename={}'.format(file.name),
+        'ETag': '"{}"'.format(file.etag),
+    }
+    if request.if_none_match.contains(file.etag):
+        data.close()
+        return Response(status=304, headers=headers)
+
+    size = len(data)
+    start, stop, status = 0, size, 200
+    # Multiple ranges are answered with the whole object
+    if request.range and len(request.range.ranges) == 1:
+        bounds = request.range.range_for_length(size)
+        if bounds is None:
+            data.close()
+            return Response(status=416, headers={
+                'Content-Range': 'bytes */{}'.format(size)})
+        start, stop = bounds
+        status = 206
+        headers['Content-Range'] = request.range.to_content_range_header(size)
+    headers['Content-Length'] = str(stop - start)
+
+    def generate():
+        try:
+            for offset in range(start, stop, DOWNLOAD_CHUNK_SIZE):
+                yield data[offset:min(offset + DOWNLOAD_CHUNK_SIZE, stop)]
+        finally:
+            data.close()
+
+    return Response(
+        generate(),
+        status=status,
+        headers=headers,
+        mimetype=file.content_type or 'application/octet-stream',
+        direct_passthrough=True
+    )
+
+
+def stored_metadata(backend, file):
+    """
+    Returns the size and ETag of a file's object, asking storage
+    when the row was written before they were recorded
+    """
+    metadata = {'size': file.size, 'etag': file.etag}
+    if file.size is None or file.etag is None:
+        try:
+            metadata = backend.head(file.key)
+        except StorageError:
+            pass
+    return metadata
+
+
+@bp.route('/files/<file_id>/download')
+@login_required
+def download_file(file_id):
+    """
+    Streams a file through the API for clients that can not
+    follow presigned URLs.
+
+    `Range` and `If-None-Match` are passed through to storage and
+    answered with 206 and 304, the body is relayed in chunks.
+    Hot objects are served from the local disk cache instead,
+    which a full download of an uncached object fills.
+    """
+    file = current_user.files.filter_by(id=file_id).first()
+    if not file:
+        return jsonify({'msg': 'File does not exist'}), 404
+
+    backend = storage.backend
+    # A ranged read of an uncached object is served from storage
+    # rather than waiting for the whole object to be cached
+    cached = object_cache.open(backend, file.key, file.etag, file.size,
+                               fill='Range' not in request.headers)
+    if cached is not None:
+        return cached_download(file, cached)
+
+    try:
+        obj = backend.open(file.key,
+                           range=request.headers.get('Range'),
+                           if_none_match=request.headers.get('If-None-Match'))
+    except NotModified:
+        etag = stored_metadata(backend, file)['etag']
+        return Response(status=304, headers={
+            'ETag': '"{}"'.format(etag)} if etag else {})
+    except InvalidRange:
+        size = stored_metadata(backend, file)['size']
+        return Response(status=416, headers={
+            'Content-Range': 'bytes */{}'.format(size)
+        } if size is not None else {})
+    except StorageError:
+        return jsonify({'msg': 'File not in your folder'}), 404
+
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'Content-Length': str(obj.size),
+        'Content-Disposition': 'attachment; filename={}'.format(file.name),
+        'ETag': '"{}"'.format(obj.etag),
+        'Last-Modified': http_date(obj.last_modified),
+    }
+    status = 200
+    if obj.content_range:
+        headers['Content-Range'] = obj.content_range
+        status = 206
+
+    body = obj.body
+
+    def generate():
+        try:
+            for chunk in body.iter_chunks(DOWNLOAD_CHUNK_SIZE):
+                yield chunk
+        finally:
+            body.close()
+
+    return Response(
+        generate(),
+        status=status,
+        headers=headers,
+        mimetype=obj.content_type or 'application/octet-stream',
+        direct_passthrough=True
+    )
+
+
 @bp.route('/files/<file_id>/edit', methods=['PATCH'])
 @login_required
 def edit_file(file_id):
@@ -141,6 +625,7 @@ def edit_file(file_id):
 
         file.body = file_text
         db.session.commit()
+        presigned_urls.invalidate(storage.backend, file.key)
         return jsonify({'msg': 'File edited!'})
 
     return jsonify({'err': 'You can not do that'})
@@ -153,12 +638,137 @@ def delete_file(file_id):
     if not file:
         return jsonify({'msg': 'File does not exist'})
 
+    key = file.key
+    blob_sha256 = file.blob_sha256
+    thumbnails = list((file.thumbnails or {}).values())
+
+    if blob_sha256:
+        release_blobs({blob_sha256: 1})
     db.session.delete(file)
     db.session.commit()
 
-    res_object = s3_client.delete_object(
-        Bucket=current_app.config['S3_BUCKET'],
-        Key=file.key
-    )
+    if blob_sha256:
+        remove_unreferenced_blobs([blob_sha256])
+    elif thumbnails:
+        storage.delete_many([key] + thumbnails)
+    else:
+        storage.delete(key)
+    presigned_urls.invalidate(storage.backend, key)
 
     return jsonify({'msg': 'File removed'})
+
+
+@bp.route('/files/delete', methods=['DELETE'])
+@login_required
+def delete_files():
+    """
+    Deletes every file in the `id` form list.
+
+    Objects are removed with batched delete requests,
+    then the rows of the deleted objects are removed in one
+    transaction. Reports the result for each id.
+    """
+    try:
+        file_ids = [int(file_id) for file_id in request.form.getlist('id')]
+    except ValueError:
+        return jsonify({'err': 'File ids must be integers'}), 400
+
+    if not file_ids:
+        return jsonify({'err': 'Missing part of your form'}), 400
+
+    if len(file_ids) > MAX_BATCH_DELETE:
+        return jsonify({
+            'err': 'You can delete at most {} files at once'
+                   .format(MAX_BATCH_DELETE)
+        }), 400
+
+    keys_by_id = {}
+    blobs_by_id = {}
+    thumbnails = []
+    for start in range(0, len(file_ids), ID_CHUNK_SIZE):
+        chunk = file_ids[start:start + ID_CHUNK_SIZE]
+        rows = db.session.query(
+            File.id, File.key, File.blob_sha256, File.thumbnails).filter(
+                File.user_id == current_user.id, File.id.in_(chunk))
+        for file_id, key, blob_sha256, file_thumbnails in rows:
+            keys_by_id[file_id] = key
+            if blob_sha256:
+                blobs_by_id[file_id] = blob_sha256
+            elif file_thumbnails:
+                thumbnails.extend(file_thumbnails.values())
+
+    # Content addressed objects are shared, only their references go
+    deleted, errors = storage.delete_many(
+        list({key for file_id, key in keys_by_id.items()
+              if file_id not in blobs_by_id}) + thumbnails)
+
+    deleted_keys = set(deleted)
+    deleted_ids = [file_id for file_id, key in keys_by_id.items()
+                   if key in deleted_keys or file_id in blobs_by_id]
+    for start in range(0, len(deleted_ids), ID_CHUNK_SIZE):
+        File.query.filter(
+            File.id.in_(deleted_ids[start:start + ID_CHUNK_SIZE])
+        ).delete(synchronize_session=False)
+    release_blobs(Counter(blobs_by_id.values()))
+    db.session.commit()
+
+    if blobs_by_id:
+        remove_unreferenced_blobs(set(blobs_by_id.values()))
+
+    results = []
+    for file_id in file_ids:
+        key = keys_by_id.get(file_id)
+        if not key:
+            results.append({'id': file_id, 'deleted': False,
+                            'msg': 'File does not exist'})
+        elif key in errors and file_id not in blobs_by_id:
+            results.append({'id': file_id, 'deleted': False,
+                            'msg': errors[key]})
+        else:
+            presigned_urls.invalidate(storage.backend, key)
+            results.append({'id': file_id, 'deleted': True})
+
+    return jsonify({'files': results})
+
+
+@bp.route('/files/zip', methods=['GET', 'POST'])
+@login_required
+def zip_files():
+    """
+    Streams a ZIP archive of every file in the `id` list
+    """
+    try:
+        file_ids = [int(file_id) for file_id in request.values.getlist('id')]
+    except ValueError:
+        return jsonify({'err': 'File ids must be integers'}), 400
+
+    if not file_ids:
+        return jsonify({'err': 'Missing part of your form'}), 400
+
+    if len(file_ids) > MAX_ZIP_FILES:
+        return jsonify({
+            'err': 'You can download at most {} files at once'
+                   .format(MAX_ZIP_FILES)
+        }), 400
+
+    entries = {}
+    for start in range(0, len(file_ids), ID_CHUNK_SIZE):
+        chunk = file_ids[start:start + ID_CHUNK_SIZE]
+        for file_id, name, key in db.session.query(
+                File.id, File.name, File.key).filter(
+                    File.user_id == current_user.id, File.id.in_(chunk)):
+            entries[file_id] = (name, key)
+
+    if not entries:
+        return jsonify({'msg': 'File does not exist'}), 404
+
+    # Keep the order the files were asked for
+    files = [entries[file_id] for file_id in dict.fromkeys(file_ids)
+             if file_id in entries]
+    archive = stream_zip(storage.backend, files,
+                         current_app.config['ZIP_PREFETCH'])
+    return Response(
+        stream_with_context(archive),
+        mimetype='application/zip',
+        headers={'Content-Disposition': 'attachment; filename=files.zip'}
+    )
@@ -0,0 +1,145 @@
+import os
+import multiprocessing
+from io import BytesIO
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from flask import current_app
+
+from app import db, storage
+from app.models import File
+
+IMAGE_EXTENSIONS = set(['png', 'jpg', 'jpeg', 'gif'])
+THUMBNAIL_DIR = '.thumbs'
+
+# Per-process state, rebuilt after a fork
+_pool = None
+_pool_pid = None
+
+
+def is_image(name):
+    return os.path.splitext(name)[1][1:].lower() in IMAGE_EXTENSIONS
+
+
+def thumbnail_key(key, size):
+    """
+    Derives the key of a thumbnail from the original key,
+    `user/photo.png` becomes `user/.thumbs/256/photo.png.jpg`
+    """
+    folder, _, name = key.rpartition('/')
+    return '{0}/{1}/{2}/{3}.jpg'.format(folder, THUMBNAIL_DIR, size, name)
+
+
+def thumbnail_keys(key, sizes):
+    return [thumbnail_key(key, size) for size in sizes]
+
+
+def render_thumbnails(backend, key, sizes, quality=85):
+    """
+    Downloads an image, writes a JPEG thumbnail for each size
+    and returns the thumbnail keys by size.
+
+    Runs in a worker process, the storage backend is sent over
+    without its client and builds one of its own there.
+    """
+    from PIL import Image
+
+    obj = backend.open(key)
+    try:
+        body = obj.body.read()
+    finally:
+        obj.body.close()
+    image = Image.open(BytesIO(body))
+    image.load()
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    thumbnails = {}
+    for size in sorted(sizes, reverse=True):
+        # Shrink the previous, larger thumbnail instead of the original
+        image.thumbnail((size, size))
+        output = BytesIO()
+        image.save(output, 'JPEG', quality=quality, optimize=True)
+        thumbnails[str(size)] = thumbnail_key(key, size)
+        backend.put(thumbnails[str(size)], output.getvalue(), 'image/jpeg')
+    return thumbnails
+
+
+def get_pool():
+    """
+    Returns this process's thumbnail pool.
+
+    Workers are spawned rather than forked, so they never inherit
+    locks or sockets held by the threads of a web worker.
+    """
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        _pool = ProcessPoolExecutor(
+            max_workers=current_app.config['THUMBNAIL_WORKERS'],
+            mp_context=multiprocessing.get_context('spawn')
+        )
+        _pool_pid = os.getpid()
+    return _pool
+
+
+def save_thumbnails(app, file_id, future):
+    """
+    Records the keys of rendered thumbnails on the File row.
+
+    Runs on a thread of the pool, which has no request, so it
+    pushes an app context and always hands back its session.
+    """
+    with app.app_context():
+        try:
+            thumbnails = future.result()
+        except Exception as err:
+            app.logger.warning('Thumbnails for file %s failed: %s',
+                               file_id, err)
+            return
+        try:
+            File.query.filter_by(id=file_id).update(
+                {'thumbnails': thumbnails}, synchronize_session=False)
+            db.session.commit()
+        except Exception as err:
+            app.logger.error('Saving thumbnails for file %s failed: %s',
+                             file_id, err)
+            db.session.rollback()
+        finally:
+            db.session.remove()
+
+
+def queue_thumbnails(file):
+    """
+    Generates thumbnails for a committed image upload.
+
+    The work runs in a process pool and the keys are recorded on
+    the File row when it is done. With `THUMBNAIL_WORKERS` set to
+    0 the thumbnails are rendered in the request, for tests.
+    """
+    config = current_app.config
+    if not config['THUMBNAIL_SIZES'] or not is_image(file.name):
+        return
+    if file.size and file.size > config['THUMBNAIL_MAX_SOURCE_SIZE']:
+        return
+
+    # Content addressed files share the thumbnails of their blob
+    if file.blob_sha256:
+        sibling = File.query.filter(
+            File.blob_sha256 == file.blob_sha256,
+            File.thumbnails.isnot(None)
+        ).first()
+        if sibling:
+            File.query.filter_by(id=file.id).update(
+                {'thumbnails': sibling.thumbnails}, synchronize_session=False)
+            return
+
+    args = (storage.backend, file.key, config['THUMBNAIL_SIZES'])
+    app = current_app._get_current_object()
+    if config['THUMBNAIL_WORKERS'] == 0:
+        try:
+            file.thumbnails = render_thumbnails(*args)
+        except Exception as err:
+            current_app.logger.warning('Thumbnails for %s failed: %s',
+                                       file.key, err)
+        return
+    future = get_pool().submit(render_thumbnails, *args)
+    future.add_done_callback(partial(save_thumbnails, app, file.id))
@@ -0,0 +1,68 @@
+from flask import current_app, abort, send_file, request
+
+from app.storage.base import StorageError, ObjectNotFound, NotModified, \
+    InvalidRange, PreconditionFailed, StoredObject
+
+
+def make_backend(config):
+    """
+    Builds the backend named by `STORAGE_BACKEND` from an app config
+    """
+    name = config['STORAGE_BACKEND']
+    if name == 's3':
+        from app.storage.s3 import S3Backend
+        return S3Backend.from_config(config)
+    if name == 'local':
+        from app.storage.local import LocalBackend
+        return LocalBackend.from_config(config)
+    raise ValueError('Unknown storage backend {!r}'.format(name))
+
+
+class Storage(object):
+    """
+    Object storage used by the app.
+
+    The backend is built from the app config the first time it is
+    used and shared by every thread of the process. Attribute access
+    is forwarded to it, so `storage.head(key)` calls the backend.
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['storage'] = None
+        # Target of the presigned URLs handed out by the local backend
+        app.add_url_rule('/storage/<path:key>', 'local_object',
+                         local_object)
+
+    @property
+    def backend(self):
+        backend = current_app.extensions.get('storage')
+        if backend is None:
+            backend = make_backend(current_app.config)
+            current_app.extensions['storage'] = backend
+        return backend
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name == 'backend':
+            raise AttributeError(name)
+        return getattr(self.backend, name)
+
+
+def local_object(key):
+    """
+    Serves an object of the local backend to a presigned URL
+    """
+    from app.storage.local import LocalBackend
+
+    backend = current_app.extensions.get('storage')
+    if not isinstance(backend, LocalBackend) or \
+            not backend.verify(key, request.args.get('token')):
+        abort(404)
+    try:
+        meta = backend.head(key)
+    except ObjectNotFound:
+        abort(404)
+    return send_file(backend.path(key), mimetype=meta['content_type'],
+                     conditional=True)
@@ -0,0 +1,48 @@
+class StorageError(Exception):
+    """
+    Raised by a storage backend when a request fails
+    """
+    pass
+
+
+class ObjectNotFound(StorageError):
+    pass
+
+
+class NotModified(StorageError):
+    """
+    The object still has the ETag given in `If-None-Match`
+    """
+    pass
+
+
+class InvalidRange(StorageError):
+    """
+    The requested range starts past the end of the object
+    """
+    pass
+
+
+class PreconditionFailed(StorageError):
+    """
+    The object no longer has the ETag given in `If-Match`
+    """
+    pass
+
+
+class StoredObject(object):
+    """
+    An object opened for reading.
+
+    `body` has `read`, `iter_chunks` and `close` like the streaming
+    body of boto3, `size` is the length of the returned bytes and
+    `content_range` is set when only a range was returned.
+    """
+    def __init__(self, body, size, etag, content_type=None,
+                 last_modified=None, content_range=None):
+        self.body = body
+        self.size = size
+        self.etag = etag
+        self.content_type = content_type
+        self.last_modified = last_modified
+        self.content_range = content_range
@@ -0,0 +1,291 @@
+import os
+import json
+import hashlib
+import mimetypes
+import tempfile
+from datetime import datetime, timezone
+from time import time
+
+from flask import url_for
+from itsdangerous import URLSafeSerializer, BadSignature
+from werkzeug.http import parse_range_header, unquote_etag
+
+from app.metrics import timed
+from app.storage.base import StorageError, ObjectNotFound, NotModified, \
+    InvalidRange, PreconditionFailed, StoredObject
+
+# Object metadata is kept next to the objects in this directory
+META_DIR = '.meta'
+COPY_CHUNK_SIZE = 1024 * 1024
+LIST_PAGE_SIZE = 1000
+
+
+class FileBody(object):
+    """
+    Reads `length` bytes of an open file, like a boto3 streaming body
+    """
+    def __init__(self, f, length):
+        self._f = f
+        self._remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._f.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def iter_chunks(self, chunk_size=COPY_CHUNK_SIZE):
+        while True:
+            data = self.read(chunk_size)
+            if not data:
+                break
+            yield data
+
+    def close(self):
+        self._f.close()
+
+
+class LocalBackend(object):
+    """
+    Stores objects as files under a local directory.
+
+    Keys map to paths below `root` and ETags are MD5 digests, as for
+    single part S3 uploads. Meant for development, tests and
+    benchmarks, presigned URLs point at the app itself.
+    """
+    def __init__(self, root, secret_key='local'):
+        self.root = os.path.abspath(root)
+        self.name = 'file://' + self.root
+        self.secret_key = secret_key
+        os.makedirs(os.path.join(self.root, META_DIR), exist_ok=True)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['LOCAL_STORAGE_ROOT'], config['SECRET_KEY'])
+
+    def path(self, key, meta=False):
+        parts = [part for part in key.split('/') if part]
+        if not parts or '..' in parts or parts[0] == META_DIR:
+            raise StorageError('Invalid key {!r}'.format(key))
+        if meta:
+            parts = [META_DIR] + parts[:-1] + [parts[-1] + '.json']
+        return os.path.join(self.root, *parts)
+
+    def _write_meta(self, key, meta):
+        path = self.path(key, meta=True)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(meta, f)
+
+    def _store(self, key, chunks, content_type):
+        if key.endswith('/'):
+            # Folder markers are plain directories
+            os.makedirs(self.path(key), exist_ok=True)
+            return {'size': 0, 'etag': hashlib.md5().hexdigest(),
+                    'content_type': content_type}
+
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        digest = hashlib.md5()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp',
+                                        dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+        meta = {
+            'size': size,
+            'etag': digest.hexdigest(),
+            'content_type': content_type or
+            mimetypes.guess_type(key)[0] or 'binary/octet-stream',
+        }
+        self._write_meta(key, meta)
+        return meta
+
+    @timed('storage')
+    def upload(self, key, stream, content_type=None):
+        try:
+            return self._store(
+                key, iter(lambda: stream.read(COPY_CHUNK_SIZE), b''),
+                content_type)
+        except (IOError, OSError) as err:
+            raise StorageError(str(err))
+
+    @timed('storage')
+    def put(self, key, data, content_type=None):
+        try:
+            self._store(key, [data], content_type)
+        except (IOError, OSError) as err:
+            raise StorageError(str(err))
+
+    @timed('storage')
+    def head(self, key):
+        try:
+            with open(self.path(key, meta=True)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            raise ObjectNotFound(key)
+
+    @timed('storage')
+    def open(self, key, range=None, if_none_match=None, if_match=None):
+        meta = self.head(key)
+        etag = meta['etag']
+        if if_match and unquote_etag(if_match)[0] != etag:
+            raise PreconditionFailed(key)
+        if if_none_match and unquote_etag(if_none_match)[0] == etag:
+            raise NotModified(key)
+
+        size = meta['size']
+        start, stop, content_range = 0, size, None
+        # Like S3, an unparsable or multi-part range returns everything
+        ranges = parse_range_header(range) if range else None
+        if ranges and len(ranges.ranges) == 1:
+            bounds = ranges.range_for_length(size)
+            if bounds is None:
+                raise InvalidRange(key)
+            start, stop = bounds
+            content_range = ranges.to_content_range_header(size)
+
+        path = self.path(key)
+        try:
+            f = open(path, 'rb')
+        except (IOError, OSError):
+            raise ObjectNotFound(key)
+        f.seek(start)
+        modified = datetime.fromtimestamp(os.fstat(f.fileno()).st_mtime,
+                                          timezone.utc)
+        return StoredObject(FileBody(f, stop - start), stop - start, etag,
+                            content_type=meta['content_type'],
+                            last_modified=modified,
+                            content_range=content_range)
+
+    def _remove(self, key):
+        path = self.path(key)
+        if key.endswith('/'):
+            try:
+                os.rmdir(path)
+            except OSError:
+                # Like S3, removing a folder marker keeps the objects
+                pass
+            return
+        os.remove(path)
+        meta_path = self.path(key, meta=True)
+        try:
+            os.remove(meta_path)
+        except OSError:
+            pass
+        # Drop metadata folders emptied by the delete
+        folder = os.path.dirname(meta_path)
+        while folder != os.path.join(self.root, META_DIR):
+            try:
+                os.rmdir(folder)
+            except OSError:
+                break
+            folder = os.path.dirname(folder)
+
+    @timed('storage')
+    def delete(self, key):
+        try:
+            self._remove(key)
+        except FileNotFoundError:
+            pass
+        except (IOError, OSError) as err:
+            raise StorageError(str(err))
+
+    @timed('storage')
+    def delete_many(self, keys):
+        deleted = []
+        errors = {}
+        # Folders go last and deepest first, once they are empty
+        keys = [key for key in keys if not key.endswith('/')] + \
+            sorted((key for key in keys if key.endswith('/')), reverse=True)
+        for key in keys:
+            try:
+                self.delete(key)
+            except StorageError as err:
+                errors[key] = str(err)
+            else:
+                deleted.append(key)
+        return deleted, errors
+
+    def _walk(self, prefix):
+        directory, _, _ = prefix.rpartition('/')
+        top = os.path.join(self.root, *directory.split('/')) \
+            if directory else self.root
+        for dirpath, dirnames, filenames in os.walk(top):
+            dirnames[:] = [name for name in dirnames if name != META_DIR]
+            folder = os.path.relpath(dirpath, self.root).replace(os.sep, '/')
+            folder = '' if folder == '.' else folder + '/'
+            if folder:
+                yield folder
+            for name in filenames:
+                if not name.startswith('.tmp'):
+                    yield folder + name
+
+    def list_pages(self, prefix=''):
+        """
+        Yields the keys under `prefix` in pages, in lexicographic
+        order. Directories are listed as folder marker keys.
+        """
+        keys = sorted(key for key in self._walk(prefix)
+                      if key.startswith(prefix))
+        for start in range(0, len(keys), LIST_PAGE_SIZE):
+            yield keys[start:start + LIST_PAGE_SIZE]
+
+    @timed('storage')
+    def list_folders(self, prefix=''):
+        """
+        Returns the folder marker keys and the keys directly under
+        `prefix`, each in lexicographic order
+        """
+        top = os.path.join(self.root, *prefix.split('/')) \
+            if prefix else self.root
+        folders, keys = [], []
+        try:
+            entries = list(os.scandir(top))
+        except (IOError, OSError):
+            return folders, keys
+        for entry in entries:
+            if entry.is_dir():
+                if entry.name != META_DIR:
+                    folders.append(prefix + entry.name + '/')
+            elif not entry.name.startswith('.tmp'):
+                keys.append(prefix + entry.name)
+        return sorted(folders), sorted(keys)
+
+    @timed('storage')
+    def last_modified(self, key):
+        try:
+            mtime = os.path.getmtime(self.path(key))
+        except (IOError, OSError):
+            raise ObjectNotFound(key)
+        return datetime.fromtimestamp(mtime, timezone.utc)
+
+    def _serializer(self):
+        return URLSafeSerializer(self.secret_key, salt='local-storage')
+
+    @timed('storage')
+    def presign(self, key, expires_in, method='get_object'):
+        if method != 'get_object':
+            raise StorageError('Only downloads can be presigned')
+        token = self._serializer().dumps([key, int(time()) + expires_in])
+        return url_for('local_object', key=key, token=token, _external=True)
+
+    def verify(self, key, token):
+        """
+        Checks a token made by `presign` for `key` has not expired
+        """
+        try:
+            signed_key, expires_at = self._serializer().loads(token or '')
+        except (BadSignature, ValueError):
+            return False
+        return signed_key == key and expires_at > time()
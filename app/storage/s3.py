@@ -0,0 +1,269 @@
+import os
+from threading import Lock
+
+import boto3
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotoConfig
+from botocore.exceptions import ClientError, BotoCoreError
+
+from app.metrics import timed
+from app.storage.base import StorageError, ObjectNotFound, NotModified, \
+    InvalidRange, PreconditionFailed, StoredObject
+
+# DeleteObjects accepts at most 1000 keys per request
+DELETE_BATCH_SIZE = 1000
+
+ERRORS_BY_STATUS = {
+    304: NotModified,
+    404: ObjectNotFound,
+    412: PreconditionFailed,
+    416: InvalidRange,
+}
+
+
+def storage_error(err):
+    """
+    Maps a botocore error to the matching StorageError
+    """
+    status = None
+    if isinstance(err, ClientError):
+        status = err.response['ResponseMetadata'].get('HTTPStatusCode')
+        if err.response['Error'].get('Code') in ('NoSuchKey', 'NotFound'):
+            status = 404
+    return ERRORS_BY_STATUS.get(status, StorageError)(str(err))
+
+
+class S3Backend(object):
+    """
+    Stores objects in one S3 bucket.
+
+    Every thread of a process shares one client and its connection
+    pool, which holds up to `S3_MAX_POOL_CONNECTIONS` keep-alive
+    connections. A forked worker builds its own client on first use
+    instead of sharing the parent's sockets.
+    """
+    def __init__(self, bucket_name, max_pool_connections=10,
+                 connect_timeout=60, read_timeout=60, max_attempts=5,
+                 multipart_threshold=8 * 1024 * 1024,
+                 multipart_chunksize=8 * 1024 * 1024, max_concurrency=10,
+                 endpoint_url=None):
+        self.bucket_name = bucket_name
+        self.endpoint_url = endpoint_url
+        self.name = 's3://' + bucket_name
+        self.client_config = BotoConfig(
+            max_pool_connections=max_pool_connections,
+            connect_timeout=connect_timeout,
+            read_timeout=read_timeout,
+            retries={'max_attempts': max_attempts}
+        )
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_chunksize,
+            max_concurrency=max_concurrency
+        )
+        # Not exposed by the boto3 constructor, defaults to 10 chunks.
+        # Parts are read from the stream one chunk at a time, so peak
+        # memory per upload is a few part sizes whatever the file size.
+        self.transfer_config.max_in_memory_upload_chunks = max_concurrency
+        self._client = None
+        self._client_pid = None
+        self._lock = Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            config['S3_BUCKET'],
+            max_pool_connections=config['S3_MAX_POOL_CONNECTIONS'],
+            connect_timeout=config['S3_CONNECT_TIMEOUT'],
+            read_timeout=config['S3_READ_TIMEOUT'],
+            max_attempts=config['S3_MAX_ATTEMPTS'],
+            multipart_threshold=config['S3_MULTIPART_THRESHOLD'],
+            multipart_chunksize=config['S3_MULTIPART_CHUNKSIZE'],
+            max_concurrency=config['S3_MAX_CONCURRENCY'],
+            endpoint_url=config['S3_ENDPOINT_URL']
+        )
+
+    def __getstate__(self):
+        # Sent to worker processes without the client or its lock
+        state = self.__dict__.copy()
+        state.update(_client=None, _client_pid=None, _lock=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = Lock()
+
+    @property
+    def client(self):
+        if self._client is None or self._client_pid != os.getpid():
+            with self._lock:
+                if self._client is None or self._client_pid != os.getpid():
+                    self._client = boto3.client(
+                        's3', config=self.client_config,
+                        endpoint_url=self.endpoint_url)
+                    self._client_pid = os.getpid()
+        return self._client
+
+    @timed('storage')
+    def upload(self, key, stream, content_type=None):
+        """
+        Uploads a file-like object as a parallel multipart upload and
+        returns its metadata.
+
+        Small files fall under the multipart threshold and are sent
+        with a single PUT. If any part fails the multipart upload is
+        aborted and StorageError is raised.
+        """
+        extra_args = {'ContentType': content_type} if content_type else None
+        try:
+            self.client.upload_fileobj(stream, self.bucket_name, key,
+                                       ExtraArgs=extra_args,
+                                       Config=self.transfer_config)
+        except (S3UploadFailedError, ClientError, BotoCoreError) as err:
+            raise StorageError(str(err))
+        return self.head(key)
+
+    @timed('storage')
+    def put(self, key, data, content_type=None):
+        """
+        Stores a small object from bytes
+        """
+        params = {'Bucket': self.bucket_name, 'Key': key, 'Body': data}
+        if content_type:
+            params['ContentType'] = content_type
+        try:
+            self.client.put_object(**params)
+        except (ClientError, BotoCoreError) as err:
+            raise storage_error(err)
+
+    @timed('storage')
+    def head(self, key):
+        """
+        Returns the size, ETag and content type of an object
+        using a HEAD request, the object body is never fetched
+        """
+        try:
+            head = self.client.head_object(Bucket=self.bucket_name, Key=key)
+        except (ClientError, BotoCoreError) as err:
+            raise storage_error(err)
+        return {
+            'size': head['ContentLength'],
+            'etag': head['ETag'].strip('"'),
+            'content_type': head.get('ContentType'),
+        }
+
+    @timed('storage')
+    def open(self, key, range=None, if_none_match=None, if_match=None):
+        """
+        Opens an object for reading. `range` is a `Range` header
+        value, the conditions are ETags as sent in request headers.
+        """
+        params = {'Bucket': self.bucket_name, 'Key': key}
+        if range:
+            params['Range'] = range
+        if if_none_match:
+            params['IfNoneMatch'] = if_none_match
+        if if_match:
+            params['IfMatch'] = if_match
+        try:
+            res = self.client.get_object(**params)
+        except (ClientError, BotoCoreError) as err:
+            raise storage_error(err)
+        return StoredObject(
+            res['Body'],
+            res['ContentLength'],
+            res['ETag'].strip('"'),
+            content_type=res.get('ContentType'),
+            last_modified=res.get('LastModified'),
+            content_range=res.get('ContentRange')
+        )
+
+    @timed('storage')
+    def delete(self, key):
+        try:
+            self.client.delete_object(Bucket=self.bucket_name, Key=key)
+        except (ClientError, BotoCoreError) as err:
+            raise storage_error(err)
+
+    @timed('storage')
+    def delete_many(self, keys):
+        """
+        Deletes keys with DeleteObjects, up to 1000 keys per request.
+
+        Returns the list of deleted keys and a dict of the keys
+        that could not be deleted mapped to the S3 error message.
+        """
+        deleted = []
+        errors = {}
+        for start in range(0, len(keys), DELETE_BATCH_SIZE):
+            batch = keys[start:start + DELETE_BATCH_SIZE]
+            try:
+                res = self.client.delete_objects(
+                    Bucket=self.bucket_name,
+                    Delete={
+                        'Objects': [{'Key': key} for key in batch],
+                        'Quiet': True,
+                    }
+                )
+            except (ClientError, BotoCoreError) as err:
+                errors.update((key, str(err)) for key in batch)
+                continue
+
+            failed = {err['Key']: err.get('Message', err.get('Code'))
+                      for err in res.get('Errors', [])}
+            errors.update(failed)
+            deleted.extend(key for key in batch if key not in failed)
+        return deleted, errors
+
+    def list_pages(self, prefix=''):
+        """
+        Yields the keys under `prefix` in pages of up to 1000 keys,
+        in lexicographic order
+        """
+        paginator = self.client.get_paginator('list_objects_v2')
+        try:
+            for page in paginator.paginate(Bucket=self.bucket_name,
+                                           Prefix=prefix):
+                keys = [obj['Key'] for obj in page.get('Contents', [])]
+                if keys:
+                    yield keys
+        except (ClientError, BotoCoreError) as err:
+            raise storage_error(err)
+
+    @timed('storage')
+    def list_folders(self, prefix=''):
+        """
+        Returns the folders and the keys directly under `prefix`,
+        each in lexicographic order
+        """
+        folders, keys = [], []
+        paginator = self.client.get_paginator('list_objects_v2')
+        try:
+            for page in paginator.paginate(Bucket=self.bucket_name,
+                                           Prefix=prefix, Delimiter='/'):
+                folders.extend(common['Prefix']
+                               for common in page.get('CommonPrefixes', []))
+                keys.extend(obj['Key'] for obj in page.get('Contents', []))
+        except (ClientError, BotoCoreError) as err:
+            raise storage_error(err)
+        return folders, keys
+
+    @timed('storage')
+    def last_modified(self, key):
+        """
+        Returns when an object was last written, as an aware datetime
+        """
+        try:
+            head = self.client.head_object(Bucket=self.bucket_name, Key=key)
+        except (ClientError, BotoCoreError) as err:
+            raise storage_error(err)
+        return head['LastModified']
+
+    @timed('storage')
+    def presign(self, key, expires_in, method='get_object'):
+        return self.client.generate_presigned_url(
+            ClientMethod=method,
+            Params={'Bucket': self.bucket_name, 'Key': key},
+            ExpiresIn=expires_in
+        )
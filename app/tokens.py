@@ -0,0 +1,254 @@
+from uuid import uuid4
+from time import time
+from datetime import datetime, timedelta
+from collections import deque
+from threading import Lock
+
+from flask import current_app, request, Blueprint
+from flask.sessions import SecureCookieSessionInterface
+from flask_wtf import CSRFProtect
+
+
+def bearer_token(req=None):
+    """
+    Returns the token of an `Authorization: Bearer` header, or None
+    """
+    header = (req or request).headers.get('Authorization', '')
+    scheme, _, token = header.partition(' ')
+    if scheme.lower() != 'bearer' or not token.strip():
+        return None
+    return token.strip()
+
+
+def encode_token(user, kind, expires_in):
+    # PyJWT is imported on first use, so booting a worker does
+    # not pay for it
+    import jwt
+
+    now = time()
+    return jwt.encode({
+        'sub': user.id,
+        'username': user.username,
+        'typ': kind,
+        'jti': uuid4().hex,
+        'iat': now,
+        'exp': now + expires_in,
+    }, current_app.config['SECRET_KEY'], algorithm='HS256').decode('utf-8')
+
+
+def issue_tokens(user):
+    """
+    Returns a new access and refresh token pair for a user
+    """
+    expires_in = current_app.config['JWT_ACCESS_EXPIRES']
+    return {
+        'access_token': encode_token(user, 'access', expires_in),
+        'refresh_token': encode_token(
+            user, 'refresh', current_app.config['JWT_REFRESH_EXPIRES']),
+        'token_type': 'Bearer',
+        'expires_in': expires_in,
+    }
+
+
+def decode_token(token, kind='access'):
+    """
+    Returns the claims of a valid, unexpired token of `kind`, or
+    None. Revocation is checked separately with `RevocationList`.
+    """
+    import jwt
+
+    try:
+        claims = jwt.decode(token, current_app.config['SECRET_KEY'],
+                            algorithms=['HS256'])
+    except (jwt.InvalidTokenError, TypeError):
+        return None
+    if 'jti' not in claims or 'sub' not in claims:
+        return None
+    if kind is not None and claims.get('typ') != kind:
+        return None
+    return claims
+
+
+class RevocationList(object):
+    """
+    The revoked tokens that have not expired yet, kept in memory so
+    checking a token costs no query.
+
+    Revocations are written to the RevokedToken table and each
+    process picks up the ones made by others every
+    `TOKEN_REVOCATION_SYNC_SECONDS`. Ids are handed out before the
+    revocation commits, so each sync reads again the rows above the
+    highest id loaded `TOKEN_REVOCATION_SYNC_MARGIN` seconds before,
+    in case one committed late. Token ids are kept as 16 byte digests
+    and dropped once the token would have expired.
+    """
+    def __init__(self, app=None):
+        self._jtis = {}
+        self._users = {}
+        self._last_ids = deque([(0, 0)])
+        self._synced_at = 0
+        self._lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self._jtis = {}
+        self._users = {}
+        # (sync time, highest id loaded) of recent syncs
+        self._last_ids = deque([(0, 0)])
+        self._synced_at = 0
+
+    def __len__(self):
+        return len(self._jtis) + len(self._users)
+
+    def _add(self, jti, user_id, revoked_at, expires_at):
+        if jti:
+            self._jtis[bytes.fromhex(jti)] = expires_at
+        elif user_id is not None:
+            cutoff = self._users.get(user_id, (0, 0))
+            self._users[user_id] = (max(cutoff[0], revoked_at),
+                                    max(cutoff[1], expires_at))
+
+    def _prune(self, now):
+        for jti, expires_at in list(self._jtis.items()):
+            if expires_at <= now:
+                self._jtis.pop(jti, None)
+        for user_id, (_, expires_at) in list(self._users.items()):
+            if expires_at <= now:
+                self._users.pop(user_id, None)
+
+    def sync(self, force=False):
+        """
+        Loads revocations committed since the last sync
+        """
+        from app import db
+        from app.models import RevokedToken
+
+        interval = current_app.config['TOKEN_REVOCATION_SYNC_SECONDS']
+        if not force and time() - self._synced_at < interval:
+            return
+        # One thread syncs, the others go on with what is loaded
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            now = self._synced_at = time()
+            margin = current_app.config['TOKEN_REVOCATION_SYNC_MARGIN']
+            while len(self._last_ids) > 1 and \
+                    self._last_ids[1][0] <= now - margin:
+                self._last_ids.popleft()
+            last_id = self._last_ids[-1][1]
+            rows = db.session.query(
+                RevokedToken.id, RevokedToken.jti, RevokedToken.user_id,
+                RevokedToken.revoked_at, RevokedToken.expires_at
+            ).filter(
+                RevokedToken.id > self._last_ids[0][1],
+                RevokedToken.expires_at > datetime.utcnow()
+            ).order_by(RevokedToken.id)
+            for row_id, jti, user_id, revoked_at, expires_at in rows:
+                self._add(jti, user_id, epoch(revoked_at), epoch(expires_at))
+                last_id = max(last_id, row_id)
+            self._last_ids.append((now, last_id))
+            self._prune(now)
+        finally:
+            self._lock.release()
+
+    def is_revoked(self, claims):
+        self.sync()
+        try:
+            if bytes.fromhex(claims['jti']) in self._jtis:
+                return True
+        except (TypeError, ValueError):
+            return True
+        cutoff = self._users.get(claims['sub'])
+        return cutoff is not None and claims.get('iat', 0) <= cutoff[0]
+
+    def revoke(self, claims):
+        """
+        Revokes one token, the caller commits
+        """
+        from app import db
+        from app.models import RevokedToken
+
+        db.session.add(RevokedToken(
+            jti=claims['jti'], user_id=claims['sub'],
+            expires_at=datetime.utcfromtimestamp(claims['exp'])))
+        self._add(claims['jti'], claims['sub'], time(), claims['exp'])
+
+    def revoke_user(self, user_id):
+        """
+        Revokes every token issued to a user so far, the caller commits
+        """
+        from app import db
+        from app.models import RevokedToken
+
+        now = time()
+        expires_at = now + max(current_app.config['JWT_ACCESS_EXPIRES'],
+                               current_app.config['JWT_REFRESH_EXPIRES'])
+        db.session.add(RevokedToken(
+            user_id=user_id, revoked_at=datetime.utcfromtimestamp(now),
+            expires_at=datetime.utcfromtimestamp(expires_at)))
+        self._add(None, user_id, now, expires_at)
+
+
+def epoch(value):
+    return (value - datetime(1970, 1, 1)) / timedelta(seconds=1)
+
+
+class BearerSessionInterface(SecureCookieSessionInterface):
+    """
+    Gives a request with a bearer token an empty session that is never
+    saved, so it is authenticated by the token only, never by a session
+    cookie sent along with it. Flask-Login finds no user in the session
+    and calls its request loader.
+    """
+    def open_session(self, app, request):
+        if bearer_token(request) is not None:
+            return self.session_class()
+        return super(BearerSessionInterface, self).open_session(app, request)
+
+    def save_session(self, app, session, response):
+        if bearer_token() is not None:
+            return
+        return super(BearerSessionInterface, self).save_session(
+            app, session, response)
+
+
+class BearerCSRFProtect(CSRFProtect):
+    """
+    CSRF protection for cookie sessions only. Flask-WTF's own check is
+    turned off and `protect` is called for requests without a bearer
+    token, which are the only ones a session cookie authenticates.
+    """
+    def __init__(self, app=None):
+        self.exempt_views = set()
+        self.exempt_blueprints = set()
+        super(BearerCSRFProtect, self).__init__(app)
+
+    def init_app(self, app):
+        app.config['WTF_CSRF_CHECK_DEFAULT'] = False
+        super(BearerCSRFProtect, self).init_app(app)
+        app.before_request(self.protect_cookie_request)
+
+    def exempt(self, view):
+        if isinstance(view, Blueprint):
+            self.exempt_blueprints.add(view.name)
+        elif isinstance(view, str):
+            self.exempt_views.add(view)
+        else:
+            self.exempt_views.add(
+                '{0}.{1}'.format(view.__module__, view.__name__))
+        return super(BearerCSRFProtect, self).exempt(view)
+
+    def protect_cookie_request(self):
+        config = current_app.config
+        if not config['WTF_CSRF_ENABLED'] or bearer_token() is not None:
+            return
+        if request.method not in config['WTF_CSRF_METHODS']:
+            return
+        view = current_app.view_functions.get(request.endpoint)
+        if view is None or request.blueprint in self.exempt_blueprints:
+            return
+        if '{0}.{1}'.format(view.__module__, view.__name__) \
+                in self.exempt_views:
+            return
+        self.protect()
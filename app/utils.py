@@ -1,6 +1,7 @@
 from functools import wraps
-from flask import redirect, url_for, request, current_app
+from flask import redirect, url_for, request, current_app, jsonify
 from flask_login import current_user
+from app.tokens import bearer_token
 
 ALLOWED_EXTENSIONS = set(['pdf', 'png', 'jpg', 'jpeg', 'gif', 'docx', 'xlsx'])
 
@@ -17,10 +18,15 @@ def login_required(f):
     """
     temp auth middleware until resolve https redirect with
     `login_required` from flask-login
+
+    Accepts a session or a bearer token, a request with a bad token
+    gets a 401 instead of the login redirect
     """
     @wraps(f)
     def https_redirect(*args, **kwargs):
         if not current_user.is_authenticated:
+            if bearer_token() is not None:
+                return jsonify({'err': 'Invalid or expired token'}), 401
             if not current_app.debug:
                 return redirect(
                     url_for(
@@ -0,0 +1,232 @@
+"""
+Fixtures and reporting for the endpoint benchmarks.
+
+    python -m pytest benchmarks [--bench-compare .benchmarks/old.json]
+
+Each benchmark times one endpoint through the test client against
+the local storage backend, so the numbers measure the app rather
+than the network or moto. Results are written to `--bench-output`
+and compared with `--bench-compare`, slower medians are flagged.
+"""
+import io
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+from datetime import datetime
+
+import pytest
+
+from app import db, storage
+from app.models import User, File
+from tests.conftest import app, client  # noqa: F401
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MIN_ROUNDS = 5
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('benchmarks')
+    group.addoption('--bench-rounds', type=int, default=200,
+                    help='Most timed calls per benchmark.')
+    group.addoption('--bench-seconds', type=float, default=5,
+                    help='Time budget per benchmark, at least '
+                         '{} calls are timed.'.format(MIN_ROUNDS))
+    group.addoption('--bench-accounts', default='1,1000,100000',
+                    help='Comma separated account sizes, in files.')
+    group.addoption('--bench-output', default=None,
+                    help='Where to save the results, defaults to '
+                         '.benchmarks/<time>.json.')
+    group.addoption('--bench-compare', default=None,
+                    help='Results of an earlier run to compare with.')
+    group.addoption('--bench-threshold', type=float, default=0.25,
+                    help='Slowdown of the median flagged as a regression.')
+    group.addoption('--bench-fail', action='store_true',
+                    help='Fail the run when a regression is flagged.')
+
+
+def pytest_configure(config):
+    config.bench_results = {}
+    config.bench_regressions = []
+
+
+def pytest_generate_tests(metafunc):
+    if 'account_size' in metafunc.fixturenames:
+        sizes = [int(size) for size in
+                 metafunc.config.getoption('bench_accounts').split(',')]
+        metafunc.parametrize('account_size', sizes)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Bench(object):
+    """
+    Times a callable and records ops/sec and latency percentiles.
+    `setup` runs before each call, untimed, and returns its arguments.
+    """
+    def __init__(self, config):
+        self.rounds = config.getoption('bench_rounds')
+        self.seconds = config.getoption('bench_seconds')
+        self.results = config.bench_results
+
+    def __call__(self, name, fn, setup=None):
+        args = setup() if setup else ()
+        fn(*args)
+
+        timings = []
+        deadline = time.perf_counter() + self.seconds
+        while len(timings) < self.rounds and (
+                len(timings) < MIN_ROUNDS or
+                time.perf_counter() < deadline):
+            args = setup() if setup else ()
+            start = time.perf_counter()
+            fn(*args)
+            timings.append(time.perf_counter() - start)
+
+        self.results[name] = result = {
+            'rounds': len(timings),
+            'ops_per_sec': round(len(timings) / sum(timings), 1),
+            'p50_ms': round(percentile(timings, 0.5) * 1000, 3),
+            'p95_ms': round(percentile(timings, 0.95) * 1000, 3),
+            'p99_ms': round(percentile(timings, 0.99) * 1000, 3),
+        }
+        return result
+
+
+@pytest.fixture
+def bench(request):
+    return Bench(request.config)
+
+
+@pytest.fixture
+def local_storage(app, tmp_path):
+    app.config.update(STORAGE_BACKEND='local',
+                      LOCAL_STORAGE_ROOT=str(tmp_path))
+    app.extensions['storage'] = None
+    yield storage.backend
+    app.extensions['storage'] = None
+
+
+@pytest.fixture
+def logged_in(app, client, local_storage):
+    """
+    A verified user with a session, no password is ever hashed
+    """
+    user = User(username='benchuser', email='bench@justfiles.com',
+                is_verified=True)
+    db.session.add(user)
+    db.session.commit()
+    with client.session_transaction() as session:
+        # Flask-Login 0.4 reads user_id, later versions _user_id
+        session['user_id'] = session['_user_id'] = str(user.id)
+        session['_fresh'] = True
+    return user
+
+
+def add_files(user, count, size=1024, batch_size=10000):
+    """
+    Inserts `count` File rows for `user` and stores one object that
+    they all point at, returns their ids
+    """
+    key = '{}/seed.pdf'.format(user.folder)
+    meta = storage.upload(key, io.BytesIO(b'0' * size), 'application/pdf')
+    for start in range(0, count, batch_size):
+        db.session.execute(File.__table__.insert(), [{
+            'name': 'seed{}.pdf'.format(number),
+            'key': key,
+            'body': 'seeded file',
+            'date': '2020-01-01',
+            'size': meta['size'],
+            'etag': meta['etag'],
+            'content_type': meta['content_type'],
+            'user_id': user.id,
+        } for number in range(start, min(start + batch_size, count))])
+    db.session.commit()
+    return [file_id for file_id, in db.session.query(File.id)
+            .filter_by(user_id=user.id).order_by(File.id)]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """
+    Returns `(name, old p50, new p50, change)` for every benchmark of
+    both runs
+    """
+    rows = []
+    for name, result in sorted(results.items()):
+        old = baseline.get(name)
+        if old:
+            change = result['p50_ms'] / old['p50_ms'] - 1
+            rows.append((name, old['p50_ms'], result['p50_ms'], change))
+    return rows
+
+
+def pytest_sessionfinish(session, exitstatus):
+    config = session.config
+    results = config.bench_results
+    if not results:
+        return
+
+    output = config.getoption('bench_output') or os.path.join(
+        ROOT, '.benchmarks',
+        datetime.utcnow().strftime('%Y%m%dT%H%M%S') + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({
+            'commit': git_commit(),
+            'created_at': datetime.utcnow().isoformat(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'results': results,
+        }, f, indent=2, sort_keys=True)
+    config.bench_output = output
+
+    baseline_path = config.getoption('bench_compare')
+    config.bench_comparison = []
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)['results']
+        config.bench_comparison = compare(results, baseline)
+        threshold = config.getoption('bench_threshold')
+        config.bench_regressions = [
+            name for name, _, _, change in config.bench_comparison
+            if change > threshold]
+        if config.bench_regressions and config.getoption('bench_fail'):
+            session.exitstatus = 1
+
+
+def pytest_terminal_summary(terminalreporter, exitstatus, config):
+    results = config.bench_results
+    if not results:
+        return
+
+    line = '{:<36} {:>10} {:>10} {:>10} {:>10}'
+    write = terminalreporter.write_line
+    terminalreporter.section('benchmarks')
+    write(line.format('name', 'ops/sec', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for name, result in sorted(results.items()):
+        write(line.format(name, result['ops_per_sec'], result['p50_ms'],
+                          result['p95_ms'], result['p99_ms']))
+    write('Saved to {}'.format(config.bench_output))
+
+    if config.bench_comparison:
+        terminalreporter.section('compared with {}'.format(
+            config.getoption('bench_compare')))
+        write(line.format('name', 'old p50', 'new p50', 'change', ''))
+        for name, old, new, change in config.bench_comparison:
+            flag = 'REGRESSION' if name in config.bench_regressions else ''
+            write('{:<36} {:>10} {:>10} {:>+10.0%} {}'.format(
+                name, old, new, change, flag))
@@ -0,0 +1,366 @@
+"""
+Load tests the app under gunicorn with many concurrent users.
+
+For each worker class and worker count the database is migrated and
+gunicorn is started as boot.sh does, against a fresh SQLite database
+and a local storage stand-in: the local backend, or a moto S3 server
+to go through boto and its connection pool. Virtual users then log
+in and keep uploading, listing, viewing and deleting their files for
+`--seconds` after a warm up, and throughput and latency percentiles are reported per
+operation.
+
+    python benchmarks/loadtest.py [--workers 1 2 4]
+        [--worker-class sync gthread] [--users 32] [--storage moto]
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+from collections import defaultdict
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUCKET = 'loadtest'
+PASSWORD = 'loadtestpassword'
+DEFAULT_MIX = 'login=5,upload=15,list=40,view=30,delete=10'
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(url, process, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('{} exited with {}'.format(
+                ' '.join(process.args), process.returncode))
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError('{} did not answer in {}s'.format(url, timeout))
+
+
+def seed(args):
+    """
+    Runs in a child with the load test environment: creates a verified
+    user per virtual user, each with `--files` files
+    """
+    import io
+    sys.path.insert(0, ROOT)
+    from run import app
+    from app import db, storage
+    from app.hashing import hash_password
+    from app.models import User, File
+
+    with app.app_context():
+        if app.config['STORAGE_BACKEND'] == 's3':
+            storage.client.create_bucket(Bucket=BUCKET)
+        # Every user shares one hash, made at the configured cost
+        password_hash = hash_password(PASSWORD,
+                                      app.config['BCRYPT_LOG_ROUNDS'])
+        payload = b'0' * args.file_size
+        for number in range(args.users):
+            user = User(username='loaduser{:04d}'.format(number),
+                        email='load{}@justfiles.com'.format(number),
+                        password_hash=password_hash, is_verified=True)
+            db.session.add(user)
+            db.session.flush()
+            for file_number in range(args.files):
+                name = 'seed{}.pdf'.format(file_number)
+                key = '{0}/{1}'.format(user.folder, name)
+                file = File(name=name, key=key, body='', date='2020-01-01',
+                            user_id=user.id)
+                file.set_metadata(storage.upload(
+                    key, io.BytesIO(payload), 'application/pdf'))
+                db.session.add(file)
+            storage.put(user.folder + '/', b'')
+        db.session.commit()
+
+
+class VirtualUser(threading.Thread):
+    """
+    Logs in, then picks operations from the mix until the deadline
+    """
+    def __init__(self, base_url, username, args, deadline, record):
+        super(VirtualUser, self).__init__(daemon=True)
+        self.base_url = base_url
+        self.username = username
+        self.args = args
+        self.deadline = deadline
+        self.record = record
+        self.session = requests.Session()
+        self.csrf = None
+        self.file_ids = []
+        self.uploads = 0
+        self.random = random.Random(username)
+        self.payload = b'0' * args.file_size
+
+    def request(self, op, method, path, **kwargs):
+        headers = {'X-CSRFToken': self.csrf} if self.csrf else {}
+        start = time.perf_counter()
+        try:
+            rv = self.session.request(method, self.base_url + path,
+                                      headers=headers, timeout=60,
+                                      allow_redirects=False, **kwargs)
+        except requests.RequestException:
+            self.record(op, time.perf_counter() - start, None)
+            return None
+        self.record(op, time.perf_counter() - start, rv.status_code)
+        return rv
+
+    def login(self):
+        rv = self.request('login', 'POST', '/login', data={
+            'username': self.username, 'password': PASSWORD})
+        if rv is not None and rv.status_code == 200:
+            self.csrf = rv.json()['csrf']
+
+    def upload(self):
+        self.uploads += 1
+        name = '{0}-{1}.pdf'.format(self.name, self.uploads)
+        self.request('upload', 'POST', '/files', data={
+            'text': 'load test upload', 'date': '2020-01-01',
+        }, files={'file': (name, self.payload, 'application/pdf')})
+
+    def list(self):
+        rv = self.request('list', 'GET', '/files?limit=50')
+        if rv is not None and rv.status_code == 200:
+            self.file_ids = [file['id'] for file in rv.json()['files']]
+
+    def view(self):
+        if not self.file_ids:
+            return self.list()
+        self.request('view', 'GET', '/files/{}'.format(
+            self.random.choice(self.file_ids)))
+
+    def delete(self):
+        if not self.file_ids:
+            return self.list()
+        file_id = self.file_ids.pop(self.random.randrange(
+            len(self.file_ids)))
+        self.request('delete', 'DELETE', '/files/{}/delete'.format(file_id))
+
+    def run(self):
+        ops, weights = zip(*self.args.mix)
+        self.login()
+        while time.perf_counter() < self.deadline:
+            if self.csrf is None:
+                self.login()
+            else:
+                getattr(self, self.random.choices(ops, weights)[0])()
+            if self.args.think:
+                time.sleep(self.random.expovariate(1 / self.args.think))
+
+
+def start_storage(args, tmp, env):
+    """
+    Points the app at a local storage stand-in, returns the moto
+    server process if one was started
+    """
+    if args.storage == 'local':
+        env.update(STORAGE_BACKEND='local',
+                   LOCAL_STORAGE_ROOT=os.path.join(tmp, 'storage'))
+        return None
+
+    port = free_port()
+    moto = subprocess.Popen(
+        [os.path.join(os.path.dirname(sys.executable), 'moto_server'),
+         '-H', '127.0.0.1', '-p', str(port)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = 'http://127.0.0.1:{}'.format(port)
+    wait_for(url, moto)
+    env.update(STORAGE_BACKEND='s3', S3_BUCKET=BUCKET, S3_ENDPOINT_URL=url)
+    env.setdefault('AWS_ACCESS_KEY_ID', 'loadtest')
+    env.setdefault('AWS_SECRET_ACCESS_KEY', 'loadtest')
+    env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    return moto
+
+
+def run(args, worker_class, workers):
+    """
+    Boots a fresh deployment and drives it for `--seconds`
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, FLASK_APP='run.py',
+                   DATABASE_URL=args.database_url or
+                   'sqlite:///' + os.path.join(tmp, 'loadtest.db'))
+        moto = start_storage(args, tmp, env)
+        gunicorn = None
+        log = open(os.path.join(tmp, 'gunicorn.log'), 'w+')
+        try:
+            subprocess.check_call(
+                [sys.executable, '-m', 'flask', 'db', 'upgrade'],
+                env=env, cwd=ROOT, stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL)
+            subprocess.check_call(
+                [sys.executable, __file__, '--seed',
+                 '--users', str(args.users), '--files', str(args.files),
+                 '--file-size', str(args.file_size)], env=env, cwd=ROOT)
+
+            port = free_port()
+            env.update(GUNICORN_WORKERS=str(workers),
+                       GUNICORN_WORKER_CLASS=worker_class,
+                       GUNICORN_THREADS=str(
+                           args.threads if worker_class == 'gthread' else 1))
+            gunicorn = subprocess.Popen(
+                [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+                 '--bind', '127.0.0.1:{}'.format(port), 'run:app'],
+                env=env, cwd=ROOT, stdout=log, stderr=subprocess.STDOUT)
+            base_url = 'http://127.0.0.1:{}'.format(port)
+            wait_for(base_url + '/login', gunicorn)
+
+            timings = defaultdict(list)
+            statuses = defaultdict(lambda: defaultdict(int))
+            lock = threading.Lock()
+
+            # Workers spawn their hashing pools on the first logins,
+            # requests made while warming up are not counted
+            measure_from = time.perf_counter() + args.warmup
+
+            def record(op, elapsed, status):
+                if time.perf_counter() < measure_from:
+                    return
+                with lock:
+                    statuses[op][status] += 1
+                    if status is not None and status < 400:
+                        timings[op].append(elapsed * 1000)
+
+            deadline = measure_from + args.seconds
+            users = [VirtualUser(base_url, 'loaduser{:04d}'.format(number),
+                                 args, deadline, record)
+                     for number in range(args.users)]
+            for user in users:
+                user.start()
+            for user in users:
+                user.join()
+        except Exception:
+            log.seek(0)
+            sys.stderr.write(log.read()[-4000:])
+            raise
+        finally:
+            for process in (gunicorn, moto):
+                if process is not None:
+                    process.terminate()
+                    process.wait()
+            log.close()
+
+    ops = {}
+    for op in sorted(statuses):
+        counts = statuses[op]
+        ok = len(timings[op])
+        ops[op] = {
+            'requests': sum(counts.values()),
+            'per_second': round(ok / args.seconds, 1),
+            # 503s are logins turned away by the hashing pool
+            'shed': counts.get(503, 0),
+            'errors': sum(count for status, count in counts.items()
+                          if status is None or
+                          (status >= 400 and status != 503)),
+            'p50_ms': round(percentile(timings[op], 0.5) or 0, 1),
+            'p95_ms': round(percentile(timings[op], 0.95) or 0, 1),
+            'p99_ms': round(percentile(timings[op], 0.99) or 0, 1),
+        }
+    everything = [value for op in timings for value in timings[op]]
+    return {
+        'worker_class': worker_class,
+        'workers': workers,
+        'threads': args.threads if worker_class == 'gthread' else 1,
+        'users': args.users,
+        'storage': args.storage,
+        'per_second': round(len(everything) / args.seconds, 1),
+        'p50_ms': round(percentile(everything, 0.5) or 0, 1),
+        'p95_ms': round(percentile(everything, 0.95) or 0, 1),
+        'p99_ms': round(percentile(everything, 0.99) or 0, 1),
+        'ops': ops,
+    }
+
+
+def print_report(results):
+    line = '{:<10} {:>7} {:<8} {:>8} {:>6} {:>6} {:>9} {:>9} {:>9}'
+    print(line.format('class', 'workers', 'op', 'req/s', 'shed', 'errors',
+                      'p50 ms', 'p95 ms', 'p99 ms'))
+    for result in results:
+        rows = sorted(result['ops'].items())
+        rows.append(('all', dict(result, shed='', errors='')))
+        for op, stats in rows:
+            print(line.format(result['worker_class'], result['workers'], op,
+                              stats['per_second'], stats['shed'],
+                              stats['errors'], stats['p50_ms'],
+                              stats['p95_ms'], stats['p99_ms']))
+
+
+def parse_mix(value):
+    mix = []
+    for part in value.split(','):
+        op, _, weight = part.partition('=')
+        if op not in ('login', 'upload', 'list', 'view', 'delete'):
+            raise argparse.ArgumentTypeError('Unknown operation ' + op)
+        mix.append((op, float(weight or 1)))
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--worker-class', nargs='+',
+                        default=['sync', 'gthread'])
+    parser.add_argument('--threads', type=int, default=4,
+                        help='Threads per gthread worker.')
+    parser.add_argument('--users', type=int, default=32,
+                        help='Concurrent virtual users.')
+    parser.add_argument('--seconds', type=float, default=30)
+    parser.add_argument('--warmup', type=float, default=5,
+                        help='Seconds of load before measuring.')
+    parser.add_argument('--think', type=float, default=0,
+                        help='Mean pause between requests, in seconds.')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help='Operation weights, default ' + DEFAULT_MIX)
+    parser.add_argument('--files', type=int, default=20,
+                        help='Files each user starts with.')
+    parser.add_argument('--file-size', type=int, default=64 * 1024)
+    parser.add_argument('--storage', choices=['local', 'moto'],
+                        default='local')
+    parser.add_argument('--database-url',
+                        help='Use this database instead of a fresh SQLite '
+                             'file, it is migrated but not emptied.')
+    parser.add_argument('--output', help='Also save the results as JSON.')
+    parser.add_argument('--seed', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.seed:
+        seed(args)
+        return
+
+    results = []
+    for worker_class in args.worker_class:
+        for workers in args.workers:
+            print('Running {} x {} for {}s'.format(
+                worker_class, workers, args.seconds), file=sys.stderr)
+            results.append(run(args, worker_class, workers))
+    print_report(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+Measures login throughput against the size of the hashing pool.
+
+For each pool size, `--clients` threads log in as fast as they can
+for `--seconds` while one more thread keeps requesting the file
+list, showing how much logins slow down other requests. A pool
+size of 0 hashes on the request threads, as before the pool.
+
+    python benchmarks/login_throughput.py [--workers 0 1 2 4]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(workers, args, tmp):
+    """
+    Runs in a fresh interpreter for each pool size
+    """
+    sys.path.insert(0, ROOT)
+    from config import Config
+    from app import create_app, db, hasher
+    from app.models import User
+
+    Config.STORAGE_BACKEND = 'local'
+    Config.HASHING_WORKERS = workers
+    Config.HASHING_QUEUE_SIZE = args.queue_size
+    Config.BCRYPT_LOG_ROUNDS = args.rounds
+    Config.SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(
+        tmp, 'login.db')
+    Config.LOCAL_STORAGE_ROOT = os.path.join(tmp, 'storage')
+    Config.WTF_CSRF_ENABLED = False
+    Config.OUTBOX_WORKER = False
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        for number in range(args.clients + 1):
+            user = User(username='benchuser{}'.format(number),
+                        email='bench{}@justfiles.com'.format(number))
+            user.set_password('benchpassword')
+            user.is_verified = True
+            db.session.add(user)
+        db.session.commit()
+        # Spawn the pool before the clock starts
+        hasher.start()
+        User.query.first().check_password('benchpassword')
+
+    deadline = time.perf_counter() + args.seconds
+    logins, shed, files = [], [], []
+    lock = threading.Lock()
+
+    def log_in(number):
+        client = app.test_client()
+        form = {'username': 'benchuser{}'.format(number),
+                'password': 'benchpassword'}
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            rv = client.post('/login', data=form)
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                (logins if rv.status_code == 200 else shed).append(elapsed)
+
+    def list_files():
+        client = app.test_client()
+        client.post('/login', data={
+            'username': 'benchuser{}'.format(args.clients),
+            'password': 'benchpassword'})
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            client.get('/files')
+            files.append((time.perf_counter() - start) * 1000)
+
+    threads = [threading.Thread(target=log_in, args=(number,))
+               for number in range(args.clients)]
+    threads.append(threading.Thread(target=list_files))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return {
+        'workers': workers,
+        'logins_per_second': round(len(logins) / args.seconds, 1),
+        'shed': len(shed),
+        'login_p50_ms': round(percentile(logins, 0.5) or 0, 1),
+        'login_p95_ms': round(percentile(logins, 0.95) or 0, 1),
+        'files_p50_ms': round(percentile(files, 0.5) or 0, 1),
+        'files_p95_ms': round(percentile(files, 0.95) or 0, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=[0, 1, 2, 4])
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--rounds', type=int, default=12)
+    parser.add_argument('--queue-size', type=int, default=32)
+    parser.add_argument('--child', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        with tempfile.TemporaryDirectory() as tmp:
+            print(json.dumps(run(args.workers[0], args, tmp)))
+        return
+
+    results = []
+    for workers in args.workers:
+        command = [sys.executable, __file__, '--child',
+                   '--workers', str(workers),
+                   '--clients', str(args.clients),
+                   '--seconds', str(args.seconds),
+                   '--rounds', str(args.rounds),
+                   '--queue-size', str(args.queue_size)]
+        out = subprocess.check_output(command, cwd=ROOT)
+        results.append(json.loads(out.decode('utf-8').splitlines()[-1]))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""
+Measures how long a worker takes to answer its first request.
+
+Each run starts a fresh interpreter, imports the app, then serves
+`GET /files/<id>` (a user load, a file query and a presigned URL)
+through the test client. The preload runs import and warm up the
+app once, as a preloading gunicorn master does, and time the
+requests in forked children instead.
+
+    python benchmarks/startup.py [--runs 5] [--backend s3|local]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup(app):
+    from app import db
+    from app.models import User, File
+
+    with app.app_context():
+        db.create_all()
+        user = User(username='benchuser', email='bench@justfiles.com')
+        user.set_password('benchpassword')
+        user.is_verified = True
+        db.session.add(user)
+        db.session.flush()
+        db.session.add(File(name='bench.pdf', key='benchuser/bench.pdf',
+                            body='', size=1, etag='0', user_id=user.id))
+        db.session.commit()
+        return user.id
+
+
+def first_requests(app, user_id):
+    """
+    Returns the latency of the first and second request in ms
+    """
+    client = app.test_client()
+    with client.session_transaction() as session:
+        # Flask-Login 0.4 reads user_id, later versions _user_id
+        session['user_id'] = session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+
+    timings = []
+    for _ in range(2):
+        start = time.perf_counter()
+        rv = client.get('/files/1')
+        timings.append((time.perf_counter() - start) * 1000)
+        assert rv.status_code == 200, rv.data
+    return timings
+
+
+def child(preload, forks):
+    """
+    Runs in the measured interpreter and prints the results as JSON
+    """
+    start = time.perf_counter()
+    import run
+    import_ms = (time.perf_counter() - start) * 1000
+    user_id = setup(run.app)
+
+    if not preload:
+        first, second = first_requests(run.app, user_id)
+        print(json.dumps({'import_ms': import_ms, 'first_ms': first,
+                          'second_ms': second}))
+        return
+
+    from app import warm_up
+    start = time.perf_counter()
+    warm_up(run.app)
+    warm_up_ms = (time.perf_counter() - start) * 1000
+
+    results = []
+    for _ in range(forks):
+        read_fd, write_fd = os.pipe()
+        forked_at = time.perf_counter()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            first, second = first_requests(run.app, user_id)
+            ready_ms = (time.perf_counter() - forked_at) * 1000
+            os.write(write_fd, json.dumps([ready_ms, first, second])
+                     .encode('utf-8'))
+            os._exit(0)
+        os.close(write_fd)
+        with os.fdopen(read_fd) as f:
+            results.append(json.loads(f.read()))
+        os.waitpid(pid, 0)
+
+    print(json.dumps({
+        'import_ms': import_ms,
+        'warm_up_ms': warm_up_ms,
+        'fork_to_response_ms': min(result[0] for result in results),
+        'first_ms': min(result[1] for result in results),
+        'second_ms': min(result[2] for result in results),
+    }))
+
+
+def measure(args, preload):
+    runs = []
+    for _ in range(args.runs):
+        with tempfile.TemporaryDirectory() as tmp:
+            env = dict(
+                os.environ,
+                DATABASE_URL='sqlite:///' + os.path.join(tmp, 'bench.db'),
+                STORAGE_BACKEND=args.backend,
+                LOCAL_STORAGE_ROOT=os.path.join(tmp, 'storage'),
+            )
+            # Presigning needs credentials but never reaches AWS
+            env.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+            env.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+            env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+            command = [sys.executable, __file__, '--child']
+            if preload:
+                command.append('--preload')
+            out = subprocess.check_output(command, env=env, cwd=ROOT)
+            runs.append(json.loads(out.decode('utf-8').splitlines()[-1]))
+    # Best of the runs, the least disturbed by the machine
+    return {name: round(min(run[name] for run in runs), 1)
+            for name in runs[0]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--backend', default='s3', choices=['s3', 'local'])
+    parser.add_argument('--forks', type=int, default=3)
+    parser.add_argument('--child', action='store_true',
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--preload', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        sys.path.insert(0, ROOT)
+        child(args.preload, args.forks)
+        return
+
+    results = {'cold': measure(args, preload=False)}
+    if hasattr(os, 'fork'):
+        results['preload'] = measure(args, preload=True)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Latency of the file endpoints by file size and account size
+"""
+import io
+import random
+from itertools import count
+
+import pytest
+
+from app import db, storage
+from app.models import File
+
+from benchmarks.conftest import add_files
+
+FILE_SIZES = {'1kb': 1024, '1mb': 1024 ** 2, '10mb': 10 * 1024 ** 2}
+
+
+@pytest.mark.parametrize('file_size', list(FILE_SIZES))
+def test_upload(bench, client, logged_in, account_size, file_size):
+    add_files(logged_in, account_size)
+    data = b'0' * FILE_SIZES[file_size]
+    names = count()
+
+    def upload():
+        rv = client.post('/files', data={
+            'file': (io.BytesIO(data), 'upload{}.pdf'.format(next(names))),
+            'text': 'benchmark upload',
+            'date': '2020-01-01',
+        }, content_type='multipart/form-data')
+        assert rv.status_code == 200, rv.data
+
+    bench('upload[files={},size={}]'.format(account_size, file_size),
+          upload)
+
+
+@pytest.mark.parametrize('sort', ['id', 'name'])
+def test_list(bench, client, logged_in, account_size, sort):
+    add_files(logged_in, account_size)
+
+    def list_files():
+        rv = client.get('/files?sort={}&limit=50'.format(sort))
+        assert rv.status_code == 200, rv.data
+
+    bench('list[files={},sort={}]'.format(account_size, sort), list_files)
+
+
+def test_view(bench, client, logged_in, account_size):
+    ids = add_files(logged_in, account_size)
+    pick = random.Random(0).choice
+
+    def view():
+        rv = client.get('/files/{}'.format(pick(ids)))
+        assert rv.status_code == 200 and b'url' in rv.data, rv.data
+
+    bench('view[files={}]'.format(account_size), view)
+
+
+def test_edit(bench, client, logged_in, account_size):
+    ids = add_files(logged_in, account_size)
+    pick = random.Random(0).choice
+    edits = count()
+
+    def edit():
+        rv = client.patch('/files/{}/edit'.format(pick(ids)), data={
+            'body': 'edit {}'.format(next(edits))})
+        assert rv.status_code == 200 and b'edited' in rv.data, rv.data
+
+    bench('edit[files={}]'.format(account_size), edit)
+
+
+def test_delete(bench, client, logged_in, account_size):
+    add_files(logged_in, account_size)
+    names = count()
+
+    def add_file():
+        name = 'delete{}.pdf'.format(next(names))
+        key = '{0}/{1}'.format(logged_in.folder, name)
+        file = File(name=name, key=key, body='', date='2020-01-01',
+                    user_id=logged_in.id)
+        file.set_metadata(storage.upload(
+            key, io.BytesIO(b'0' * 1024), 'application/pdf'))
+        db.session.add(file)
+        db.session.commit()
+        return (file.id,)
+
+    def delete(file_id):
+        rv = client.delete('/files/{}/delete'.format(file_id))
+        assert rv.status_code == 200 and b'removed' in rv.data, rv.data
+
+    bench('delete[files={}]'.format(account_size), delete, setup=add_file)
@@ -11,4 +11,13 @@ while true; do
     sleep 5
 done
 
-exec gunicorn -b :5000 --access-logfile - --error-logfile - run:app
+# Finish purges of deleted users that a restart cut short
+flask users resume-purges &
+
+# Send queued emails from the start, workers only wake up their own
+# outbox thread once they queue one
+flask outbox drain --loop &
+
+# Set GUNICORN_PRELOAD=1 to load the app once before forking workers,
+# see gunicorn.conf.py
+exec gunicorn -c gunicorn.conf.py run:app
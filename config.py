@@ -3,10 +3,95 @@ basedir = os.path.abspath(os.path.dirname(__file__))
 
 
 class Config(object):
-    MAX_CONTENT_LENGTH = 5 * 1024 * 1024
+    # Uploads are spooled to disk by Werkzeug and streamed to S3 in parts,
+    # so the limit is no longer bound by worker memory
+    MAX_CONTENT_LENGTH = 2 * 1024 * 1024 * 1024
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'you-will-never-guess'
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Where files are stored, 's3' or 'local' for development
+    STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND') or 's3'
+    LOCAL_STORAGE_ROOT = os.environ.get('LOCAL_STORAGE_ROOT') or \
+        os.path.join(basedir, 'storage')
     S3_BUCKET = os.environ.get('S3_BUCKET') or 'NOT_SET'
+    # Another S3 compatible service, such as a local stand-in
+    S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')
+    # Connection pool shared by every thread of a worker process
+    S3_MAX_POOL_CONNECTIONS = 50
+    S3_CONNECT_TIMEOUT = 5
+    S3_READ_TIMEOUT = 60
+    S3_MAX_ATTEMPTS = 3
+    # Multipart upload settings, S3 requires parts of at least 5 MB
+    S3_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+    S3_MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+    S3_MAX_CONCURRENCY = 4
+    # Files of one batch upload sent at a time, each using up to
+    # S3_MAX_CONCURRENCY connections
+    UPLOAD_CONCURRENCY = 4
+    # Store each distinct file content once under blobs/<sha256>
+    S3_CONTENT_ADDRESSED = os.environ.get('S3_CONTENT_ADDRESSED') == '1'
+    # Local disk cache of hot objects for the download proxy
+    DISK_CACHE_DIR = os.environ.get('DISK_CACHE_DIR')
+    DISK_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+    DISK_CACHE_MAX_OBJECT_SIZE = 50 * 1024 * 1024
+    # Seconds a miss waits for another thread caching the same object
+    # before reading it from storage itself
+    DISK_CACHE_FILL_TIMEOUT = 10
+    # Thumbnails rendered for image uploads, in pixels
+    THUMBNAIL_SIZES = [128, 512]
+    THUMBNAIL_WORKERS = 2
+    THUMBNAIL_MAX_SOURCE_SIZE = 50 * 1024 * 1024
+    # Objects fetched ahead while streaming a ZIP download
+    ZIP_PREFETCH = 4
+    # DeleteObjects requests in flight while purging a deleted user
+    PURGE_CONCURRENCY = 4
+    # A running purge not updated for this long is resumed by
+    # `flask users resume-purges`
+    PURGE_STALE_SECONDS = 600
+    # Presigned URLs are reused until they have less than MIN_TTL seconds left
+    PRESIGNED_URL_EXPIRES = 3600
+    PRESIGNED_URL_MIN_TTL = 600
+    PRESIGNED_URL_CACHE_SIZE = 10000
+    # Users loaded for authenticated requests are cached for TTL seconds,
+    # 0 loads them from the database on every request
+    USER_CACHE_SIZE = 10000
+    USER_CACHE_TTL = 30
+    # bcrypt cost, hashes made with another cost are upgraded on login
+    BCRYPT_LOG_ROUNDS = 12
+    # Passwords hashed at once in the hashing pool, 0 hashes in the request,
+    # and how many more may wait before logins are turned away
+    HASHING_WORKERS = 2
+    HASHING_QUEUE_SIZE = 32
+    HASHING_TIMEOUT = 10
+    # Bearer tokens for API clients, in seconds
+    JWT_ACCESS_EXPIRES = 15 * 60
+    JWT_REFRESH_EXPIRES = 30 * 24 * 60 * 60
+    TOKEN_REVOCATION_SYNC_SECONDS = 10
+    # Longest a revocation may take to commit and still be picked up
+    TOKEN_REVOCATION_SYNC_MARGIN = 60
+    # Request latency histograms served on /metrics, see app/metrics.py.
+    # Scrapers send METRICS_TOKEN as a bearer token when it is set.
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED') == '1'
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    # Send the latency breakdown to clients in a Server-Timing header
+    SERVER_TIMING = os.environ.get('SERVER_TIMING') == '1'
+    # SQL statements slower than this are logged with their parameters,
+    # see app/queries.py
+    SLOW_QUERY_SECONDS = float(os.environ.get('SLOW_QUERY_SECONDS') or 0.5)
+    # Requests running one statement this many times are logged as a
+    # possible N+1, 0 turns the check off
+    N_PLUS_ONE_THRESHOLD = 10
     SENDGRID_API_KEY = os.environ.get('SENDGRID_API_KEY') or 'whoops'
+    SENDGRID_API_HOST = os.environ.get('SENDGRID_API_HOST') or \
+        'https://api.sendgrid.com'
+    SENDGRID_POOL_SIZE = 4
+    SENDGRID_TIMEOUT = 10
+    # Email outbox, see app/auth/email.py
+    OUTBOX_WORKER = True
+    OUTBOX_BATCH_SIZE = 50
+    OUTBOX_POLL_SECONDS = 5
+    OUTBOX_MAX_ATTEMPTS = 6
+    OUTBOX_RETRY_BACKOFF = 30
+    OUTBOX_CLAIM_TIMEOUT = 600
+    OUTBOX_COALESCE_SECONDS = 60
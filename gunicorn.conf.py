@@ -0,0 +1,30 @@
+import os
+
+bind = ':5000'
+accesslog = '-'
+errorlog = '-'
+workers = int(os.environ.get('GUNICORN_WORKERS', 1))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'sync')
+threads = int(os.environ.get('GUNICORN_THREADS', 1))
+
+# Load the app once in the master, workers are forked with it loaded
+# and start taking requests as soon as they are forked
+preload_app = os.environ.get('GUNICORN_PRELOAD') == '1'
+
+
+def when_ready(server):
+    if preload_app:
+        from run import app
+        from app import warm_up
+        warm_up(app)
+        server.log.info('Preloaded app')
+
+
+def post_fork(server, worker):
+    if preload_app:
+        # Connections opened by the master must not be shared
+        from run import app
+        from app import db, hasher
+        with app.app_context():
+            db.get_engine().dispose()
+        hasher.start()
@@ -1,10 +1,16 @@
 import os
+import json
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
 import pytest
 import boto3
 from moto import mock_s3
 
 from app import create_app, db
 from app.models import User
+from app.queries import count_queries
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
@@ -36,6 +42,17 @@ def add_user_to_db(user):
         raise
 
 
+@contextmanager
+def assert_max_queries(limit):
+    """
+    Fails when the block runs more than `limit` SQL statements
+    """
+    with count_queries() as log:
+        yield log
+    assert log.count <= limit, 'Ran {0} queries, expected at most {1}:\n{2}' \
+        .format(log.count, limit, '\n'.join(log.statements))
+
+
 @pytest.fixture(scope='function')
 def aws_credentials():
     """Mocked AWS Credentials for moto."""
@@ -83,3 +100,41 @@ def app():
 @pytest.fixture
 def client(app):
     return app.test_client()
+
+
+class SinkHandler(BaseHTTPRequestHandler):
+    """Stands in for the SendGrid mail send API"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.received.append({
+            'path': self.path,
+            'auth': self.headers['Authorization'],
+            'body': json.loads(body.decode('utf-8')),
+        })
+        self.send_response(self.server.status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def mail_sink(app):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SinkHandler)
+    server.received = []
+    server.status = 202
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    app.config.update(
+        SENDGRID_API_HOST='http://127.0.0.1:{}'.format(server.server_port),
+        SENDGRID_API_KEY='test-key'
+    )
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
@@ -1,5 +1,7 @@
+import time
+
 from app import db
-from app.models import User
+from app.models import User, File
 
 from tests.conftest import create_user, add_user_to_db
 
@@ -251,6 +253,145 @@ def test_delete_user(client, s3_fixture):
     assert b'User deleted' in delete_rv.data
 
 
+def test_delete_user_purges_files(client, s3_fixture):
+    """Delete a User and purge every object under the User's folder"""
+    (s3_client, s3) = s3_fixture
+    s3_client.create_bucket(Bucket=TEST_S3_BUCKET)
+    username = "test"
+    password = "test123"
+
+    user = create_user(username, password)
+    add_user_to_db(user)
+    folder = user.folder
+    db.session.add(File(name='test.pdf', key=folder + '/test.pdf',
+                        author=user))
+    db.session.commit()
+
+    bucket = s3.Bucket(TEST_S3_BUCKET)
+    bucket.put_object(Key=folder + '/')
+    for i in range(25):
+        bucket.put_object(Key='{0}/file{1}.pdf'.format(folder, i),
+                          Body=b'test')
+    bucket.put_object(Key=folder + '2/keep.pdf', Body=b'test')
+
+    client.post('/login', data=dict(
+        username=username,
+        password=password
+    ), follow_redirects=True)
+
+    delete_rv = client.delete('/user/delete')
+    assert delete_rv.status_code == 200
+    job_id = delete_rv.get_json()['job']['id']
+
+    assert File.query.count() == 0
+    assert User.query.filter_by(username=username).first() is None
+
+    deadline = time.time() + 10
+    while True:
+        job = client.get('/user/delete/{}'.format(job_id)).get_json()['job']
+        if job['status'] in ('done', 'failed') or time.time() > deadline:
+            break
+        time.sleep(0.05)
+
+    assert job['status'] == 'done'
+    assert job['deleted'] == 26
+    assert job['failed'] == 0
+
+    remaining = [obj.key for obj in bucket.objects.all()]
+    assert remaining == [folder + '2/keep.pdf']
+
+    missing_job_rv = client.get('/user/delete/notajob')
+    assert missing_job_rv.status_code == 404
+
+
+def test_resume_purges(app, client, s3_fixture):
+    """Purges cut short by a restart are finished by the CLI command"""
+    from datetime import datetime, timedelta
+    from app.cli import register
+    from app.models import PurgeJob
+
+    (s3_client, s3) = s3_fixture
+    s3_client.create_bucket(Bucket=TEST_S3_BUCKET)
+    bucket = s3.Bucket(TEST_S3_BUCKET)
+    for folder in ('stale', 'queued', 'busy'):
+        bucket.put_object(Key=folder + '/file.pdf', Body=b'test')
+
+    long_ago = datetime.utcnow() - timedelta(hours=1)
+    db.session.add_all([
+        PurgeJob(id='stale', prefix='stale/', username='staleuser',
+                 status='running', updated_at=long_ago),
+        PurgeJob(id='queued', prefix='queued/', username='queueduser'),
+        PurgeJob(id='busy', prefix='busy/', username='busyuser',
+                 status='running'),
+    ])
+    db.session.commit()
+
+    # Usernames of accounts still being purged are not handed out
+    register_rv = client.post('/register', data=dict(
+        username='staleuser',
+        email='stale@email.com',
+        password1='ThisIsAValidPassword',
+        password2='ThisIsAValidPassword'
+    ))
+    assert register_rv.status_code == 400
+    assert b'not available yet' in register_rv.data
+
+    register(app)
+    result = app.test_cli_runner().invoke(args=['users', 'resume-purges'])
+    assert result.exit_code == 0, result.output
+    assert 'Purge of stale/ done, 1 deleted' in result.output
+    assert 'Purge of queued/ done, 1 deleted' in result.output
+
+    db.session.expire_all()
+    assert PurgeJob.query.get('busy').status == 'running'
+    assert [obj.key for obj in bucket.objects.all()] == ['busy/file.pdf']
+
+    register_rv = client.post('/register', data=dict(
+        username='staleuser',
+        email='stale@email.com',
+        password1='ThisIsAValidPassword',
+        password2='ThisIsAValidPassword'
+    ))
+    assert b'User added' in register_rv.data
+    user = User.query.filter_by(username='staleuser').first()
+    assert user.folder not in ('staleuser', 'stale')
+
+
+def test_purge_failed_keys_retried(app, s3_fixture, monkeypatch):
+    """Keys that fail to delete leave the purge failed until resumed"""
+    from app import storage
+    from app.auth.purge import run_purge
+    from app.models import PurgeJob
+
+    (s3_client, s3) = s3_fixture
+    s3_client.create_bucket(Bucket=TEST_S3_BUCKET)
+    bucket = s3.Bucket(TEST_S3_BUCKET)
+    for i in range(4):
+        bucket.put_object(Key='gone/file{}.pdf'.format(i), Body=b'test')
+    db.session.add(PurgeJob(id='partial', prefix='gone/',
+                            username='goneuser'))
+    db.session.commit()
+
+    backend = storage.backend
+    real_delete_many = backend.delete_many
+
+    def delete_many(keys):
+        # The backend reports an error for every other key
+        deleted, errors = real_delete_many(keys[::2])
+        errors.update((key, 'AccessDenied') for key in keys[1::2])
+        return deleted, errors
+
+    monkeypatch.setattr(backend, 'delete_many', delete_many)
+    job = run_purge(app, 'partial')
+    assert (job.status, job.deleted, job.failed) == ('failed', 2, 2)
+    assert len(list(bucket.objects.all())) == 2
+    monkeypatch.undo()
+
+    job = run_purge(app, 'partial')
+    assert (job.status, job.deleted, job.failed) == ('done', 4, 0)
+    assert list(bucket.objects.all()) == []
+
+
 def test_user_token(client):
     """Test verification of User JWT"""
     user = User(id=0)
@@ -270,3 +411,296 @@ def test_user_password():
 
     assert user.check_password('password')
     assert user.password_hash != 'password'
+
+
+def test_login_rehashes_password(client):
+    """Test hashes made with another cost are upgraded on login"""
+    from app import hasher
+    from app.hashing import hash_password, hash_rounds
+
+    username = "test"
+    password = "test123"
+
+    user = create_user(username, password)
+    user.password_hash = hash_password(password, 4)
+    add_user_to_db(user)
+
+    login_rv = client.post('/login', data=dict(
+        username=username,
+        password=password
+    ))
+    assert login_rv.status_code == 200
+
+    user = User.query.filter_by(username=username).first()
+    assert hash_rounds(user.password_hash) == hasher.rounds
+    assert user.check_password(password)
+
+
+def test_login_load_shedding(client, monkeypatch):
+    """Test logins are turned away when the hashing pool is full"""
+    from threading import BoundedSemaphore
+    from app import hasher
+
+    username = "test"
+    password = "test123"
+
+    add_user_to_db(create_user(username, password))
+
+    # Every slot of the pool is taken
+    monkeypatch.setattr(hasher, 'workers', 1)
+    hasher._get_pool()
+    slots = BoundedSemaphore(1)
+    slots.acquire()
+    monkeypatch.setattr(hasher, '_slots', slots)
+
+    busy_rv = client.post('/login', data=dict(
+        username=username,
+        password=password
+    ))
+    assert busy_rv.status_code == 503
+    assert busy_rv.headers['Retry-After'] == '1'
+
+    slots.release()
+    login_rv = client.post('/login', data=dict(
+        username=username,
+        password=password
+    ))
+    assert login_rv.status_code == 200
+
+
+def test_bearer_tokens(client):
+    """Test issuing, using, refreshing and revoking bearer tokens"""
+    username = "test"
+    password = "test123"
+
+    add_user_to_db(create_user(username, password))
+
+    bad_rv = client.post('/token', data=dict(
+        username=username,
+        password='wrong'
+    ))
+    assert bad_rv.status_code == 400
+
+    token_rv = client.post('/token', data=dict(
+        username=username,
+        password=password
+    ))
+    assert token_rv.status_code == 200
+    tokens = token_rv.get_json()
+    assert tokens['token_type'] == 'Bearer'
+    headers = {'Authorization': 'Bearer ' + tokens['access_token']}
+
+    files_rv = client.get('/files', headers=headers)
+    assert files_rv.status_code == 200
+
+    # A refresh token is not an access token
+    refresh_headers = {'Authorization': 'Bearer ' + tokens['refresh_token']}
+    assert client.get('/files', headers=refresh_headers).status_code == 401
+
+    refresh_rv = client.post('/token/refresh', data=dict(
+        refresh_token=tokens['refresh_token']
+    ))
+    assert refresh_rv.status_code == 200
+    new_tokens = refresh_rv.get_json()
+
+    # The old refresh token can only be used once
+    reuse_rv = client.post('/token/refresh', data=dict(
+        refresh_token=tokens['refresh_token']
+    ))
+    assert reuse_rv.status_code == 401
+
+    revoke_rv = client.post('/token/revoke', headers=headers)
+    assert revoke_rv.status_code == 200
+    assert client.get('/files', headers=headers).status_code == 401
+
+    # Other processes pick up the revocation from the database
+    from app import revoked_tokens
+    revoked_tokens.init_app(None)
+    revoked_tokens.sync(force=True)
+    assert client.get('/files', headers=headers).status_code == 401
+
+    new_headers = {'Authorization': 'Bearer ' + new_tokens['access_token']}
+    assert client.get('/files', headers=new_headers).status_code == 200
+
+
+def test_revocation_committed_late(app):
+    """Test a revocation committed after a higher id is still loaded"""
+    from datetime import datetime, timedelta
+    from unittest import mock
+    from app import revoked_tokens
+    from app.models import RevokedToken
+
+    def claims(jti):
+        return {'jti': jti, 'sub': 1, 'iat': 0}
+
+    expires_at = datetime.utcnow() + timedelta(hours=1)
+    revoked_tokens.init_app(app)
+    with mock.patch('app.tokens.time', return_value=1000):
+        db.session.add(RevokedToken(id=2, jti='b' * 32,
+                                    expires_at=expires_at))
+        db.session.commit()
+        revoked_tokens.sync(force=True)
+        assert revoked_tokens.is_revoked(claims('b' * 32))
+
+    # Id 1 was handed out first but committed after the last sync
+    with mock.patch('app.tokens.time', return_value=1010):
+        db.session.add(RevokedToken(id=1, jti='a' * 32,
+                                    expires_at=expires_at))
+        db.session.commit()
+        revoked_tokens.sync(force=True)
+        assert revoked_tokens.is_revoked(claims('a' * 32))
+
+    # Past the margin only ids above those loaded back then are read
+    margin = app.config['TOKEN_REVOCATION_SYNC_MARGIN']
+    with mock.patch('app.tokens.time', return_value=1010 + margin):
+        revoked_tokens.sync(force=True)
+    assert revoked_tokens._last_ids[0] == (1010, 2)
+    revoked_tokens.init_app(app)
+
+
+def test_bearer_tokens_of_deleted_user(client, s3_fixture):
+    """Test tokens stop working once their User is deleted"""
+    s3_client = s3_fixture[0]
+    s3_client.create_bucket(Bucket=TEST_S3_BUCKET)
+    username = "test"
+    password = "test123"
+
+    add_user_to_db(create_user(username, password))
+
+    tokens = client.post('/token', data=dict(
+        username=username,
+        password=password
+    )).get_json()
+    headers = {'Authorization': 'Bearer ' + tokens['access_token']}
+
+    delete_rv = client.delete('/user/delete', headers=headers)
+    assert delete_rv.status_code == 200
+
+    assert client.get('/files', headers=headers).status_code == 401
+    refresh_rv = client.post('/token/refresh', data=dict(
+        refresh_token=tokens['refresh_token']
+    ))
+    assert refresh_rv.status_code == 401
+
+    # A User removed by another process, which revoked nothing here
+    add_user_to_db(create_user(username, password))
+    tokens = client.post('/token', data=dict(
+        username=username,
+        password=password
+    )).get_json()
+    headers = {'Authorization': 'Bearer ' + tokens['access_token']}
+    db.session.execute(User.__table__.delete())
+    db.session.commit()
+    assert client.get('/files', headers=headers).status_code == 401
+
+
+def test_bearer_token_skips_session(app, client):
+    """Test a bearer request is never authenticated by its cookies"""
+    username = "test"
+    password = "test123"
+
+    add_user_to_db(create_user(username, password))
+
+    app.config['WTF_CSRF_ENABLED'] = True
+    client.post('/login', data=dict(
+        username=username,
+        password=password
+    ))
+    assert client.get('/files').status_code == 200
+    # Cookie requests still need the CSRF token
+    assert client.delete('/user/delete').status_code == 400
+
+    # CSRF is not checked for bearer requests, so neither is the session
+    headers = {'Authorization': 'Bearer bogus'}
+    assert client.get('/files', headers=headers).status_code == 401
+    assert client.delete('/user/delete', headers=headers).status_code == 401
+
+    tokens = client.post('/token', data=dict(
+        username=username,
+        password=password
+    )).get_json()
+    headers = {'Authorization': 'Bearer ' + tokens['access_token']}
+    assert client.get('/files', headers=headers).status_code == 200
+    # Bearer requests leave the session cookie alone
+    assert client.get('/files').status_code == 200
+
+
+def test_import_users(app, s3_fixture, tmp_path, mail_sink):
+    """Test bulk importing Users from CSV and resuming an import"""
+    from app.cli import register
+    from app.models import OutboxEmail
+
+    (s3_client, s3) = s3_fixture
+    s3_client.create_bucket(Bucket=TEST_S3_BUCKET)
+    add_user_to_db(create_user('existing1', 'ThisIsAValidPassword'))
+
+    source = tmp_path / 'users.csv'
+    source.write_text(
+        'username,email,password,verified\n'
+        'skipped01,skipped@email.com,ThisIsAValidPassword,\n'
+        'imported1,imported1@email.com,ThisIsAValidPassword,\n'
+        'imported2,imported2@email.com,ThisIsAValidPassword,true\n'
+        'existing1,other@email.com,ThisIsAValidPassword,\n'
+        'short,short@email.com,ThisIsAValidPassword,\n'
+    )
+    # An earlier run got through the first row
+    (tmp_path / 'users.csv.checkpoint').write_text('1')
+
+    register(app)
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['users', 'import', str(source),
+                                 '--workers', '0', '--chunk-size', '2'])
+    assert result.exit_code == 0, result.output
+    assert 'Created 2 users, 1 already existed, 1 invalid' in result.output
+    assert 'Tried 1 emails' in result.output
+    assert not (tmp_path / 'users.csv.checkpoint').exists()
+
+    assert User.query.filter_by(username='skipped01').first() is None
+    imported = User.query.filter_by(username='imported1').first()
+    assert imported.check_password('ThisIsAValidPassword')
+    assert not imported.is_verified
+    assert User.query.filter_by(username='imported2').first().is_verified
+    # The verification email is sent before the command exits
+    assert [(email.to_email, email.status)
+            for email in OutboxEmail.query.all()] == \
+        [('imported1@email.com', 'sent')]
+    assert len(mail_sink.received) == 1
+    keys = [obj.key for obj in s3.Bucket(TEST_S3_BUCKET).objects.all()]
+    assert sorted(keys) == sorted(
+        user.folder + '/' for user in User.query.filter(
+            User.username.in_(['imported1', 'imported2'])))
+
+    # Running it again creates nothing twice
+    result = runner.invoke(args=['users', 'import', str(source),
+                                 '--workers', '0'])
+    assert 'Created 1 users, 3 already existed, 1 invalid' in result.output
+
+
+def test_import_users_malformed_ndjson(app, s3_fixture, tmp_path):
+    """Test malformed NDJSON lines are reported and skipped"""
+    from app.cli import register
+
+    (s3_client, s3) = s3_fixture
+    s3_client.create_bucket(Bucket=TEST_S3_BUCKET)
+
+    source = tmp_path / 'users.ndjson'
+    source.write_text(
+        '{"username": "imported1", "email": "imported1@email.com", '
+        '"password": "ThisIsAValidPassword", "verified": true}\n'
+        '\n'
+        '{"username": "broken1", "email": \n'
+        '["not", "an", "object"]\n'
+        '{"username": "imported2", "email": "imported2@email.com", '
+        '"password": "ThisIsAValidPassword", "verified": true}\n'
+    )
+
+    register(app)
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['users', 'import', str(source),
+                                 '--workers', '0', '--chunk-size', '2'])
+    assert result.exit_code == 0, result.output
+    assert 'Created 2 users, 0 already existed, 2 invalid' in result.output
+    assert 'Row 2: line 3 is not valid JSON' in result.output
+    assert 'Row 3: line 4 is not a JSON object' in result.output
+    assert User.query.filter(
+        User.username.in_(['imported1', 'imported2'])).count() == 2
@@ -0,0 +1,245 @@
+import time
+import threading
+from unittest import mock
+
+from app import db
+from app.cache import LRUCache, PresignedUrlCache
+from app.storage.s3 import S3Backend
+from app.models import File
+
+TEST_S3_BUCKET = 'somebucket'
+
+
+def test_lru_cache_eviction():
+    """Test least recently used entries are evicted first"""
+    cache = LRUCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+
+
+def test_lru_cache_expiry():
+    """Test expired entries are not returned"""
+    cache = LRUCache()
+    with mock.patch('app.cache.time', return_value=100):
+        cache.set('a', 1, expires_at=110)
+        assert cache.get('a') == 1
+
+    with mock.patch('app.cache.time', return_value=110):
+        assert cache.get('a') is None
+        assert len(cache) == 0
+
+
+def test_presigned_url_reuse(app, s3_fixture):
+    """Test presigned URLs are reused until close to expiring"""
+    backend = S3Backend(TEST_S3_BUCKET)
+    app.config.update(PRESIGNED_URL_EXPIRES=3600, PRESIGNED_URL_MIN_TTL=600)
+    cache = PresignedUrlCache(app)
+
+    with mock.patch('app.cache.time', return_value=1000):
+        url = cache.get_url(backend, 'user/test.pdf')
+        assert cache.get_url(backend, 'user/test.pdf') == url
+
+    # Past EXPIRES - MIN_TTL a fresh URL is signed
+    with mock.patch('app.cache.time', return_value=1000 + 3000), \
+            mock.patch.object(backend, 'presign', return_value='new-url'):
+        assert cache.get_url(backend, 'user/test.pdf') == 'new-url'
+
+
+def test_presigned_url_invalidate(app, s3_fixture):
+    """Test invalidated keys are signed again"""
+    backend = S3Backend(TEST_S3_BUCKET)
+    cache = PresignedUrlCache(app)
+
+    cache.get_url(backend, 'user/test.pdf')
+    cache.invalidate(backend, 'user/test.pdf')
+
+    with mock.patch.object(backend, 'presign',
+                           return_value='new-url') as generate:
+        assert cache.get_url(backend, 'user/test.pdf') == 'new-url'
+        generate.assert_called_once()
+
+
+def test_object_cache(app, client, s3_fixture, tmp_path):
+    from app import object_cache, storage
+    from tests.conftest import create_user, add_user_to_db
+    from tests.test_s3 import create_file, add_file_to_db
+
+    (s3_client, s3) = s3_fixture
+    s3_client.create_bucket(Bucket=TEST_S3_BUCKET)
+    app.config.update(DISK_CACHE_DIR=str(tmp_path),
+                      DISK_CACHE_MAX_BYTES=1000,
+                      DISK_CACHE_MAX_OBJECT_SIZE=500)
+    object_cache.init_app(app)
+
+    user = create_user('testuser', 'testpass')
+    user.id = 0
+    add_user_to_db(user)
+
+    bodies = [b'a' * 400, b'b' * 400, b'c' * 400]
+    for file_id, body in enumerate(bodies):
+        file = create_file(name='test{}.pdf'.format(file_id), id=file_id,
+                           username='testuser', user_id=0)
+        s3.Bucket(TEST_S3_BUCKET).put_object(Key=file.key, Body=body)
+        file.set_metadata(storage.head(file.key))
+        add_file_to_db(file)
+
+    client.post('/login', data=dict(username='testuser', password='testpass'))
+
+    # A miss waits for the thread caching the object at most
+    # DISK_CACHE_FILL_TIMEOUT, then reads it from storage
+    concurrent = []
+    backend = storage.backend
+    real_get_object = backend.client.get_object
+    file = File.query.get(0)
+    object_cache.fill_timeout = 0.01
+
+    def get_object(**kwargs):
+        concurrent.append(object_cache.open(backend, file.key, file.etag,
+                                            file.size))
+        return real_get_object(**kwargs)
+
+    with mock.patch.object(backend.client, 'get_object', get_object):
+        object_cache.open(backend, file.key, file.etag, file.size).close()
+    assert concurrent == [None]
+    assert object_cache.stats()['misses'] == 2
+
+    for path in tmp_path.iterdir():
+        path.unlink()
+    object_cache.init_app(app)
+    object_cache.hits = object_cache.misses = 0
+
+    # Concurrent misses share a single fetch
+    calls = []
+    results = []
+    start = threading.Barrier(4)
+
+    def get_object(**kwargs):
+        calls.append(kwargs['Key'])
+        time.sleep(0.2)
+        return real_get_object(**kwargs)
+
+    def read():
+        start.wait()
+        data = object_cache.open(backend, file.key, file.etag, file.size)
+        results.append(bytes(data))
+        data.close()
+
+    threads = [threading.Thread(target=read) for _ in range(4)]
+    with mock.patch.object(backend.client, 'get_object', get_object):
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert calls == [file.key]
+    assert results == [bodies[0]] * 4
+    stats = object_cache.stats()
+    assert stats['misses'] == 1
+    assert stats['hits'] == 3
+
+    # Hits are served without touching S3
+    with mock.patch.object(backend.client, 'get_object',
+                           side_effect=AssertionError('unexpected')):
+        full_rv = client.get('/files/0/download')
+        assert full_rv.status_code == 200
+        assert full_rv.data == bodies[0]
+
+        range_rv = client.get('/files/0/download',
+                              headers={'Range': 'bytes=0-9'})
+        assert range_rv.status_code == 206
+        assert range_rv.data == bodies[0][:10]
+        assert range_rv.headers['Content-Range'] == 'bytes 0-9/400'
+
+        not_modified_rv = client.get(
+            '/files/0/download',
+            headers={'If-None-Match': full_rv.headers['ETag']})
+        assert not_modified_rv.status_code == 304
+
+    # A ranged read of an uncached object does not cache it
+    range_rv = client.get('/files/1/download',
+                          headers={'Range': 'bytes=0-9'})
+    assert range_rv.status_code == 206
+    assert range_rv.data == bodies[1][:10]
+    assert len(list(tmp_path.iterdir())) == 1
+
+    # Filling past the size budget evicts the least recently used
+    assert client.get('/files/1/download').data == bodies[1]
+    assert client.get('/files/2/download').data == bodies[2]
+    stats = object_cache.stats()
+    assert stats['evictions'] == 1
+    assert stats['bytes'] <= 1000
+    assert len(list(tmp_path.iterdir())) == 2
+
+    # A changed ETag is a miss
+    s3.Bucket(TEST_S3_BUCKET).put_object(Key=file.key, Body=b'new')
+    file.set_metadata(storage.head(file.key))
+    db.session.commit()
+    assert client.get('/files/0/download').data == b'new'
+
+    # A full disk falls back to reading from storage
+    s3.Bucket(TEST_S3_BUCKET).put_object(Key=file.key, Body=b'newer')
+    file.set_metadata(storage.head(file.key))
+    db.session.commit()
+    with mock.patch('app.cache.os.replace',
+                    side_effect=OSError(28, 'No space left on device')):
+        rv = client.get('/files/0/download')
+    assert rv.status_code == 200
+    assert rv.data == b'newer'
+    assert not any(path.name.startswith('tmp')
+                   for path in tmp_path.iterdir())
+
+    app.config.update(DISK_CACHE_DIR=None)
+    object_cache.init_app(app)
+
+
+def test_user_cache(app, client):
+    from sqlalchemy import event
+    from app import user_cache
+    from app.models import User
+    from tests.conftest import create_user, add_user_to_db
+
+    add_user_to_db(create_user('testuser', 'testpass'))
+    client.post('/login', data=dict(username='testuser', password='testpass'))
+
+    user_queries = []
+
+    def count_user_queries(conn, cursor, statement, *args):
+        if 'FROM user' in statement:
+            user_queries.append(statement)
+
+    engine = db.get_engine()
+    event.listen(engine, 'before_cursor_execute', count_user_queries)
+    try:
+        for _ in range(3):
+            assert client.get('/').status_code == 200
+            db.session.remove()
+    finally:
+        event.remove(engine, 'before_cursor_execute', count_user_queries)
+
+    # Only the first request loads the user from the database
+    assert len(user_queries) == 1
+    stats = user_cache.stats()
+    assert stats['hits'] == 2
+    assert stats['hit_rate'] == 2 / 3
+
+    # Changes to the user drop the cached copy
+    user = User.query.filter_by(username='testuser').first()
+    user.email = 'new@justfiles.com'
+    db.session.commit()
+    assert user_cache.stats()['entries'] == 0
+    db.session.remove()
+
+    assert client.get('/').status_code == 200
+    assert user_cache.stats()['entries'] == 1
+    db.session.remove()
+
+    db.session.delete(User.query.filter_by(username='testuser').first())
+    db.session.commit()
+    assert user_cache.stats()['entries'] == 0
+    assert client.get('/').status_code == 302
@@ -0,0 +1,83 @@
+from app.metrics import metrics, timed, _local
+
+from tests.conftest import create_user, add_user_to_db
+
+
+def test_metrics(app, client, monkeypatch):
+    """Test requests are timed and broken down into spans"""
+    monkeypatch.setattr(metrics, 'enabled', True)
+    app.config.update(SERVER_TIMING=True, METRICS_TOKEN='scraper')
+    username = "test"
+    password = "test123"
+
+    add_user_to_db(create_user(username, password))
+
+    login_rv = client.post('/login', data=dict(
+        username=username,
+        password=password
+    ))
+    assert 'hashing;dur=' in login_rv.headers['Server-Timing']
+
+    files_rv = client.get('/files')
+    assert files_rv.status_code == 200
+    assert 'db;dur=' in files_rv.headers['Server-Timing']
+
+    assert client.get('/metrics').status_code == 401
+    metrics_rv = client.get('/metrics', headers={
+        'Authorization': 'Bearer scraper'})
+    assert metrics_rv.status_code == 200
+    assert metrics_rv.mimetype == 'text/plain'
+    text = metrics_rv.get_data(as_text=True)
+    assert 'http_request_duration_seconds_count' \
+        '{endpoint="auth.files",method="GET"} 1' in text
+    assert 'http_requests_total' \
+        '{endpoint="auth.login",method="POST",status="200"} 1' in text
+    assert 'http_request_span_seconds_count' \
+        '{endpoint="auth.login",span="hashing"} 1' in text
+    assert 'span_duration_seconds_count' \
+        '{operation="verify",span="hashing"} 1' in text
+    assert 'span_duration_seconds_bucket' \
+        '{le="+Inf",operation="SELECT",span="db"}' in text
+    assert 'cache_entries{cache="user"}' in text
+
+    # The breakdown stays on the server unless SERVER_TIMING is set
+    app.config['SERVER_TIMING'] = False
+    assert 'Server-Timing' not in client.get('/files').headers
+
+
+def test_metrics_disabled(client):
+    """Test nothing is recorded or served when metrics are off"""
+    assert not metrics.enabled
+
+    files_rv = client.get('/files')
+    assert 'Server-Timing' not in files_rv.headers
+    assert 'endpoint="auth.files"' not in metrics.render()
+    assert client.get('/metrics').status_code == 404
+
+
+def test_timed_nested_spans(monkeypatch):
+    """Test an outer span keeps its guard after an inner span"""
+    monkeypatch.setattr(metrics, 'enabled', True)
+    seen = []
+
+    @timed('storage')
+    def put():
+        seen.append(getattr(_local, 'span', None))
+
+    @timed('hashing')
+    def verify():
+        put()
+        seen.append(getattr(_local, 'span', None))
+        # Not recorded twice
+        verify_again()
+
+    @timed('hashing')
+    def verify_again():
+        seen.append(getattr(_local, 'span', None))
+
+    verify()
+    assert seen == ['storage', 'hashing', 'hashing']
+    assert getattr(_local, 'span', None) is None
+    spans = metrics._spans
+    assert ('hashing', 'verify') in spans
+    assert ('hashing', 'verify_again') not in spans
@@ -0,0 +1,76 @@
+from datetime import datetime
+
+from app import db
+from app.auth.email import outbox
+from app.models import OutboxEmail
+
+
+def test_outbox_coalesces_and_sends(app, mail_sink):
+    """Test repeated emails are coalesced and sent once"""
+    outbox.queue('welcome@justfiles.com', 'Verify', 'test@email.com',
+                 'first token', 'verify')
+    db.session.commit()
+    outbox.queue('welcome@justfiles.com', 'Verify', 'test@email.com',
+                 'second token', 'verify')
+    outbox.queue('welcome@justfiles.com', 'Verify', 'other@email.com',
+                 'other token', 'verify')
+    db.session.commit()
+
+    assert OutboxEmail.query.count() == 2
+    assert outbox.drain() == 2
+    assert outbox.drain() == 0
+
+    assert len(mail_sink.received) == 2
+    request = mail_sink.received[0]
+    assert request['path'] == '/v3/mail/send'
+    assert request['auth'] == 'Bearer test-key'
+    assert request['body']['content'][0]['value'] == 'second token'
+
+    # Already sent within the window, so it is not sent again
+    outbox.queue('welcome@justfiles.com', 'Verify', 'test@email.com',
+                 'third token', 'verify')
+    db.session.commit()
+    assert outbox.drain() == 0
+    assert {email.status for email in OutboxEmail.query} == {'sent'}
+
+
+def test_outbox_retries_with_backoff(app, mail_sink):
+    """Test failed emails are retried later and eventually given up"""
+    app.config.update(OUTBOX_MAX_ATTEMPTS=2, OUTBOX_RETRY_BACKOFF=30)
+    mail_sink.status = 500
+
+    email = outbox.queue('welcome@justfiles.com', 'Verify',
+                         'test@email.com', 'token', 'verify')
+    db.session.commit()
+
+    assert outbox.drain() == 1
+    assert email.status == 'pending'
+    assert email.attempts == 1
+    assert email.next_attempt_at > datetime.utcnow()
+
+    # Not due yet
+    assert outbox.drain() == 0
+
+    email.next_attempt_at = datetime.utcnow()
+    db.session.commit()
+    assert outbox.drain() == 1
+    assert email.status == 'failed'
+    assert email.attempts == 2
+    assert len(mail_sink.received) == 2
+
+
+def test_register_queues_email(client, s3_fixture):
+    """Test registering queues the verification email"""
+    s3_fixture[0].create_bucket(Bucket='somebucket')
+
+    client.post('/register', data=dict(
+        username='test1234',
+        email='test@email.com',
+        password1='ThisIsAValidPassword',
+        password2='ThisIsAValidPassword'
+    ))
+
+    email = OutboxEmail.query.one()
+    assert email.to_email == 'test@email.com'
+    assert email.kind == 'verify'
+    assert email.status == 'pending'
@@ -0,0 +1,119 @@
+import io
+import logging
+
+import pytest
+
+from app import storage
+from app.models import File
+from app.metrics import metrics
+from app.queries import queries
+
+from tests.conftest import create_user, add_user_to_db, assert_max_queries
+
+
+@pytest.fixture
+def local_storage(app, tmp_path):
+    app.config.update(STORAGE_BACKEND='local',
+                      LOCAL_STORAGE_ROOT=str(tmp_path))
+    app.extensions['storage'] = None
+    yield storage.backend
+    app.extensions['storage'] = None
+
+
+def upload(client, name):
+    return client.post('/files', data=dict(
+        text='This is a file',
+        date='2020-01-01',
+        file=(io.BytesIO(b'this is a test'), name)
+    ))
+
+
+def test_endpoint_query_counts(client, local_storage):
+    """Test the file endpoints run a bounded number of queries"""
+    username = 'testuser'
+    password = 'testpass'
+
+    add_user_to_db(create_user(username, password))
+    client.post('/login', data=dict(
+        username=username,
+        password=password
+    ))
+
+    for number in range(20):
+        assert upload(client, 'test{}.pdf'.format(number)).status_code == 200
+    file_id = File.query.first().id
+
+    # Loading the user when it is not cached adds one query
+    with assert_max_queries(5):
+        assert upload(client, 'last.pdf').status_code == 200
+    with assert_max_queries(2) as log:
+        rv = client.get('/files')
+    assert len(rv.get_json()['files']) == 21
+    assert log.repeated(2) == []
+    with assert_max_queries(2):
+        assert client.get('/files/{}'.format(file_id)).status_code == 200
+    with assert_max_queries(4):
+        assert client.patch('/files/{}/edit'.format(file_id),
+                            data={'body': 'edited'}).status_code == 200
+    with assert_max_queries(3):
+        assert client.delete(
+            '/files/{}/delete'.format(file_id)).status_code == 200
+
+
+def test_repeated_and_slow_queries_logged(app, client, caplog, monkeypatch):
+    """Test N+1 statements and slow statements are logged"""
+    def lookups():
+        for file_id in range(5):
+            File.query.get(file_id)
+        File.query.filter(File.id.in_([1, 2, 3])).all()
+        File.query.filter(File.id.in_([1, 2])).all()
+        return 'done'
+
+    app.add_url_rule('/lookups', 'lookups', lookups)
+    monkeypatch.setattr(metrics, 'enabled', True)
+    monkeypatch.setattr(queries, 'repeat_threshold', 5)
+    monkeypatch.setattr(queries, 'slow_seconds', 0)
+
+    with caplog.at_level(logging.WARNING):
+        assert client.get('/lookups').status_code == 200
+
+    repeated = [record.getMessage() for record in caplog.records
+                if 'N+1' in record.getMessage()]
+    assert len(repeated) == 1
+    assert 'GET /lookups ran 5 times' in repeated[0]
+    assert 'WHERE file.id = ?' in repeated[0]
+    slow = [record.getMessage() for record in caplog.records
+            if record.getMessage().startswith('Slow query')]
+    # Parameter values are never logged, only their types
+    assert any('IN (?, ?, ?)' in message and '(int, int, int)' in message
+               for message in slow)
+    assert not any('1, 2, 3' in message for message in slow)
+
+    text = client.get('/metrics').get_data(as_text=True)
+    assert 'http_request_queries_total{endpoint="lookups"} 7' in text
+
+
+def test_batch_upload_query_count(app, client, local_storage):
+    """Test a batch upload runs a bounded number of queries"""
+    add_user_to_db(create_user('testuser', 'testpass'))
+    client.post('/login', data=dict(
+        username='testuser',
+        password='testpass'
+    ))
+
+    # Loading the user, checking the names, inserting the rows and
+    # loading them after the commit, with content addressing also
+    # finding, claiming and creating the blobs
+    for content_addressed, limit in ((False, 6), (True, 11)):
+        app.config['S3_CONTENT_ADDRESSED'] = content_addressed
+        with assert_max_queries(limit) as log:
+            rv = client.post('/files/batch', data=dict(
+                text='Receipt',
+                date='today',
+                file=[(io.BytesIO(b'same' if number % 2 else b'other'),
+                       '{0}{1}.pdf'.format(content_addressed, number))
+                      for number in range(30)]
+            ))
+        assert all(result['uploaded']
+                   for result in rv.get_json()['files'])
+        assert log.repeated(3) == []
@@ -1,7 +1,8 @@
 import io
 
-from app import db
+from app import db, storage
 from app.models import User, File
+from app.storage import StorageError
 
 from tests.conftest import create_user, add_user_to_db
 
@@ -290,3 +291,752 @@ def test_delete_file_by_id(client, s3_fixture):
     delete_file_rv = client.delete('/files/{}/delete'.format(file_id))
     assert delete_file_rv.status_code == 200
     assert b'File removed' in delete_file_rv.data
+
+
+def test_upload_large_file_multipart(app, client, s3_fixture):
+    username = 'testuser'
+    password = 'testpass'
+    file_name = 'large.pdf'
+    file_size = 11 * 1024 * 1024
+
+    (s3_client, s3) = s3_fixture
+    s3_client.create_bucket(Bucket=TEST_S3_BUCKET)
+
+    app.config.update(
+        S3_MULTIPART_THRESHOLD=5 * 1024 * 1024,
+        S3_MULTIPART_CHUNKSIZE=5 * 1024 * 1024
+    )
+
+    user = create_user(username, password)
+    add_user_to_db(user)
+
+    client.post('/login', data=dict(
+        username=username,
+        password=password
+    ))
+
+    post_file_rv = client.post(
+        '/files',
+        data=dict(
+            text="This is a large file",
+            date="some date",
+            file=(io.BytesIO(b'x' * file_size), file_name)
+        ))
+    assert post_file_rv.status_code == 200
+
+    head = s3_client.head_object(
+        Bucket=TEST_S3_BUCKET,
+        Key=File.query.filter_by(name=file_name).first().key
+    )
+    assert head['ContentLength'] == file_size
+    # Multipart uploads have an ETag suffixed with the part count
+    assert head['ETag'].strip('"').endswith('-3')
+
+    uploads = s3_client.list_multipart_uploads(Bucket=TEST_S3_BUCKET)
+    assert not uploads.get('Uploads')
+
+
+def test_file_metadata(app, client, s3_fixture, monkeypatch):
+    username = 'testuser'
+    password = 'testpass'
+    file_name = 'test.pdf'
+    file_body = b'this is a test'
+
+    (s3_client, s3) = s3_fixture
+    s3_client.create_bucket(Bucket=TEST_S3_BUCKET)
+
+    add_user_to_db(create_user(username, password))
+
+    client.post('/login', data=dict(
+        username=username,
+        password=password
+    ))
+
+    client.post(
+        '/files',
+        data=dict(
+            text="This is a file",
+            date="some date",
+            file=(io.BytesIO(file_body), file_name, 'application/pdf')
+        ))
+
+    file = File.query.filter_by(name=file_name).first()
+    assert file.size == len(file_body)
+    assert file.etag
+    assert file.content_type == 'application/pdf'
+    assert file.uploaded_at is not None
+
+    # Viewing a file with stored metadata must not touch S3 objects
+
+    def fail(*args, **kwargs):
+        raise AssertionError('unexpected S3 call')
+
+    monkeypatch.setattr(storage.backend.client, 'get_object', fail)
+    monkeypatch.setattr(storage.backend.client, 'head_object', fail)
+
+    valid_get_rv = client.get('/files/{}'.format(file.id))
+    assert valid_get_rv.status_code == 200
+    assert valid_get_rv.get_json()['file']['size'] == len(file_body)
+
+    # A failed backfill still serves the file
+    def unavailable(key):
+        raise StorageError('Service unavailable')
+
+    file.size = None
+    db.session.commit()
+    monkeypatch.setattr(storage, 'head', unavailable)
+    rv = client.get('/files/{}'.format(file.id))
+    assert rv.status_code == 200
+    assert rv.get_json()['file']['size'] is None
+
+
+def test_backfill_file_metadata(app, s3_fixture):
+    from app.cli import register
+
+    username = 'testuser'
+    user_id = 0
+
+    (s3_client, s3) = s3_fixture
+    s3_client.create_bucket(Bucket=TEST_S3_BUCKET)
+
+    user = create_user(username, 'testpass')
+    user.id = user_id
+    add_user_to_db(user)
+
+    file = create_file(name='test.pdf', id=0,
+                       username=username, user_id=user_id)
+    missing_file = create_file(name='test2.pdf', id=1,
+                               username=username, user_id=user_id)
+    add_file_to_db(file)
+    add_file_to_db(missing_file)
+
+    s3.Bucket(TEST_S3_BUCKET).put_object(
+        Key=file.key,
+        Body=io.BytesIO(b'this is a test')
+    )
+
+    register(app)
+    result = app.test_cli_runner().invoke(args=['files', 'backfill'])
+    assert 'Backfilled 1 files, 1 missing from storage' in result.output
+
+    assert File.query.get(0).size == len(b'this is a test')
+    assert File.query.get(1).size is None
+
+
+def test_list_files_paginated(client):
+    username = 'testuser'
+    user_id = 0
+    password = 'testpass'
+
+    user = create_user(username, password)
+    user.id = user_id
+    add_user_to_db(user)
+
+    names = ['c.pdf', 'a.pdf', 'e.pdf', 'b.pdf', 'd.pdf']
+    for file_id, name in enumerate(names):
+        file = create_file(name=name, id=file_id,
+                           username=username, user_id=user_id)
+        file.date = '2020-01-0{}'.format(5 - file_id)
+        add_file_to_db(file)
+
+    client.post('/login', data=dict(
+        username=username,
+        password=password
+    ))
+
+    # Newest first by default
+    first_page = client.get('/files?limit=2').get_json()
+    assert [f['id'] for f in first_page['files']] == [4, 3]
+
+    second_page = client.get(
+        '/files?limit=2&cursor={}'.format(first_page['next'])).get_json()
+    assert [f['id'] for f in second_page['files']] == [2, 1]
+
+    last_page = client.get(
+        '/files?limit=2&cursor={}'.format(second_page['next'])).get_json()
+    assert [f['id'] for f in last_page['files']] == [0]
+    assert last_page['next'] is None
+
+    # Walk every page sorted by name
+    seen = []
+    cursor = ''
+    while cursor is not None:
+        page = client.get('/files?sort=name&order=asc&limit=2&cursor={}'
+                          .format(cursor)).get_json()
+        seen.extend(f['name'] for f in page['files'])
+        cursor = page['next']
+    assert seen == sorted(names)
+
+    by_date = client.get('/files?sort=date&order=asc').get_json()
+    assert [f['id'] for f in by_date['files']] == [4, 3, 2, 1, 0]
+
+    invalid_sort_rv = client.get('/files?sort=size')
+    assert invalid_sort_rv.status_code == 400
+
+    invalid_cursor_rv = client.get('/files?cursor=notacursor')
+    assert invalid_cursor_rv.status_code == 400
+    assert b'Invalid cursor' in invalid_cursor_rv.data
+
+
+def test_upload_duplicate_name_race(client, s3_fixture, monkeypatch):
+    username = 'testuser'
+    user_id = 0
+    password = 'testpass'
+    file_name = 'test.pdf'
+
+    (s3_client, s3) = s3_fixture
+    s3_client.create_bucket(Bucket=TEST_S3_BUCKET)
+
+    user = create_user(username, password)
+    user.id = user_id
+    add_user_to_db(user)
+    add_file_to_db(create_file(name=file_name, username=username,
+                               user_id=user_id))
+
+    client.post('/login', data=dict(
+        username=username,
+        password=password
+    ))
+
+    # A concurrent upload passes the existence check before
+    # the other row is committed, the unique index catches it
+    monkeypatch.setattr(File, 'name_exists',
+                        staticmethod(lambda user_id, name: False))
+
+    file_exists_rv = client.post(
+        '/files',
+        data=dict(
+            text="This is a file",
+            date="some date",
+            file=(io.BytesIO(b'this is a test'), file_name)
+        ))
+    assert file_exists_rv.status_code == 400
+    assert b'You already have a file with that name' in file_exists_rv.data
+
+    objects = s3_client.list_objects_v2(Bucket=TEST_S3_BUCKET)
+    assert 'Contents' not in objects
+
+
+def test_upload_files_batch(app, client, s3_fixture, monkeypatch):
+    username = 'testuser'
+    user_id = 0
+    password = 'testpass'
+
+    (s3_client, s3) = s3_fixture
+    s3_client.create_bucket(Bucket=TEST_S3_BUCKET)
+
+    user = create_user(username, password)
+    user.id = user_id
+    add_user_to_db(user)
+    add_file_to_db(create_file(name='old.pdf', username=username,
+                               user_id=user_id))
+
+    client.post('/login', data=dict(
+        username=username,
+        password=password
+    ))
+
+    missing_form_rv = client.post('/files/batch', data=dict(date='today'))
+    assert missing_form_rv.status_code == 400
+
+    commits = []
+    real_commit = db.session.commit
+    monkeypatch.setattr(db.session, 'commit',
+                        lambda: commits.append(1) or real_commit())
+
+    batch_rv = client.post('/files/batch', data=dict(
+        text='Receipt',
+        date='today',
+        file=[(io.BytesIO(b'first'), 'one.pdf', 'application/pdf'),
+              (io.BytesIO(b'second'), 'two.pdf', 'application/pdf'),
+              (io.BytesIO(b'third'), 'old.pdf'),
+              (io.BytesIO(b'fourth'), 'one.pdf'),
+              (io.BytesIO(b'fifth'), 'five.txt')]
+    ))
+    assert batch_rv.status_code == 200
+    results = batch_rv.get_json()['files']
+    assert [result['uploaded'] for result in results] == \
+        [True, True, False, False, False]
+    assert b'already have a file' in batch_rv.data
+    assert results[4]['msg'] == 'Invalid file type'
+    # One commit for the rows and one for the thumbnails
+    assert len(commits) == 2
+
+    file = File.query.get(results[1]['id'])
+    # Each upload has a key of its own in the user's folder
+    assert file.key.startswith(user.folder + '/')
+    assert file.key.endswith('/two.pdf')
+    assert file.size == len(b'second')
+    assert file.content_type == 'application/pdf'
+    body = s3_client.get_object(Bucket=TEST_S3_BUCKET, Key=file.key)['Body']
+    assert body.read() == b'second'
+
+    # Content addressed batches upload duplicate content once
+    app.config.update(S3_CONTENT_ADDRESSED=True)
+    batch_rv = client.post('/files/batch', data=dict(
+        text=['First copy', 'Second copy'],
+        date='today',
+        file=[(io.BytesIO(b'same'), 'copy1.pdf'),
+              (io.BytesIO(b'same'), 'copy2.pdf')]
+    ))
+    results = batch_rv.get_json()['files']
+    assert all(result['uploaded'] for result in results)
+    copies = File.query.filter(File.id.in_(
+        [result['id'] for result in results])).all()
+    assert {copy.body for copy in copies} == {'First copy', 'Second copy'}
+    assert copies[0].blob.refcount == 2
+    assert len([key for key in s3_client.list_objects_v2(
+        Bucket=TEST_S3_BUCKET)['Contents']
+        if key['Key'].startswith('blobs/')]) == 1
+
+
+def test_upload_outside_transaction(app, client, s3_fixture, monkeypatch):
+    """Test uploads hold no database lock and lose name races cleanly"""
+    import sqlite3
+    import threading
+    from tests.conftest import TEST_DB_PATH
+
+    (s3_client, s3) = s3_fixture
+    s3_client.create_bucket(Bucket=TEST_S3_BUCKET)
+    add_user_to_db(create_user('testuser', 'testpass'))
+    client.post('/login', data=dict(
+        username='testuser',
+        password='testpass'
+    ))
+    user_id = User.query.filter_by(username='testuser').first().id
+
+    backend = storage.backend
+    real_upload = backend.upload
+    taken = []
+    # Batch uploads run in threads, which take turns writing
+    lock = threading.Lock()
+
+    def upload(key, stream, content_type=None):
+        # Fails at once if the request holds the write lock
+        with lock:
+            other = sqlite3.connect(TEST_DB_PATH, timeout=0)
+            try:
+                other.execute('UPDATE user SET email = email')
+                for name in taken:
+                    other.execute('INSERT INTO file (name, user_id) '
+                                  'VALUES (?, ?)', (name, user_id))
+                other.commit()
+            finally:
+                other.close()
+        return real_upload(key, stream, content_type)
+
+    monkeypatch.setattr(backend, 'upload', upload)
+
+    def post(name, body=b'this is a test'):
+        return client.post('/files', data=dict(
+            text='This is a file',
+            date='some date',
+            file=(io.BytesIO(body), name)
+        ))
+
+    def stored_keys():
+        listing = s3_client.list_objects_v2(Bucket=TEST_S3_BUCKET)
+        return sorted(obj['Key'] for obj in listing.get('Contents', []))
+
+    for content_addressed in (False, True):
+        app.config.update(S3_CONTENT_ADDRESSED=content_addressed)
+        prefix = str(content_addressed)
+        assert post(prefix + 'first.pdf').status_code == 200
+        batch_rv = client.post('/files/batch', data=dict(
+            text='Receipt',
+            date='today',
+            file=[(io.BytesIO(b'batch one'), prefix + 'batch1.pdf'),
+                  (io.BytesIO(b'batch two'), prefix + 'batch2.pdf')]
+        ))
+        assert all(result['uploaded']
+                   for result in batch_rv.get_json()['files'])
+
+        # The name is taken by another upload while this one runs
+        keys = stored_keys()
+        taken[:] = [prefix + 'raced.pdf']
+        raced_rv = post(prefix + 'raced.pdf', b'raced contents')
+        assert raced_rv.status_code == 400
+        assert b'already have a file' in raced_rv.data
+        assert stored_keys() == keys
+        taken[:] = []
+
+
+def test_delete_files_batch(client, s3_fixture, monkeypatch):
+    username = 'testuser'
+    user_id = 0
+    password = 'testpass'
+    other_user_id = 1
+
+    (s3_client, s3) = s3_fixture
+    s3_client.create_bucket(Bucket=TEST_S3_BUCKET)
+
+    user = create_user(username, password)
+    user.id = user_id
+    add_user_to_db(user)
+    other_user = create_user('otheruser', password)
+    other_user.id = other_user_id
+    add_user_to_db(other_user)
+
+    for file_id in range(3):
+        file = create_file(name='test{}.pdf'.format(file_id), id=file_id,
+                           username=username, user_id=user_id)
+        add_file_to_db(file)
+        s3.Bucket(TEST_S3_BUCKET).put_object(Key=file.key, Body=b'test')
+    add_file_to_db(create_file(name='other.pdf', id=3, username='otheruser',
+                               user_id=other_user_id))
+
+    client.post('/login', data=dict(
+        username=username,
+        password=password
+    ))
+
+    missing_form_rv = client.delete('/files/delete')
+    assert missing_form_rv.status_code == 400
+
+    invalid_id_rv = client.delete('/files/delete', data=dict(id=['one']))
+    assert invalid_id_rv.status_code == 400
+
+    # Make S3 refuse to delete one of the keys
+    real_delete_objects = storage.backend.client.delete_objects
+
+    def delete_objects(**kwargs):
+        res = real_delete_objects(**kwargs)
+        res['Errors'] = [{'Key': 'testuser/test2.pdf', 'Code': 'AccessDenied',
+                          'Message': 'Access Denied'}]
+        return res
+
+    monkeypatch.setattr(storage.backend.client, 'delete_objects',
+                        delete_objects)
+
+    delete_rv = client.delete('/files/delete', data=dict(
+        id=['0', '1', '2', '3', '9']
+    ))
+    assert delete_rv.status_code == 200
+    results = delete_rv.get_json()['files']
+    assert results[0] == {'id': 0, 'deleted': True}
+    assert results[1] == {'id': 1, 'deleted': True}
+    assert results[2] == {'id': 2, 'deleted': False, 'msg': 'Access Denied'}
+    # Other users files are reported as missing
+    assert results[3]['deleted'] is False
+    assert results[4] == {'id': 9, 'deleted': False,
+                          'msg': 'File does not exist'}
+
+    remaining = [file.id for file in File.query.order_by(File.id)]
+    assert remaining == [2, 3]
+
+
+def test_content_addressed_upload(app, client, s3_fixture):
+    import hashlib
+    from app.models import Blob
+
+    username = 'testuser'
+    password = 'testpass'
+    file_body = b'this is a test'
+    sha256 = hashlib.sha256(file_body).hexdigest()
+
+    (s3_client, s3) = s3_fixture
+    s3_client.create_bucket(Bucket=TEST_S3_BUCKET)
+    app.config.update(S3_CONTENT_ADDRESSED=True)
+
+    add_user_to_db(create_user(username, password))
+
+    client.post('/login', data=dict(
+        username=username,
+        password=password
+    ))
+
+    for name in ('first.pdf', 'second.pdf'):
+        post_file_rv = client.post(
+            '/files',
+            data=dict(
+                text="This is a file",
+                date="some date",
+                file=(io.BytesIO(file_body), name)
+            ))
+        assert post_file_rv.status_code == 200
+
+    # Instant upload of content that is already stored
+    instant_rv = client.post('/files/instant', data=dict(
+        text="This is a file",
+        date="some date",
+        name='third.pdf',
+        hash=sha256
+    ))
+    assert instant_rv.status_code == 200
+
+    unknown_rv = client.post('/files/instant', data=dict(
+        text="This is a file",
+        date="some date",
+        name='fourth.pdf',
+        hash='0' * 64
+    ))
+    assert unknown_rv.status_code == 404
+    assert b'Unknown file hash' in unknown_rv.data
+
+    blob = Blob.query.get(sha256)
+    assert blob.key.startswith('blobs/{}/'.format(sha256))
+    keys = [obj['Key'] for obj in
+            s3_client.list_objects_v2(Bucket=TEST_S3_BUCKET)['Contents']]
+    assert keys == [blob.key]
+    assert blob.refcount == 3
+    assert {file.key for file in File.query} == {blob.key}
+    assert {file.size for file in File.query} == {len(file_body)}
+
+    file_ids = [file.id for file in File.query.order_by(File.id)]
+    delete_rv = client.delete('/files/{}/delete'.format(file_ids[0]))
+    assert b'File removed' in delete_rv.data
+    db.session.expire_all()
+    assert Blob.query.get(sha256).refcount == 2
+
+    # The object goes with the last reference
+    delete_rv = client.delete('/files/delete', data=dict(
+        id=[str(file_id) for file_id in file_ids[1:]]
+    ))
+    results = delete_rv.get_json()['files']
+    assert all(result['deleted'] for result in results)
+    assert Blob.query.get(sha256) is None
+    assert 'Contents' not in s3_client.list_objects_v2(Bucket=TEST_S3_BUCKET)
+
+
+def test_collect_blobs_reacquired(app, s3_fixture):
+    from sqlalchemy import event
+    from app.models import Blob
+    from app.s3.blobs import collect_blobs
+
+    (s3_client, s3) = s3_fixture
+    s3_client.create_bucket(Bucket=TEST_S3_BUCKET)
+
+    kept, dropped = 'a' * 64, 'b' * 64
+    for sha256 in (kept, dropped):
+        s3.Bucket(TEST_S3_BUCKET).put_object(
+            Key='blobs/' + sha256, Body=b'test')
+        db.session.add(Blob(sha256=sha256, key='blobs/' + sha256,
+                            refcount=0))
+    db.session.commit()
+
+    # An upload of the same content acquires the blob after it was
+    # selected for collection but before its row is deleted
+    engine = db.engine
+    reacquired = []
+
+    def reacquire(conn, cursor, statement, *args):
+        if statement.startswith('DELETE FROM blob') and not reacquired:
+            reacquired.append(kept)
+            with engine.connect() as other:
+                other.execute(Blob.__table__.update()
+                              .where(Blob.sha256 == kept)
+                              .values(refcount=1))
+
+    event.listen(engine, 'before_cursor_execute', reacquire)
+    try:
+        assert collect_blobs() == 1
+    finally:
+        event.remove(engine, 'before_cursor_execute', reacquire)
+
+    assert reacquired
+    keys = [obj['Key'] for obj in
+            s3_client.list_objects_v2(Bucket=TEST_S3_BUCKET)['Contents']]
+    assert keys == ['blobs/' + kept]
+    assert Blob.query.get(kept).refcount == 1
+    assert Blob.query.get(dropped) is None
+
+
+def test_zip_files(client, s3_fixture):
+    import zipfile
+
+    username = 'testuser'
+    user_id = 0
+    password = 'testpass'
+
+    (s3_client, s3) = s3_fixture
+    s3_client.create_bucket(Bucket=TEST_S3_BUCKET)
+
+    user = create_user(username, password)
+    user.id = user_id
+    add_user_to_db(user)
+
+    contents = {
+        'report.pdf': b'pdf contents ' * 1000,
+        'sheet.xlsx': b'xlsx contents ' * 1000,
+        'missing.pdf': None,
+    }
+    for file_id, (name, body) in enumerate(contents.items()):
+        file = create_file(name=name, id=file_id,
+                           username=username, user_id=user_id)
+        add_file_to_db(file)
+        if body is not None:
+            s3.Bucket(TEST_S3_BUCKET).put_object(Key=file.key, Body=body)
+
+    client.post('/login', data=dict(
+        username=username,
+        password=password
+    ))
+
+    missing_rv = client.get('/files/zip')
+    assert missing_rv.status_code == 400
+
+    zip_rv = client.get('/files/zip?id=1&id=0&id=2&id=9')
+    assert zip_rv.status_code == 200
+    assert zip_rv.mimetype == 'application/zip'
+
+    archive = zipfile.ZipFile(io.BytesIO(zip_rv.data))
+    assert archive.namelist() == ['sheet.xlsx', 'report.pdf']
+    assert archive.read('report.pdf') == contents['report.pdf']
+    assert archive.read('sheet.xlsx') == contents['sheet.xlsx']
+    assert archive.getinfo('sheet.xlsx').compress_type == zipfile.ZIP_STORED
+    assert archive.getinfo('report.pdf').compress_type == \
+        zipfile.ZIP_DEFLATED
+
+
+def test_zip_stream_closed():
+    """Test objects are closed when the client stops reading the archive"""
+    from unittest import mock
+    from app.s3.archive import stream_zip
+
+    bodies = []
+
+    def open_object(key):
+        body = mock.Mock()
+        body.iter_chunks.return_value = [key.encode('utf-8') * 1000]
+        bodies.append(body)
+        return mock.Mock(size=len(key) * 1000, body=body)
+
+    files = [('test{}.pdf'.format(n), 'key{}'.format(n)) for n in range(8)]
+    stream = stream_zip(mock.Mock(open=open_object), files, prefetch=3)
+    assert next(stream)
+    stream.close()
+
+    # The object being copied and the three fetched ahead
+    assert len(bodies) == 4
+    for body in bodies:
+        body.close.assert_called_once_with()
+
+
+def test_upload_image_thumbnails(app, client, s3_fixture):
+    from PIL import Image
+
+    username = 'testuser'
+    password = 'testpass'
+    file_name = 'photo.png'
+
+    (s3_client, s3) = s3_fixture
+    s3_client.create_bucket(Bucket=TEST_S3_BUCKET)
+    # Render in the request, worker processes do not share moto's mock
+    app.config.update(THUMBNAIL_WORKERS=0, THUMBNAIL_SIZES=[32, 128])
+
+    user = create_user(username, password)
+    add_user_to_db(user)
+
+    client.post('/login', data=dict(
+        username=username,
+        password=password
+    ))
+
+    image = io.BytesIO()
+    Image.new('RGBA', (400, 200), (255, 0, 0, 255)).save(image, 'PNG')
+    image.seek(0)
+
+    post_file_rv = client.post(
+        '/files',
+        data=dict(
+            text="This is a photo",
+            date="some date",
+            file=(image, file_name)
+        ))
+    assert post_file_rv.status_code == 200
+
+    file = File.query.filter_by(name=file_name).first()
+    folder = file.key.rpartition('/')[0]
+    assert file.thumbnails == {
+        '32': '{}/.thumbs/32/photo.png.jpg'.format(folder),
+        '128': '{}/.thumbs/128/photo.png.jpg'.format(folder),
+    }
+
+    thumbnail = s3_client.get_object(Bucket=TEST_S3_BUCKET,
+                                     Key=file.thumbnails['128'])
+    assert thumbnail['ContentType'] == 'image/jpeg'
+    assert Image.open(io.BytesIO(thumbnail['Body'].read())).size == (128, 64)
+
+    files_rv = client.get('/files').get_json()
+    assert files_rv['files'][0]['thumbnails'] == file.thumbnails
+
+    delete_rv = client.delete('/files/{}/delete'.format(file.id))
+    assert b'File removed' in delete_rv.data
+    assert 'Contents' not in s3_client.list_objects_v2(Bucket=TEST_S3_BUCKET)
+
+
+def test_save_thumbnails_failure(app, caplog):
+    """Test a failed thumbnail write is rolled back and logged"""
+    from concurrent.futures import Future
+    from unittest import mock
+    from sqlalchemy.exc import OperationalError
+    from app.s3.thumbnails import save_thumbnails
+
+    future = Future()
+    future.set_result({'128': 'testuser/.thumbs/128/photo.png.jpg'})
+    error = OperationalError('UPDATE file', {}, 'database is locked')
+    with mock.patch.object(db.session, 'commit', side_effect=error), \
+            mock.patch.object(db.session, 'rollback') as rollback:
+        save_thumbnails(app, 1, future)
+
+    rollback.assert_called_once_with()
+    assert 'Saving thumbnails for file 1 failed' in caplog.text
+
+
+def test_download_file(client, s3_fixture):
+    username = 'testuser'
+    user_id = 0
+    password = 'testpass'
+    file_body = b'0123456789' * 10000
+
+    (s3_client, s3) = s3_fixture
+    s3_client.create_bucket(Bucket=TEST_S3_BUCKET)
+
+    user = create_user(username, password)
+    user.id = user_id
+    add_user_to_db(user)
+
+    file = create_file(name='test.pdf', id=0,
+                       username=username, user_id=user_id)
+    add_file_to_db(file)
+    s3.Bucket(TEST_S3_BUCKET).put_object(Key=file.key, Body=file_body,
+                                         ContentType='application/pdf')
+    add_file_to_db(create_file(name='missing.pdf', id=1,
+                               username=username, user_id=user_id))
+
+    client.post('/login', data=dict(
+        username=username,
+        password=password
+    ))
+
+    full_rv = client.get('/files/0/download')
+    assert full_rv.status_code == 200
+    assert full_rv.data == file_body
+    assert full_rv.mimetype == 'application/pdf'
+    assert full_rv.headers['Accept-Ranges'] == 'bytes'
+    etag = full_rv.headers['ETag']
+
+    range_rv = client.get('/files/0/download',
+                          headers={'Range': 'bytes=10-19'})
+    assert range_rv.status_code == 206
+    assert range_rv.data == file_body[10:20]
+    assert range_rv.headers['Content-Range'] == \
+        'bytes 10-19/{}'.format(len(file_body))
+
+    not_modified_rv = client.get('/files/0/download',
+                                 headers={'If-None-Match': etag})
+    assert not_modified_rv.status_code == 304
+    assert not_modified_rv.data == b''
+    assert not_modified_rv.headers['ETag'] == etag
+
+    past_end_rv = client.get('/files/0/download',
+                             headers={'Range': 'bytes=200000-'})
+    assert past_end_rv.status_code == 416
+    assert past_end_rv.headers['Content-Range'] == \
+        'bytes */{}'.format(len(file_body))
+
+    missing_object_rv = client.get('/files/1/download')
+    assert missing_object_rv.status_code == 404
+
+    missing_file_rv = client.get('/files/9/download')
+    assert missing_file_rv.status_code == 404
@@ -0,0 +1,155 @@
+import io
+import pickle
+
+import pytest
+
+from app import storage
+from app.models import User, File
+from app.storage import ObjectNotFound, NotModified, InvalidRange, \
+    PreconditionFailed
+from app.storage.local import LocalBackend
+from app.storage.s3 import S3Backend
+
+from tests.conftest import create_user, add_user_to_db
+
+
+@pytest.fixture
+def local_storage(app, tmp_path):
+    app.config.update(STORAGE_BACKEND='local',
+                      LOCAL_STORAGE_ROOT=str(tmp_path))
+    app.extensions['storage'] = None
+    yield storage.backend
+    app.extensions['storage'] = None
+
+
+def test_local_backend(tmp_path):
+    backend = LocalBackend(str(tmp_path))
+    body = b'0123456789' * 100
+
+    meta = backend.upload('user/test.pdf', io.BytesIO(body),
+                          'application/pdf')
+    assert meta['size'] == len(body)
+    assert backend.head('user/test.pdf') == meta
+    backend.put('user/', b'')
+    backend.put('user/.thumbs/128/test.png.jpg', b'thumb', 'image/jpeg')
+
+    obj = backend.open('user/test.pdf')
+    assert obj.body.read() == body
+    obj.body.close()
+
+    obj = backend.open('user/test.pdf', range='bytes=10-19')
+    assert b''.join(obj.body.iter_chunks(4)) == body[10:20]
+    assert obj.content_range == 'bytes 10-19/1000'
+    obj.body.close()
+
+    with pytest.raises(InvalidRange):
+        backend.open('user/test.pdf', range='bytes=5000-')
+    with pytest.raises(NotModified):
+        backend.open('user/test.pdf', if_none_match='"{}"'
+                     .format(meta['etag']))
+    with pytest.raises(PreconditionFailed):
+        backend.open('user/test.pdf', if_match='other')
+    with pytest.raises(ObjectNotFound):
+        backend.head('user/missing.pdf')
+
+    keys = [key for page in backend.list_pages('user/') for key in page]
+    assert keys == sorted(keys)
+    assert 'user/test.pdf' in keys
+
+    # Removing everything under a prefix leaves no folders behind
+    deleted, errors = backend.delete_many(keys)
+    assert errors == {}
+    assert list(backend.list_pages('user/')) == []
+    assert [path.name for path in tmp_path.iterdir()] == ['.meta']
+
+    # Sent to thumbnail workers without a client
+    s3_backend = S3Backend('somebucket')
+    assert pickle.loads(pickle.dumps(s3_backend)).bucket_name == 'somebucket'
+
+
+def test_local_storage_files(app, client, local_storage):
+    username = 'testuser'
+    password = 'testpass'
+    file_body = b'this is a test'
+
+    add_user_to_db(create_user(username, password))
+    client.post('/login', data=dict(
+        username=username,
+        password=password
+    ))
+
+    upload_rv = client.post('/files', data=dict(
+        text='This is a file',
+        date='some date',
+        file=(io.BytesIO(file_body), 'test.pdf', 'application/pdf')
+    ))
+    assert upload_rv.status_code == 200
+
+    file = File.query.filter_by(name='test.pdf').first()
+    assert file.size == len(file_body)
+    assert local_storage.head(file.key)['etag'] == file.etag
+
+    download_rv = client.get('/files/{}/download'.format(file.id))
+    assert download_rv.data == file_body
+
+    # Presigned URLs are served by the app
+    url = client.get('/files/{}'.format(file.id)).get_json()['file']['url']
+    assert client.get(url).data == file_body
+    assert client.get(url.replace('token=', 'token=x')).status_code == 404
+
+    client.delete('/files/{}/delete'.format(file.id))
+    with pytest.raises(ObjectNotFound):
+        local_storage.head(file.key)
+
+
+def test_reconcile(app, local_storage):
+    """Test finding and repairing differences between storage and rows"""
+    from app import db
+    from app.cli import register
+    from app.models import Blob
+
+    add_user_to_db(create_user('testuser', 'testpass'))
+    user_id = User.query.first().id
+    for key in ['testuser/', 'testuser/kept.pdf', 'testuser/orphan.pdf',
+                'testuser/.thumbs/128/kept.png.jpg', 'deleted/old.pdf',
+                'blobs/aaaa', 'blobs/cccc']:
+        local_storage.put(key, b'data')
+    db.session.add_all([
+        File(name='kept.pdf', key='testuser/kept.pdf', user_id=user_id),
+        File(name='gone.pdf', key='testuser/gone.pdf', user_id=user_id),
+        File(name='a.pdf', key='blobs/aaaa', user_id=user_id,
+             blob_sha256='aaaa'),
+        File(name='b.pdf', key='blobs/bbbb', user_id=user_id,
+             blob_sha256='bbbb'),
+        Blob(sha256='aaaa', key='blobs/aaaa', refcount=1),
+        Blob(sha256='bbbb', key='blobs/bbbb', refcount=1),
+    ])
+    db.session.commit()
+
+    register(app)
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['files', 'reconcile', '--concurrency', '1'])
+    assert result.exit_code == 0, result.output
+    assert result.output.splitlines() == [
+        'missing blobs/bbbb',
+        'orphan blobs/cccc',
+        'orphan deleted/old.pdf',
+        'missing testuser/gone.pdf',
+        'orphan testuser/orphan.pdf',
+        'Checked 5 objects, 3 orphaned, 2 missing',
+    ]
+
+    # New objects may belong to uploads that have not committed yet
+    result = runner.invoke(args=['files', 'reconcile', '--repair'])
+    assert 'Deleted 0 objects and 3 rows' in result.output
+
+    result = runner.invoke(args=['files', 'reconcile', '--repair',
+                                 '--grace', '0'])
+    assert 'Deleted 3 objects and 0 rows' in result.output
+    result = runner.invoke(args=['files', 'reconcile'])
+    assert result.output.splitlines() == [
+        'Checked 2 objects, 0 orphaned, 0 missing']
+
+    assert File.query.count() == 2
+    assert Blob.query.get('bbbb') is None
+    local_storage.head('testuser/kept.pdf')